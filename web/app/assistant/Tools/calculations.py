@@ -0,0 +1,6 @@
+# Functions run in the tools process pool. This module must not import Django or the rest of the app,
+# pool processes are spawned and import it from scratch.
+from simpleeval import simple_eval
+
+def evaluate_expression(expression: str):
+    return simple_eval(expression)
@@ -1,19 +1,15 @@
 from textwrap import dedent
 from ..moderation import Moderation
-# For weather tool
-import pyowm
-# For news tool
-from newsapi import NewsApiClient
-# Calculator
-from simpleeval import simple_eval
+# Network tools share the HTTP session of the worker, blocking work runs in tool pools.
+from ..tool_executor import get_http_session, run_in_thread, process_runner
+from ..settings import TOOLS_PROCESS_TIMEOUT_MARGIN
+# Calculator, evaluated in the process pool
+from .calculations import evaluate_expression
 # Chat summarizer
-from ...utils import get_chat_history
+from ...utils import get_unsummarized_messages, Encryption
 from ..helpers import openai_chat_request
 from ...models import Chat, Message
 # For website scraper.
-import requests
-import aiohttp
-import asyncio
 from bs4 import BeautifulSoup
 
 import os
@@ -23,32 +19,37 @@ from dotenv import load_dotenv
 load_dotenv()
 WEATHER_API_KEY = os.getenv("WEATHER_API_KEY")
 NEWS_API_KEY = os.getenv("NEWS_API_KEY")
+WEATHER_API_URL = "https://api.openweathermap.org/data/2.5/weather"
+NEWS_API_URL = "https://newsapi.org/v2/top-headlines"
+# Length of website content parts checked by moderation
+MODERATION_CHUNK_LENGTH = 2000
+# Parts moderated in one request and maximum length of website content, longer content is cut.
+MODERATION_BATCH_SIZE = 8
+WEBSITE_MAX_CONTENT_LENGTH = 32000
 
 def tools_info() -> str:
+    # Registry imports this module, so it is imported on call.
+    from ..tool_registry import get_tool_registry
 
-    with open('web/app/assistant/Tools/tools_list.txt', 'r', encoding="utf-8") as file:
-        tools_list = eval(file.read())
-        
-    message = "Here is tools list:\n"
-    for tool in tools_list:
-        message += f"Name: {tool['name'].replace('_', ' ')}; Description: {tool['description']}; Inputs: {', '.join(tool['inputs']).replace('_', ' ')};\nInputs desription: {tool['inputs_description']}\n"
-
-    return message
+    return get_tool_registry().info_message
 
-def weather(location: str) -> str|None:
+async def weather(location: str) -> str|None:
     """
     This function retrieves weather information for a given location using the OpenWeatherMap API.
     """
     if location and location.strip() != '':
         # Make request to weather API
-        owm = pyowm.OWM(WEATHER_API_KEY)
-        weather_mgr = owm.weather_manager()
-        observation = weather_mgr.weather_at_place(location)
+        params = {"q": location, "appid": WEATHER_API_KEY, "units": "metric"}
+        async with get_http_session().get(WEATHER_API_URL, params=params) as response:
+            if response.status == 404:
+                raise Exception(f'Location "{location}" not found')
+            response.raise_for_status()
+            observation = await response.json()
         # Extract needed info
-        temperature = observation.weather.temperature("celsius")["temp"]
-        humidity = observation.weather.humidity
-        wind = observation.weather.wind()
-        status = observation.weather.detailed_status
+        temperature = observation["main"]["temp"]
+        humidity = observation["main"]["humidity"]
+        wind = observation["wind"]
+        status = observation["weather"][0]["description"]
         # Create message for assistant
         message = dedent(f"""\
         Weather in: {location}
@@ -63,27 +64,29 @@ def weather(location: str) -> str|None:
         raise Exception('No location passed')
 
 
-def news(key_words: str, category: str = None) -> str|None:
+async def news(key_words: str, category: str = None) -> str|None:
     """
     Uses the News API and fetches latest news headlines based on key words
     and category, returning articles details to assistant.
     """
     available_categories = ['business', 'entertainment', 'general', 'health', 'science', 'sports', 'technology']
     result = ''
-    print(category, type(category), '-'*100)
-    if category or category.strip() == '':
+    if category and category.strip() != '':
         category = category.strip().lower()
         if category not in available_categories:
             result += f'Invalid category "{category}" provided, results are based on key words only.'
             category = None
+    else:
+        category = None
 
     try:
-        newsapi = NewsApiClient(api_key=NEWS_API_KEY)
-        top_headlines = newsapi.get_top_headlines(
-            q = key_words,
-            category = category,
-            language = 'en',
-            page_size=20)
+        params = {"q": key_words, "language": "en", "pageSize": 20}
+        if category:
+            params["category"] = category
+        async with get_http_session().get(NEWS_API_URL, params=params, headers={"X-Api-Key": NEWS_API_KEY}) as response:
+            top_headlines = await response.json()
+        if top_headlines.get('status') != 'ok':
+            raise Exception(top_headlines.get('message', f'status {response.status}'))
 
         result = "Tell user about these found articles. You MUST mention source and link (url) to the article!" + str(top_headlines['articles'])
         return result
@@ -91,9 +94,13 @@ def news(key_words: str, category: str = None) -> str|None:
     except Exception as e:
         raise Exception(f"Something went wrong while searching news: {e}")
 
-def calculator(expression) -> str|None:
+async def calculator(expression) -> str|None:
+    # Registry imports this module, so it is imported on call.
+    from ..tool_registry import get_tool_registry
+    timeout = get_tool_registry().get('calculator')['timeout'] - TOOLS_PROCESS_TIMEOUT_MARGIN
     try:
-        result = simple_eval(expression)
+        # Expression is evaluated in other process, that is stopped if it takes too long (9**9**9).
+        result = await process_runner.run(evaluate_expression, (expression,), timeout)
         return f"Solution for {expression} is {result}."
     
     except (SyntaxError, TypeError, NameError) as e:
@@ -106,32 +113,49 @@ async def chat_summarizer(messages_to_summarize, user) -> tuple[str|None, dict|N
     if int(messages_to_summarize) > 25:
         raise Exception('Number of messages to summarize cannot exceed 25.')
         
+    messages_to_summarize = int(messages_to_summarize)
     chat = await Chat.objects.aget(user=user)
-    messages = await get_chat_history(chat, int(messages_to_summarize))
+    # Only messages after the rolling summary are fetched, earlier messages are taken from the summary.
+    messages, last_message = await get_unsummarized_messages(chat, messages_to_summarize)
     
     system = "Summarize this chat"
-    prompt = f"Chat history:\n{messages}"
+    prompt = "Chat history:\n" + '\n'.join(messages)
+    if len(messages) < messages_to_summarize and chat.summary:
+        prompt = f"Summary of earlier chat:\n{Encryption().decrypt(chat.summary)}\n" + prompt
     response, token_usage = await openai_chat_request(prompt=prompt, system=system)
     
     return response, token_usage
    
+def parse_website(html: bytes) -> str:
+    # Parse the HTML content
+    soup = BeautifulSoup(html, 'html.parser')
+    
+    # Extract relevant info
+    title = soup.title.string if soup.title else "No title available"
+    paragraphs = [p.get_text(strip=True) for p in soup.find_all('p')]
+    return f"Title: {title}\nContent:\n" +'\n'.join(paragraphs)
+
 async def website_checker(website_link: str):
     try:
-        response = requests.get(website_link)
-        response.raise_for_status()  # Raise an error for failed requests
-        
-        # Parse the HTML content
-        soup = BeautifulSoup(response.content, 'html.parser')
+        async with get_http_session().get(website_link) as response:
+            response.raise_for_status()  # Raise an error for failed requests
+            html = await response.read()
         
-        # Extract relevant info
-        title = soup.title.string if soup.title else "No title available"
-        paragraphs = [p.get_text(strip=True) for p in soup.find_all('p')]
-        content = f"Title: {title}\nContent:\n" +'\n'.join(paragraphs)
+        # Parsing of big pages takes a while, so it runs in the tools thread pool.
+        content = await run_in_thread(parse_website, html)
         
+        # Only moderated part of the content is returned.
+        content = content[:WEBSITE_MAX_CONTENT_LENGTH]
+        # Moderate the content split in chunks, few chunks per request.
+        chunks = [content[i:i + MODERATION_CHUNK_LENGTH] for i in range(0, len(content), MODERATION_CHUNK_LENGTH)]
         moder = Moderation()
-        flaged, categories = moder.moderate(content[1000:])
-        if flaged:
-            raise Exception(f"Content of the wepbage user asked to check has ill content. Categories: {categories}")
+        for i in range(0, len(chunks), MODERATION_BATCH_SIZE):
+            categories = set()
+            for flaged, chunk_categories in await moder.moderate_batch(chunks[i:i + MODERATION_BATCH_SIZE]):
+                if flaged:
+                    categories.update(chunk_categories)
+            if categories:
+                raise Exception(f"Content of the wepbage user asked to check has ill content. Categories: {list(categories)}")
         
         # Create message for assitant.
         message = dedent(f"""\
@@ -4,6 +4,7 @@ from datetime import date
 from textwrap import dedent
 import json
 
+from .prompt_budget import PromptBudget, count_messages_tokens
 from .settings import EMOTIONAL_JOURNAL_DEBUG, EMOTIONAL_JOURNAL_EMOTIONS
 
 class EmotionalJournal():
@@ -24,6 +25,8 @@ class EmotionalJournal():
         else:
             self.updates_count = 0
         self.gpt_model = gpt_model
+        # Prompt tokens of the last journal request counted before it was sent.
+        self.prompt_tokens = None
         
     async def update_journal(self, chat_history: list, user_message:str) -> tuple[dict, int, date, dict]:
         """
@@ -49,15 +52,21 @@ class EmotionalJournal():
             ...
         }}""")
 
+        # Chat history takes what is left of the budget after instructions and the last user message.
+        budget = PromptBudget('Journal', self.gpt_model)
+        budget.reserve(system, user_message)
+        chat_history = budget.fit_items(chat_history, keep_end = True)
+
         # Create a prompt
         prompt = ("Conversation:|"+
         '\n'.join(chat_history)+"|"+
         "\nLast user message:" + user_message)
+        self.prompt_tokens = count_messages_tokens(self.gpt_model, system, prompt)
 
         # Request a response from the OpenAI GPT model.
         response, token_usage = await openai_chat_request(prompt = prompt, system = system, model = self.gpt_model)
 
-        if EMOTIONAL_JOURNAL_DEBUG: print(f"{'_'*20}\nJournal prompt:\n{prompt}\nJournal update response:\n{response}\n{'_'*20}")
+        if EMOTIONAL_JOURNAL_DEBUG: print(f"{'_'*20}\nJournal prompt:\n{prompt}\nPrompt tokens: {self.prompt_tokens} of {budget.budget}\nJournal update response:\n{response}\n{'_'*20}")
         
         # If response exists
         if response is not None:
@@ -1,4 +1,5 @@
-import asyncio, base64
+import asyncio, base64, hashlib, threading, time
+from collections import OrderedDict
 from io import BytesIO
 from openai import AsyncOpenAI
 from PIL import Image
@@ -8,7 +9,114 @@ load_dotenv()
 
 client = AsyncOpenAI()
 
+class ChatStream:
+    """
+    Async iterator over text deltas of a streamed chat completion.
+    While iterating it assembles the full response and captures token usage from the last chunk,
+    so after the iteration `response` and `usage` hold the same values as a regular request returns.
+    `finished` is True only if the stream was read to its end, after a failure `response` is truncated.
+    """
+    def __init__(self, stream, model: str):
+        self.stream = stream
+        self.model = model
+        self.response = ""
+        self.usage = None
+        self.finished = False
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            # With 'include_usage' the last chunk has no choices and only carries usage.
+            if chunk.usage:
+                self.usage = usage_with_cached_tokens(chunk.usage, self.model)
+            if chunk.choices and chunk.choices[0].delta.content:
+                delta = chunk.choices[0].delta.content
+                self.response += delta
+                yield delta
+        self.finished = True
+
+class PromptCacheStats:
+    """
+    Per-process counts of prompt tokens and prompt tokens read from OpenAI prompt cache by model.
+    """
+    def __init__(self):
+        self.tokens: dict[str, dict[str, int]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, model: str, prompt_tokens: int, cached_tokens: int):
+        with self.lock:
+            tokens = self.tokens.setdefault(model, {"prompt_tokens": 0, "cached_tokens": 0, "requests": 0})
+            tokens["prompt_tokens"] += prompt_tokens
+            tokens["cached_tokens"] += cached_tokens
+            tokens["requests"] += 1
+
+    def stats(self) -> dict[str, dict]:
+        """
+        Returns counts with share of prompt tokens that were cached for every model.
+        """
+        with self.lock:
+            return {
+                model: {**tokens, "hit_rate": round(tokens["cached_tokens"] / max(1, tokens["prompt_tokens"]), 3)}
+                for model, tokens in self.tokens.items()
+            }
+
+prompt_cache_stats = PromptCacheStats()
+
+def usage_with_cached_tokens(usage, model: str) -> dict:
+    """
+    Converts usage of a response to dictionary with 'cached_tokens', the part of 'prompt_tokens' read from prompt cache.
+    """
+    usage = usage.model_dump()
+    usage["cached_tokens"] = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+    prompt_cache_stats.add(model, usage["prompt_tokens"], usage["cached_tokens"])
+    return usage
 
+class TTLCache:
+    """
+    Bounded cache where entries expire 'ttl' seconds after they were set, or after their own ttl passed to 'set',
+    and the least recently used entry is evicted when 'max_size' is reached. Counts hits and misses, safe to share between threads.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + (ttl if ttl is not None else self.ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+def text_cache_key(text: str, *parts) -> str:
+    """
+    Hash of text normalized to lower case with collapsed whitespace and trimmed punctuation,
+    so trivial variations of short messages share a key. 'parts' (model name, options) are added to the key.
+    """
+    normalized = " ".join(text.casefold().split()).strip(".,!?;:'\" ")
+    key = "\x1f".join([normalized, *map(str, parts)])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
 def encode_image(image: BytesIO, max_image=512):
     """
@@ -30,10 +138,11 @@ def encode_image(image: BytesIO, max_image=512):
         return encoded_image
     
 
-async def openai_chat_request(prompt=None, messages=None, system="You are a helpful assistant.", model="gpt-4o-mini", max_retries=5, temperature=1, max_tokens=1000, timeout=10, image: BytesIO = None):
+async def openai_chat_request(prompt=None, messages=None, system="You are a helpful assistant.", model="gpt-4o-mini", max_retries=5, temperature=1, max_tokens=1000, timeout=10, image: BytesIO = None, stream: bool = False):
     """
     This function makes a chat request to OpenAI and returns the response and information about used tokens.
     In case of an error, or if the request takes longer than 'timeout' seconds, it retries up to 'max_retries' times with exponential backoff.
+    With 'stream' the response is a ChatStream of text deltas and usage is None until the stream is consumed.
     """
     if not messages and not image:
         messages = [
@@ -65,6 +174,19 @@ async def openai_chat_request(prompt=None, messages=None, system="You are a help
     
     for _ in range(max_retries):
         try:
+            if stream:
+                # Only opening of the stream is retried, deltas are consumed by the caller.
+                chat_completion_stream = await asyncio.wait_for(client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    stream=True,
+                    stream_options={"include_usage": True}
+                ), timeout=timeout)
+
+                return ChatStream(chat_completion_stream, model), None
+
             chat_completion_resp = await asyncio.wait_for(client.chat.completions.create(
                 model=model,
                 messages=messages,
@@ -73,7 +195,7 @@ async def openai_chat_request(prompt=None, messages=None, system="You are a help
             ), timeout=timeout)
 
             response = chat_completion_resp.choices[0].message.content
-            usage = chat_completion_resp.usage.model_dump()
+            usage = usage_with_cached_tokens(chat_completion_resp.usage, model)
             
             return response, usage
         except asyncio.TimeoutError:
@@ -87,6 +209,47 @@ async def openai_chat_request(prompt=None, messages=None, system="You are a help
     print("Maximum retries reached.")
     return None, None
 
+async def openai_function_call_request(prompt: str, functions: list[dict], system: str = "You are a helpful assistant.", model="gpt-4o-mini",
+                                       max_retries=5, temperature=0, max_tokens=1000, timeout=10) -> tuple[list[tuple[str, str]] | None, dict | None]:
+    """
+    Makes a chat request with native function calling and returns the called functions and information about used tokens.
+    Retries the same way as 'openai_chat_request'.
+
+    Returns:
+    - Tuple of list of (function name, arguments JSON string) tuples, empty if model called no functions, and token usage.
+    """
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": prompt}
+    ]
+    wait_time = 0.1
+
+    for _ in range(max_retries):
+        try:
+            chat_completion_resp = await asyncio.wait_for(client.chat.completions.create(
+                model=model,
+                messages=messages,
+                tools=list(functions),
+                tool_choice="auto",
+                temperature=temperature,
+                max_tokens=max_tokens
+            ), timeout=timeout)
+
+            tool_calls = chat_completion_resp.choices[0].message.tool_calls or []
+            usage = usage_with_cached_tokens(chat_completion_resp.usage, model)
+
+            return [(tool_call.function.name, tool_call.function.arguments) for tool_call in tool_calls], usage
+        except asyncio.TimeoutError:
+            print(f"OpenAI response timed out, retrying in {wait_time} seconds...")
+        except Exception as e:
+            print(f"Error occurred in OpenAI response: {e}, retrying in {wait_time} seconds...")
+
+        await asyncio.sleep(wait_time)
+        wait_time *= 2
+
+    print("Maximum retries reached.")
+    return None, None
+
 async def openai_audio_transcription(audio_file, model='whisper-1', max_retries=3, timeout=5):
     wait_time = 0.1
     for _ in range(max_retries):
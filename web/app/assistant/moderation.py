@@ -1,31 +1,37 @@
-import openai
-from openai import OpenAI
-
-from dotenv import load_dotenv
-load_dotenv()
-client = OpenAI()
+from .helpers import client
 
 class Moderation:
     """
     This class takes user message as input and returns:
       - True/False - whether the message has been flagged
       - The categories if True
+
+    Requests are made with the shared async client, so moderation doesn't block the event loop.
     """
-    def moderate(self, user_message, model='omni-moderation-latest'):
+    async def moderate(self, user_message, model='omni-moderation-latest'):
         '''A function to check user message for ill-intent'''
+        results = await self.moderate_batch([user_message], model=model)
+        return results[0]
+
+    async def moderate_batch(self, inputs: list[str], model='omni-moderation-latest') -> list[tuple[bool, list[str]]]:
+        '''A function to check multiple texts for ill-intent in one request. Returns results in order of inputs.'''
         # Wait until response is received
-        response = client.moderations.create(input=user_message, model=model)
-
-        # Process moderation response
-        flagged = response.results[0].flagged
-        flagged_categories = []
-
-        # If message has ill-intent
-        if flagged:
-        
-            # Extract categories that describe message's ill-intent
-            categories = response.results[0].categories.model_dump()
-            flagged_categories = [category for category,
-                                  value in categories.items() if value]
-            
-        return flagged, flagged_categories
\ No newline at end of file
+        response = await client.moderations.create(input=inputs, model=model)
+
+        results = []
+        for result in response.results:
+            # Process moderation response
+            flagged = result.flagged
+            flagged_categories = []
+
+            # If text has ill-intent
+            if flagged:
+
+                # Extract categories that describe text's ill-intent
+                categories = result.categories.model_dump()
+                flagged_categories = [category for category,
+                                      value in categories.items() if value]
+
+            results.append((flagged, flagged_categories))
+
+        return results
@@ -0,0 +1,182 @@
+import asyncio
+from time import perf_counter
+from typing import Callable, Awaitable, Any
+
+from .settings import PIPELINE_DEBUG
+
+class Stage:
+    """
+    One step of the assistant pipeline.
+
+    Args:
+    - name (str): Unique name of the stage. Its result is passed to dependent stages under this name.
+    - function (callable): Async function that receives results of 'inputs' as keyword arguments.
+    - inputs (list): Names of stages this stage depends on.
+    - timeout (float): Seconds the stage may run. None means no limit.
+    - optional (bool): If True, exception or missed deadline makes the stage result None instead of failing the pipeline.
+    - condition (callable): Receives results of 'condition_inputs' as keyword arguments and returns False to skip the stage.
+    - condition_inputs (list): Stages needed to check the condition, by default all 'inputs'. The condition is checked
+    as soon as they are resolved, so the stage can be skipped before its other inputs are ready.
+    - speculative (bool): If True, the stage result is only needed by dependent stages, so the stage is
+    cancelled when all of them are already resolved.
+    - cancel_condition (callable): Receives results of 'cancel_inputs' as keyword arguments and returns True to cancel
+    the stage. Unlike 'condition' it is checked also while the stage runs, the stage doesn't wait for 'cancel_inputs'.
+    - cancel_inputs (list): Stages needed to check the cancel condition.
+    """
+    def __init__(self, name: str, function: Callable[..., Awaitable[Any]], inputs: list[str] = None,
+                 timeout: float = None, optional: bool = False, condition: Callable[..., bool] = None,
+                 condition_inputs: list[str] = None, speculative: bool = False,
+                 cancel_condition: Callable[..., bool] = None, cancel_inputs: list[str] = None):
+        self.name = name
+        self.function = function
+        self.inputs = inputs or []
+        self.timeout = timeout
+        self.optional = optional
+        self.condition = condition
+        self.condition_inputs = condition_inputs if condition_inputs is not None else self.inputs
+        self.speculative = speculative
+        self.cancel_condition = cancel_condition
+        self.cancel_inputs = cancel_inputs or []
+
+class StageScheduler:
+    """
+    Runs pipeline stages as soon as all their inputs are resolved, so independent stages overlap.
+
+    - Skipped, failed optional and timed out optional stages resolve to None.
+    - Running speculative stages are cancelled when every stage that depends on them is already resolved,
+    for example recommendation search when no response will be generated.
+    - Stages are cancelled before or while they run when their cancel condition is met, for example
+    profile update of a message flagged by moderation. Cancelled stages resolve to None.
+    - Time of every started stage is recorded in 'timings'.
+    """
+    def __init__(self, stages: list[Stage]):
+        self.stages = {stage.name: stage for stage in stages}
+        self.dependents = {name: [] for name in self.stages}
+
+        for stage in stages:
+            if not set(stage.condition_inputs) <= set(stage.inputs):
+                raise Exception(f"Condition inputs of stage '{stage.name}' must be in its inputs.")
+            for input in stage.inputs:
+                if input not in self.stages:
+                    raise Exception(f"Stage '{stage.name}' depends on unknown stage '{input}'.")
+                self.dependents[input].append(stage.name)
+            for input in stage.cancel_inputs:
+                if input not in self.stages:
+                    raise Exception(f"Stage '{stage.name}' is cancelled by unknown stage '{input}'.")
+
+        self.results = {}
+        self.timings = {}
+        self.skipped = set()
+        self.checked_conditions = set()
+
+    async def run(self) -> dict[str, Any]:
+        """
+        Runs all stages and returns dictionary with their results by stage name.
+        """
+        pending = dict(self.stages)
+        running: dict[asyncio.Task, str] = {}
+        try:
+            while pending or running:
+                self._start_ready_stages(pending, running)
+                self._cancel_unneeded_stages(running)
+
+                if not running:
+                    if pending:
+                        raise Exception(f"Stages can't be resolved, check for dependency cycle: {list(pending)}")
+                    break
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                # All finished stages are resolved, so exceptions of other failed stages are retrieved too.
+                errors = []
+                for task in done:
+                    try:
+                        self._resolve(running.pop(task), task)
+                    except Exception as e:
+                        errors.append(e)
+                if errors:
+                    raise errors[0]
+        finally:
+            # On failure of a required stage stop everything else and wait until cancelled stages stop,
+            # so none of them finishes its requests after the pipeline returned.
+            for task in running:
+                task.cancel()
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+
+        if PIPELINE_DEBUG: print(f"{'_'*20}\nPipeline stages timings:\n{self.timings}\nSkipped: {self.skipped}\n{'_'*20}")
+        return self.results
+
+    def _start_ready_stages(self, pending: dict[str, Stage], running: dict[asyncio.Task, str]):
+        # Skipping a stage resolves it immediately, which can make other stages ready.
+        started = True
+        while started:
+            started = False
+            for name, stage in list(pending.items()):
+                if stage.condition is not None and name not in self.checked_conditions:
+                    if not all(input in self.results for input in stage.condition_inputs):
+                        continue
+
+                    self.checked_conditions.add(name)
+                    if not stage.condition(**{input: self.results[input] for input in stage.condition_inputs}):
+                        del pending[name]
+                        started = True
+                        self.results[name] = None
+                        self.skipped.add(name)
+                        continue
+
+                if self._cancel_condition_met(stage):
+                    del pending[name]
+                    started = True
+                    self.results[name] = None
+                    self.skipped.add(name)
+                    continue
+
+                if not all(input in self.results for input in stage.inputs):
+                    continue
+
+                del pending[name]
+                started = True
+                kwargs = {input: self.results[input] for input in stage.inputs}
+                running[asyncio.create_task(self._run_stage(stage, kwargs))] = name
+
+    def _cancel_unneeded_stages(self, running: dict[asyncio.Task, str]):
+        for task, name in running.items():
+            dependents = self.dependents[name]
+            if self.stages[name].speculative and dependents and all(dependent in self.results for dependent in dependents):
+                task.cancel()
+            elif self._cancel_condition_met(self.stages[name]):
+                task.cancel()
+
+    def _cancel_condition_met(self, stage: Stage) -> bool:
+        if stage.cancel_condition is None or not all(input in self.results for input in stage.cancel_inputs):
+            return False
+        return stage.cancel_condition(**{input: self.results[input] for input in stage.cancel_inputs})
+
+    def _resolve(self, name: str, task: asyncio.Task):
+        stage = self.stages[name]
+        if task.cancelled():
+            self.results[name] = None
+            self.skipped.add(name)
+            return
+
+        exception = task.exception()
+        if exception is None:
+            self.results[name] = task.result()
+            return
+
+        if not stage.optional:
+            raise exception
+
+        if isinstance(exception, asyncio.TimeoutError):
+            print(f"Optional stage '{name}' missed its deadline of {stage.timeout} seconds and was cancelled.")
+        else:
+            print(f"Error occurred in optional stage '{name}': {exception}")
+        self.results[name] = None
+        self.skipped.add(name)
+
+    async def _run_stage(self, stage: Stage, kwargs: dict):
+        start = perf_counter()
+        try:
+            return await asyncio.wait_for(stage.function(**kwargs), timeout=stage.timeout)
+        finally:
+            self.timings[stage.name] = round(perf_counter() - start, 3)
@@ -0,0 +1,107 @@
+import functools
+
+import tiktoken
+
+from .settings import PROMPT_TOKEN_BUDGETS, PROMPT_DEFAULT_ENCODING, PROMPT_MESSAGE_OVERHEAD_TOKENS
+
+@functools.cache
+def get_encoder(model: str) -> tiktoken.Encoding | None:
+    """
+    Returns the tokenizer of the model, loaded once per process. Models unknown to tiktoken use
+    PROMPT_DEFAULT_ENCODING. None if the encoding can't be loaded, tokens are then estimated from text length.
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        pass
+    except Exception as e:
+        print(f"Error occurred while loading tokenizer of model {model}: {e}")
+        return None
+
+    try:
+        return tiktoken.get_encoding(PROMPT_DEFAULT_ENCODING)
+    except Exception as e:
+        print(f"Error occurred while loading tokenizer {PROMPT_DEFAULT_ENCODING}: {e}")
+        return None
+
+def count_tokens(text: str, model: str) -> int:
+    encoder = get_encoder(model)
+    if encoder is None:
+        # Rough estimate of 4 characters per token for English text.
+        return len(text) // 4 + 1
+    return len(encoder.encode(text, disallowed_special=()))
+
+def count_messages_tokens(model: str, *messages: str) -> int:
+    """
+    Counts prompt tokens of a chat request with the given messages, including message formatting.
+    """
+    return sum(count_tokens(message, model) + PROMPT_MESSAGE_OVERHEAD_TOKENS for message in messages) + PROMPT_MESSAGE_OVERHEAD_TOKENS
+
+def truncate_tokens(text: str, max_tokens: int, model: str, keep_end: bool = False) -> str:
+    """
+    Cuts the text to 'max_tokens', keeping its beginning or, if 'keep_end' is True, its end.
+    """
+    if max_tokens <= 0:
+        return ""
+    encoder = get_encoder(model)
+    if encoder is None:
+        max_chars = max_tokens * 4
+        return text if len(text) <= max_chars else (text[-max_chars:] if keep_end else text[:max_chars])
+
+    tokens = encoder.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoder.decode(tokens[-max_tokens:] if keep_end else tokens[:max_tokens])
+
+def get_token_budget(module: str, model: str) -> int:
+    budgets = PROMPT_TOKEN_BUDGETS[module]
+    return budgets.get(model, budgets['default'])
+
+class PromptBudget:
+    """
+    Token budget of one prompt. Parts that are always sent are reserved first, then sections are filled
+    in order of their priority, every section takes what is left of the budget after previous sections.
+
+    - 'fit_text' truncates a text section.
+    - 'fit_items' takes whole items of a list section (chat messages, profile entries, recommendations),
+    from its start or from its end, while they fit.
+    - 'used' is the number of prompt tokens taken by reserved parts and fitted sections.
+    """
+    def __init__(self, module: str, model: str):
+        self.model = model
+        self.budget = get_token_budget(module, model)
+        self.used = PROMPT_MESSAGE_OVERHEAD_TOKENS
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.budget - self.used)
+
+    def reserve(self, *texts: str) -> int:
+        """
+        Counts texts that are always sent whole, like instructions and the user message.
+        """
+        tokens = sum(count_tokens(text, self.model) for text in texts)
+        self.used += tokens
+        return tokens
+
+    def fit_text(self, text: str, keep_end: bool = False) -> str:
+        text = truncate_tokens(text, self.remaining, self.model, keep_end)
+        self.reserve(text)
+        return text
+
+    def fit_items(self, items: list[str], keep_end: bool = False, separator_tokens: int = 1) -> list[str]:
+        """
+        Returns items that fit in the remaining budget in their original order. With 'keep_end' items
+        are taken from the end of the list, so the latest chat messages are kept.
+        """
+        fitted = []
+        for item in (reversed(items) if keep_end else items):
+            tokens = count_tokens(item, self.model) + separator_tokens
+            if tokens > self.remaining:
+                break
+            self.used += tokens
+            fitted.append(item)
+
+        if keep_end:
+            fitted.reverse()
+        return fitted
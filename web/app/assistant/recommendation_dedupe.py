@@ -0,0 +1,125 @@
+"""
+Near-duplicate detection for recommendation texts.
+
+Texts are compared by sets of word shingles. Candidate pairs are found with MinHash signatures and
+locality-sensitive hashing, so the corpus is not compared pair by pair, then confirmed with exact Jaccard
+similarity of shingles and distance of category vectors.
+"""
+import hashlib, re
+from itertools import combinations
+
+import numpy as np
+
+from .settings import RECOMMENDER_SHINGLE_SIZE
+
+# Hash values are taken modulo Mersenne prime 2^61 - 1.
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+def shingles(text: str, size: int = RECOMMENDER_SHINGLE_SIZE) -> set[str]:
+    """
+    Returns set of 'size' consecutive words of the text in lower case. Texts shorter than 'size' words are one shingle.
+    """
+    words = re.findall(r"\w+", text.casefold())
+    if len(words) <= size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def jaccard(first: set, second: set) -> float:
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
+
+class MinHasher:
+    """
+    Computes MinHash signatures of shingle sets, equal positions of two signatures estimate Jaccard similarity of sets.
+
+    Args:
+    - num_perm (int): Number of hash functions, length of a signature.
+    - bands (int): Number of LSH bands, signatures equal in any band make a candidate pair.
+    """
+    def __init__(self, num_perm: int = 64, bands: int = 16, seed: int = 1):
+        if num_perm % bands:
+            raise Exception("Number of hash functions must be divisible by number of bands.")
+        rng = np.random.RandomState(seed)
+        # Coefficients below 2^31 with 32-bit shingle hashes keep products within uint64.
+        self.a = rng.randint(1, 1 << 31, num_perm).astype(np.uint64)
+        self.b = rng.randint(0, 1 << 31, num_perm).astype(np.uint64)
+        self.num_perm = num_perm
+        self.bands = bands
+
+    def signature(self, shingle_set: set[str]) -> np.ndarray:
+        hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=4).digest(), 'little')
+                           for shingle in shingle_set], dtype=np.uint64)
+        if len(hashes) == 0:
+            return np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint64)
+        return ((hashes[:, None] * self.a + self.b) % MERSENNE_PRIME).min(axis=0)
+
+    def candidate_pairs(self, signatures: np.ndarray) -> set[tuple[int, int]]:
+        """
+        Returns pairs of row numbers of signatures equal in at least one band.
+        """
+        rows = self.num_perm // self.bands
+        pairs = set()
+        for band in range(self.bands):
+            buckets = {}
+            for i, signature in enumerate(signatures):
+                buckets.setdefault(signature[band * rows:(band + 1) * rows].tobytes(), []).append(i)
+            for bucket in buckets.values():
+                pairs.update(combinations(bucket, 2))
+        return pairs
+
+def near_duplicate_clusters(vectors: list[list[int]], texts: list[str], max_distance: float,
+                            min_similarity: float) -> list[list[int]]:
+    """
+    Groups entries whose texts have Jaccard similarity of shingles at least 'min_similarity'
+    and whose category vectors are not further than 'max_distance'. Similarity is transitive within a cluster.
+
+    Returns:
+    - List of clusters with more than one entry, each a sorted list of entry positions.
+    """
+    hasher = MinHasher()
+    shingle_sets = [shingles(text) for text in texts]
+    signatures = np.array([hasher.signature(shingle_set) for shingle_set in shingle_sets]).reshape(len(texts), hasher.num_perm)
+    vectors = np.asarray(vectors, dtype=np.int64)
+
+    parents = list(range(len(texts)))
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, j in hasher.candidate_pairs(signatures):
+        if np.sqrt(((vectors[i] - vectors[j]) ** 2).sum()) > max_distance:
+            continue
+        if jaccard(shingle_sets[i], shingle_sets[j]) >= min_similarity:
+            parents[find(i)] = find(j)
+
+    clusters = {}
+    for i in range(len(texts)):
+        clusters.setdefault(find(i), []).append(i)
+    return [cluster for cluster in clusters.values() if len(cluster) > 1]
+
+def diversify(recommendations: list[tuple[float, list[str]]], n_max: int, max_similarity: float) -> list[tuple[float, list[str]]]:
+    """
+    Greedily takes recommendations in order of distance, dropping texts similar to already taken ones.
+
+    Args:
+    - recommendations (list): (distance, texts) tuples sorted by distance, usually more than 'n_max'.
+    - n_max (int): Maximum number of returned recommendations.
+    - max_similarity (float): Texts with higher Jaccard similarity of shingles to a taken text are dropped.
+    """
+    taken_shingles = []
+    result = []
+    for distance, texts in recommendations:
+        kept = []
+        for text in texts:
+            text_shingles = shingles(text)
+            if all(jaccard(text_shingles, taken) <= max_similarity for taken in taken_shingles):
+                kept.append(text)
+                taken_shingles.append(text_shingles)
+        if kept:
+            result.append((distance, kept))
+        if len(result) == n_max:
+            break
+    return result
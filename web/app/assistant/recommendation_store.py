@@ -0,0 +1,133 @@
+"""
+Binary file format of the recommendation store.
+
+All numbers are little-endian, every array starts at offset aligned to 8 bytes.
+- Header: magic b'RECSTORE', format version, number of vectors, vectors dimension, number of tree nodes (uint32).
+- Tree: vectors (N, dimension) int8 matrix in tree order and line numbers of vectors in tree order (int32),
+then node arrays: split axes (int8), split values (int16), left and right children, starts and ends of leaves (int32).
+- Texts: offsets table (N + 1) uint64 into the UTF-8 blob of texts by line number. Texts with equal
+vector are delimited by '|', same as in recommendations file.
+"""
+import fcntl, mmap, os, struct, tempfile
+from contextlib import contextmanager
+
+import numpy as np
+
+STORE_MAGIC = b'RECSTORE'
+STORE_VERSION = 1
+HEADER = struct.Struct('<8sIIII')
+
+# Names and types of arrays in order they are written.
+TREE_ARRAYS = [
+    ('vectors', np.int8),
+    ('indices', np.int32),
+    ('split_axes', np.int8),
+    ('split_values', np.int16),
+    ('left', np.int32),
+    ('right', np.int32),
+    ('starts', np.int32),
+    ('ends', np.int32),
+]
+
+def _padding(offset: int) -> int:
+    return -offset % 8
+
+@contextmanager
+def atomic_open(path: str, mode: str = 'wb', **kwargs):
+    """
+    Opens a temporary file next to 'path' for writing and renames it to 'path' only if writing succeeded,
+    so readers never see a partially written file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, **kwargs) as file:
+            yield file
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+@contextmanager
+def file_lock(path: str, blocking: bool = True):
+    """
+    Holds an exclusive lock of the file shared by all processes, the file is created if missing.
+    Yields False without waiting if 'blocking' is False and another process holds the lock.
+    """
+    with open(path, 'a') as file:
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        # Lock is released when the file is closed.
+        yield True
+
+def write_store(path: str, arrays: dict[str, np.ndarray], texts: list[str]):
+    """
+    Atomically writes the tree arrays and texts to the store file.
+
+    Args:
+    - arrays (dict): Tree arrays by names from TREE_ARRAYS.
+    - texts (list): Texts by line number, texts with equal vector joined with '|'.
+    """
+    vectors = arrays['vectors']
+    if vectors.ndim != 2:
+        raise Exception(f"Vectors of the recommendation store must be a (N, dimension) matrix, got shape {vectors.shape}.")
+    encoded_texts = [text.encode('utf-8') for text in texts]
+    offsets = np.zeros(len(encoded_texts) + 1, dtype=np.uint64)
+    offsets[1:] = np.cumsum([len(text) for text in encoded_texts])
+
+    with atomic_open(path, 'wb') as file:
+        file.write(HEADER.pack(STORE_MAGIC, STORE_VERSION, vectors.shape[0], vectors.shape[1], len(arrays['split_axes'])))
+        offset = HEADER.size
+        for name, dtype in TREE_ARRAYS + [('offsets', np.uint64)]:
+            data = offsets if name == 'offsets' else np.ascontiguousarray(arrays[name], dtype=dtype)
+            file.write(b'\0' * _padding(offset))
+            offset += _padding(offset)
+            file.write(data.tobytes())
+            offset += data.nbytes
+        for text in encoded_texts:
+            file.write(text)
+
+class RecommendationStore:
+    """
+    Read-only view of the store file mapped to memory. Pages of the file are shared by all worker
+    processes that open it, arrays are views on the mapping without copying.
+    """
+    def __init__(self, path: str):
+        with open(path, 'rb') as file:
+            self.mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, n_vectors, dimension, n_nodes = HEADER.unpack_from(self.mapping, 0)
+        if magic != STORE_MAGIC:
+            raise Exception(f"File is not a recommendation store: {path}")
+        if version != STORE_VERSION:
+            raise Exception(f"Unsupported recommendation store version {version} in {path}, rebuild the store.")
+
+        counts = {
+            'vectors': n_vectors * dimension,
+            'indices': n_vectors,
+            'offsets': n_vectors + 1,
+        }
+        self.arrays = {}
+        offset = HEADER.size
+        for name, dtype in TREE_ARRAYS + [('offsets', np.uint64)]:
+            offset += _padding(offset)
+            count = counts.get(name, n_nodes)
+            self.arrays[name] = np.frombuffer(self.mapping, dtype=dtype, count=count, offset=offset)
+            offset += self.arrays[name].nbytes
+
+        self.arrays['vectors'] = self.arrays['vectors'].reshape(n_vectors, dimension)
+        self.offsets = self.arrays.pop('offsets')
+        self.texts_offset = offset
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def get_text(self, index: int) -> str:
+        start = self.texts_offset + int(self.offsets[index])
+        end = self.texts_offset + int(self.offsets[index + 1])
+        return self.mapping[start:end].decode('utf-8')
@@ -1,7 +1,14 @@
 from textwrap import dedent
-from .helpers import openai_chat_request
-from .settings import RECOMMENDATION_CATEGORIES, N_MAX_RECOMMENDATIONS
-import math, heapq, json
+from .helpers import openai_chat_request, TTLCache, text_cache_key
+from .settings import RECOMMENDATION_CATEGORIES, N_MAX_RECOMMENDATIONS, RECOMMENDER_LEAF_SIZE, RECOMMENDER_TREE_PATH, RECOMMENDER_RECOMMENDATIONS_PATH
+from .settings import RECOMMENDER_DELTA_PATH, RECOMMENDER_DELTA_MERGE_SIZE, RECOMMENDER_BATCH_MAX_DISTANCES, CATEGORIES_VECTOR_CACHE_SIZE, CATEGORIES_VECTOR_CACHE_TTL
+from .settings import RECOMMENDER_DUPLICATE_MIN_SIMILARITY, RECOMMENDER_DUPLICATE_MAX_DISTANCE, RECOMMENDER_DIVERSIFY
+from .settings import RECOMMENDER_DIVERSITY_MAX_SIMILARITY, RECOMMENDER_DIVERSITY_CANDIDATES_FACTOR
+from .recommendation_store import RecommendationStore, write_store, atomic_open, file_lock
+from .recommendation_dedupe import near_duplicate_clusters, diversify
+import asyncio, math, heapq, json, os, threading
+from contextlib import contextmanager
+import numpy as np
 
 from .settings import RECOMMENDER_DEBUG
 class Data:
@@ -212,7 +219,401 @@ def euclidean_distance(point1, point2):
     for i in range(len(point1)):
         dist += (point1[i] - point2[i]) ** 2
     return math.sqrt(dist)
-        
+
+class ArrayRecommendationTree:
+    """
+    Flat, array-backed variant of RecommerdationTree.
+
+    Nodes are stored in NumPy arrays of split axes, split values, child indices and ranges of vectors,
+    and vectors are stored in an (N, dimension) int8 matrix ordered so every leaf is a contiguous block.
+    Leaves hold up to 'leaf_size' vectors and are scanned with vectorized brute force.
+    Search is iterative and keeps all its state in local variables, so one tree can be queried concurrently.
+    """
+    def __init__(self, vectors: np.ndarray, indices: np.ndarray, split_axes: np.ndarray, split_values: np.ndarray,
+                 left: np.ndarray, right: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+        self.vectors = vectors
+        self.indices = indices
+        self.split_axes = split_axes
+        self.split_values = split_values
+        self.left = left
+        self.right = right
+        self.starts = starts
+        self.ends = ends
+        self.dimension = vectors.shape[1]
+
+    @staticmethod
+    def build(vectors, indices = None, leaf_size: int = RECOMMENDER_LEAF_SIZE) -> 'ArrayRecommendationTree':
+        """
+        Builds the tree from vectors.
+
+        Parameters:
+        - vectors: (N, dimension) matrix or list of category vectors.
+        - indices: Line numbers of vectors in recommendations file, by default position of the vector.
+        - leaf_size (int): Maximum number of vectors in a leaf.
+        """
+        vectors = np.asarray(vectors, dtype=np.int8)
+        if vectors.size == 0:
+            # Empty corpus of a fresh install or compacted away keeps the dimension of category vectors.
+            vectors = vectors.reshape(0, len(RECOMMENDATION_CATEGORIES))
+        if indices is None:
+            indices = np.arange(len(vectors), dtype=np.int32)
+        indices = np.asarray(indices, dtype=np.int32)
+
+        order = np.arange(len(vectors))
+        split_axes, split_values, left, right, starts, ends = [], [], [], [], [], []
+
+        def add_node(start, end):
+            split_axes.append(-1)
+            split_values.append(0)
+            left.append(-1)
+            right.append(-1)
+            starts.append(start)
+            ends.append(end)
+            return len(starts) - 1
+
+        stack = [add_node(0, len(vectors))]
+        while stack:
+            node = stack.pop()
+            start, end = starts[node], ends[node]
+            if end - start <= leaf_size:
+                continue
+
+            # Split on the axis with the largest spread at the median.
+            block = vectors[order[start:end]]
+            axis = int(np.argmax(block.max(axis=0).astype(np.int16) - block.min(axis=0)))
+            if block[:, axis].min() == block[:, axis].max():
+                # All vectors are equal, keep them in one leaf.
+                continue
+
+            median = (end - start) // 2
+            partition = np.argpartition(block[:, axis], median)
+            order[start:end] = order[start:end][partition]
+
+            split_axes[node] = axis
+            split_values[node] = int(vectors[order[start + median], axis])
+            left[node] = add_node(start, start + median)
+            right[node] = add_node(start + median, end)
+            stack.extend((left[node], right[node]))
+
+        return ArrayRecommendationTree(
+            vectors = np.ascontiguousarray(vectors[order]),
+            indices = indices[order],
+            split_axes = np.array(split_axes, dtype=np.int8),
+            split_values = np.array(split_values, dtype=np.int16),
+            left = np.array(left, dtype=np.int32),
+            right = np.array(right, dtype=np.int32),
+            starts = np.array(starts, dtype=np.int32),
+            ends = np.array(ends, dtype=np.int32)
+        )
+
+    @staticmethod
+    def from_tree(tree: RecommerdationTree, leaf_size: int = RECOMMENDER_LEAF_SIZE) -> 'ArrayRecommendationTree':
+        """
+        Builds the array-backed tree from data of a RecommerdationTree.
+        """
+        vectors, indices = [], []
+        stack = [tree.root] if tree.root else []
+        while stack:
+            node = stack.pop()
+            vectors.append(node.data.vector)
+            indices.append(node.data.index)
+            stack.extend(child for child in (node.left, node.right) if child is not None)
+
+        return ArrayRecommendationTree.build(np.array(vectors).reshape(-1, tree.dimension), indices, leaf_size)
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """
+        Returns arrays of the tree by names of the constructor arguments, used to save the tree to the store.
+        """
+        return {
+            'vectors': self.vectors,
+            'indices': self.indices,
+            'split_axes': self.split_axes,
+            'split_values': self.split_values,
+            'left': self.left,
+            'right': self.right,
+            'starts': self.starts,
+            'ends': self.ends
+        }
+
+    def nearest_neighbors(self, target: list[int], n_max: int = 1) -> list[tuple[float, int, list[int]]]:
+        """
+        Finds the nearest neighbors to a target vector.
+
+        Parameters:
+        - target (list[int]): The target vector for which we are finding the nearest neighbors.
+        - n_max (int): The maximum number of nearest neighbors to retrieve.
+
+        Returns:
+        - list[tuple]: (distance, index, vector) tuples of up to `n_max` nearest neighbors sorted by distance,
+        same as RecommerdationTree.nearest_neighbors.
+        """
+        if len(self.vectors) == 0 or n_max < 1:
+            return []
+
+        target = np.asarray(target, dtype=np.int32)
+        # Max-heap of squared distances and positions of the nearest vectors found so far.
+        nearest_heap = []
+        # Nodes to visit with lower bound of squared distance from the target to their vectors.
+        stack = [(0, 0)]
+        while stack:
+            node, bound = stack.pop()
+            if len(nearest_heap) == n_max and bound > -nearest_heap[0][0]:
+                continue
+
+            axis = self.split_axes[node]
+            if axis < 0:
+                start, end = self.starts[node], self.ends[node]
+                distances = ((self.vectors[start:end].astype(np.int32) - target) ** 2).sum(axis=1)
+                for position in np.argsort(distances, kind='stable')[:n_max]:
+                    distance = int(distances[position])
+                    if len(nearest_heap) < n_max:
+                        heapq.heappush(nearest_heap, (-distance, -(start + position)))
+                    elif distance < -nearest_heap[0][0]:
+                        heapq.heapreplace(nearest_heap, (-distance, -(start + position)))
+                    else:
+                        break
+                continue
+
+            diff = int(target[axis]) - int(self.split_values[node])
+            close_side, far_side = (self.left[node], self.right[node]) if diff < 0 else (self.right[node], self.left[node])
+            # Visit the closer side first, the far side only if it can still contain closer vectors.
+            stack.append((far_side, max(bound, diff * diff)))
+            stack.append((close_side, bound))
+
+        nearest = sorted((-distance, -position) for distance, position in nearest_heap)
+        return [(math.sqrt(distance), int(self.indices[position]), self.vectors[position].tolist())
+                for distance, position in nearest]
+
+    def batch_nearest_neighbors(self, targets, k: int = 1, distance_threshold: float = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the nearest neighbors to many target vectors at once with vectorized brute force.
+        Targets are processed in chunks, so the distance matrix stays below RECOMMENDER_BATCH_MAX_DISTANCES elements.
+
+        Parameters:
+        - targets: (M, dimension) matrix or list of target vectors.
+        - k (int): The maximum number of nearest neighbors to retrieve for each target.
+        - distance_threshold (float): If set, neighbors further than it are not returned.
+
+        Returns:
+        - Tuple of (indices, distances):
+        - indices (np.ndarray): (M, k) line numbers of neighbors sorted by distance, padded with -1.
+        - distances (np.ndarray): (M, k) distances to the neighbors, padded with inf.
+        """
+        targets = np.asarray(targets, dtype=np.int64).reshape(-1, self.dimension)
+        n_targets, n_vectors = len(targets), len(self.vectors)
+        indices = np.full((n_targets, k), -1, dtype=np.int64)
+        distances = np.full((n_targets, k), np.inf)
+        if n_vectors == 0 or k < 1:
+            return indices, distances
+
+        n_found = min(k, n_vectors)
+        vectors = self.vectors.astype(np.int64)
+        vectors_norms = (vectors ** 2).sum(axis=1)
+        chunk_size = max(1, RECOMMENDER_BATCH_MAX_DISTANCES // n_vectors)
+        for start in range(0, n_targets, chunk_size):
+            chunk = targets[start:start + chunk_size]
+            # Squared distances are exact in integers.
+            chunk_distances = (chunk ** 2).sum(axis=1)[:, None] + vectors_norms[None, :] - 2 * chunk @ vectors.T
+
+            if n_found < n_vectors:
+                positions = np.argpartition(chunk_distances, n_found - 1, axis=1)[:, :n_found]
+            else:
+                positions = np.broadcast_to(np.arange(n_vectors), (len(chunk), n_vectors))
+            nearest_distances = np.take_along_axis(chunk_distances, positions, axis=1)
+            order = np.argsort(nearest_distances, axis=1, kind='stable')
+            positions = np.take_along_axis(positions, order, axis=1)
+
+            indices[start:start + len(chunk), :n_found] = self.indices[positions]
+            distances[start:start + len(chunk), :n_found] = np.sqrt(np.take_along_axis(nearest_distances, order, axis=1))
+
+        if distance_threshold is not None:
+            too_far = distances > distance_threshold
+            indices[too_far] = -1
+            distances[too_far] = np.inf
+
+        return indices, distances
+
+class RecommendationIndex:
+    """
+    Immutable index of recommendations: the array-backed tree and texts by line number, read from
+    the binary recommendation store mapped to memory. It is never modified after loading, reload creates
+    a new index, so it is safe to share between connections.
+    Use 'get_recommendation_index' to get the index shared by the worker process.
+    """
+    def __init__(self, tree: ArrayRecommendationTree, store: RecommendationStore, version: int):
+        self.tree = tree
+        self.store = store
+        # Modification time of the store file the index was loaded from.
+        self.version = version
+
+    @staticmethod
+    def load(store_path: str, version: int = None) -> 'RecommendationIndex':
+        """
+        Maps the store file to memory, arrays of the tree are used without copying.
+        """
+        store = RecommendationStore(store_path)
+        return RecommendationIndex(ArrayRecommendationTree(**store.arrays), store, version)
+
+    def get_texts(self, index: int) -> list[str]:
+        """
+        Returns recommendation texts saved with the vector at 'index' line.
+        """
+        return self.store.get_text(index).split('|')
+
+    def nearest(self, target: list[int], n_max: int, deltas: list['RecommendationDelta'] = ()) -> list[tuple[float, list[str]]]:
+        """
+        Finds up to 'n_max' nearest recommendations to the target vector in the tree and in delta buffers.
+        Texts of equal vectors found in the tree and in deltas are combined.
+
+        Returns:
+        - List of (distance, texts) tuples sorted by distance.
+        """
+        candidates = {}
+        for distance, index, vector in self.tree.nearest_neighbors(target, n_max):
+            candidates[tuple(vector)] = [distance, self.get_texts(index)]
+
+        for delta in deltas:
+            for distance, vector, texts in delta.nearest(target, n_max):
+                if vector in candidates:
+                    candidates[vector][1] = list(dict.fromkeys(candidates[vector][1] + texts))
+                else:
+                    candidates[vector] = [distance, texts]
+
+        nearest_data = sorted(candidates.values(), key=lambda candidate: candidate[0])[:n_max]
+        return [(distance, texts) for distance, texts in nearest_data]
+
+    def batch_nearest(self, targets, n_max: int, distance_threshold: float = None) -> list[list[tuple[float, list[str]]]]:
+        """
+        Finds up to 'n_max' nearest recommendations for every target vector in one vectorized pass over the tree.
+
+        Returns:
+        - List with a list of (distance, texts) tuples sorted by distance for every target.
+        """
+        indices, distances = self.tree.batch_nearest_neighbors(targets, n_max, distance_threshold)
+        return [[(float(distance), self.get_texts(int(index))) for index, distance in zip(row_indices, row_distances) if index >= 0]
+                for row_indices, row_distances in zip(indices, distances)]
+
+class RecommendationDelta:
+    """
+    Recommendations appended to the delta file after the store was built, searched with brute force.
+    Only bytes appended since the previous refresh are read, so keeping the buffer up to date costs
+    O(new entries) I/O. Texts of equal vectors are grouped like in the recommendations file.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, inode: int|None):
+        self.inode = inode
+        self.offset = 0
+        self.texts: dict[tuple[int, ...], list[str]] = {}
+        self.vectors = None
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def refresh(self):
+        """
+        Reads lines appended to the delta file since the previous refresh. The buffer is cleared
+        when the file is removed or replaced by a merge.
+        """
+        with self.lock:
+            try:
+                file_stat = os.stat(self.path)
+            except FileNotFoundError:
+                if self.inode is not None:
+                    self._reset(None)
+                return
+
+            if file_stat.st_ino != self.inode or file_stat.st_size < self.offset:
+                self._reset(file_stat.st_ino)
+            if file_stat.st_size == self.offset:
+                return
+
+            with open(self.path, 'rb') as file:
+                file.seek(self.offset)
+                data = file.read(file_stat.st_size - self.offset)
+
+            # Last line could be written only partially by another process, it is read on the next refresh.
+            data = data[:data.rfind(b'\n') + 1]
+            self.offset += len(data)
+            for line in data.decode('utf-8').splitlines():
+                vector, text = line.split(':', maxsplit=1)
+                vector = tuple(map(int, vector.split(',')))
+                self.texts.setdefault(vector, []).extend(text.split('|'))
+            # Matrix of vectors is rebuilt on the next search.
+            self.vectors = None
+
+    def nearest(self, target: list[int], n_max: int) -> list[tuple[float, tuple[int, ...], list[str]]]:
+        """
+        Returns up to 'n_max' (distance, vector, texts) tuples nearest to the target vector.
+        """
+        with self.lock:
+            if not self.texts:
+                return []
+            if self.vectors is None:
+                self.keys = list(self.texts)
+                self.vectors = np.array(self.keys, dtype=np.int32)
+            keys, vectors, texts = self.keys, self.vectors, self.texts
+
+        distances = np.sqrt(((vectors - np.asarray(target, dtype=np.int32)) ** 2).sum(axis=1))
+        order = np.argsort(distances, kind='stable')[:n_max]
+        return [(float(distances[i]), keys[i], list(texts[keys[i]])) for i in order]
+
+# Category vectors by text and model, shared by all connections of the worker process.
+categories_vector_cache = TTLCache(CATEGORIES_VECTOR_CACHE_SIZE, CATEGORIES_VECTOR_CACHE_TTL)
+
+# Delta buffers loaded in this worker process by their paths.
+_recommendation_deltas: dict[str, RecommendationDelta] = {}
+
+def get_recommendation_delta(delta_path: str) -> RecommendationDelta:
+    """
+    Returns the delta buffer shared by the worker process, refreshed with newly appended recommendations.
+    """
+    with _recommendation_indexes_lock:
+        delta = _recommendation_deltas.setdefault(delta_path, RecommendationDelta(delta_path))
+    delta.refresh()
+    return delta
+
+# Indexes loaded in this worker process by their store paths.
+_recommendation_indexes: dict[str, RecommendationIndex] = {}
+_recommendation_indexes_lock = threading.Lock()
+# Only one rebuild of the store runs in the worker process, workers are serialized by the lock file.
+_recommendation_rebuild_lock = threading.Lock()
+
+def get_recommendation_index(store_path: str) -> RecommendationIndex:
+    """
+    Returns the recommendation index shared by the worker process. The index is loaded once and
+    reloaded only when modification time of the store file changes.
+    """
+    version = os.stat(store_path).st_mtime_ns
+
+    index = _recommendation_indexes.get(store_path)
+    if index is not None and index.version == version:
+        return index
+
+    with _recommendation_indexes_lock:
+        # Other thread could reload the index while waiting for the lock.
+        index = _recommendation_indexes.get(store_path)
+        if index is None or index.version != version:
+            index = RecommendationIndex.load(store_path, version)
+            # Replacing the whole index keeps reload atomic for readers.
+            _recommendation_indexes[store_path] = index
+
+    return index
+
+def reload_recommendation_index(store_path: str) -> RecommendationIndex:
+    """
+    Forces reload of the shared recommendation index, used after the store is rebuilt.
+    """
+    with _recommendation_indexes_lock:
+        index = RecommendationIndex.load(store_path, os.stat(store_path).st_mtime_ns)
+        _recommendation_indexes[store_path] = index
+
+    return index
+
 class Recommender:
     """
     The Recommender class provides functionalities to manage, process, and retrieve recommendations 
@@ -220,69 +621,199 @@ class Recommender:
     """
     def __init__(self,
                  gpt_model: str,
-                 recommendations_tree_path: str='web/app/assistant/Recommendations/recomendation_tree.json',
-                 recommendations_path: str="web/app/assistant/Recommendations/recommendations.txt"):
+                 recommendations_tree_path: str=RECOMMENDER_TREE_PATH,
+                 recommendations_path: str=RECOMMENDER_RECOMMENDATIONS_PATH,
+                 recommendations_delta_path: str=RECOMMENDER_DELTA_PATH):
         """
         Initializes the Recommender instance with specified GPT model and paths for recommendations and tree.
 
         Parameters:
         - gpt_model (str): GPT model used in generating recommendations and vectors.
-        - recommendations_tree_path (str): Path to save/load the KD-tree for recommendation vectors.
-        - recommendations_path (str): Path to the recommendations."""
+        - recommendations_tree_path (str): Path to the binary recommendation store with the KD-tree and texts.
+        - recommendations_path (str): Path to the recommendations.
+        - recommendations_delta_path (str): Path to the append-only file with recommendations not merged into the store yet."""
         self.gpt_model = gpt_model
         self.recommendations_path = recommendations_path
         self.recommendations_tree_path = recommendations_tree_path
+        self.recommendations_delta_path = recommendations_delta_path
+        # Delta is moved here while it is merged, so new recommendations are appended to a fresh delta file.
+        self.merging_delta_path = recommendations_delta_path + '.merging'
+        # Held by the worker merging the delta or rewriting recommendations.
+        self.rebuild_lock_path = recommendations_delta_path + '.lock'
         
+    @staticmethod
+    def read_recommendations(*paths: str) -> dict[str, str]:
+        """
+        Reads recommendations files in order, missing files are skipped.
+
+        Returns:
+        - Dictionary of '|'-joined texts by vector string in order of lines.
+        """
+        recommendations = {}
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding="utf-8") as file:
+                for line in file:
+                    vector, text = line.rstrip('\n').split(':', maxsplit=1)
+                    recommendations[vector] = recommendations[vector] + '|' + text if vector in recommendations else text
+        return recommendations
+
+    @contextmanager
+    def rebuild_lock(self, blocking: bool = True):
+        """
+        Holds the rebuild lock of this worker and the lock file shared by all workers, so only one
+        merge or rewrite of recommendations runs at a time. Yields False without waiting if 'blocking'
+        is False and a rebuild is already running.
+        """
+        if not _recommendation_rebuild_lock.acquire(blocking=blocking):
+            yield False
+            return
+        try:
+            with file_lock(self.rebuild_lock_path, blocking) as acquired:
+                yield acquired
+        finally:
+            _recommendation_rebuild_lock.release()
+
     def build_and_save_rec_tree(self):
         """
-        Builds a KD-tree from recommendations vectors and saves it for faster retrieval of similar recommendations.
+        Merges the delta file into recommendations, builds a KD-tree from recommendations vectors and saves
+        it with recommendations texts to the binary store for faster retrieval of similar recommendations.
+        Store and recommendations file are replaced atomically.
         """
-        recommendation_data = []
-        with open(self.recommendations_path, 'r', encoding="utf-8") as file:
-            for line_num, line in enumerate(file):
-                vector = line.split(':', maxsplit=1)[0]
-                vector = list(map(int, vector.split(',')))
-                recommendation_data.append(Data(vector, line_num))
-        
-        dimension = len(recommendation_data[0].vector)
-        
-        tree = RecommerdationTree(dimension)
-        tree.build_tree(recommendation_data)
-        tree.save_tree(self.recommendations_tree_path)
-        
-        return
-        
-    def get_recomendations(self, target: list[int], n_max: int):
+        with self.rebuild_lock():
+            self.merge_delta()
+
+    def merge_delta(self):
         """
-        Get
+        Merges the delta and rebuilds the store, the caller holds 'rebuild_lock'.
         """
-        # Load the recommendation tree and find nearest neighbors
-        tree = RecommerdationTree.load_tree(self.recommendations_tree_path)
-        nearest_data = tree.nearest_neighbors(target, n_max)
-        # Sort nearest_data by line number in ascending order for efficient reading
-        nearest_data.sort(key = lambda x: x[1])
-        
-        recommendations = []
-        curent_index = 0
-        # Read file and append recommendations
-        with open(self.recommendations_path, 'r', encoding="utf-8") as file:
-            for line_num, line in enumerate(file):
-                if line_num == nearest_data[curent_index][1]:
-
-                    text = line.split(':', maxsplit=1)[1]
-                    recommendations.append((nearest_data[curent_index][0],text.split('|')))
-                    
-                    if curent_index >= len(nearest_data)-1:
-                        break
-                    curent_index += 1
+        # Delta left by an interrupted merge is merged again before the current one.
+        if not os.path.exists(self.merging_delta_path) and os.path.exists(self.recommendations_delta_path):
+            os.replace(self.recommendations_delta_path, self.merging_delta_path)
+
+        recommendations = self.read_recommendations(self.recommendations_path, self.merging_delta_path)
+
+        if os.path.exists(self.merging_delta_path):
+            with atomic_open(self.recommendations_path, 'w', encoding='utf-8') as file:
+                file.writelines(f"{vector}:{text}\n" for vector, text in recommendations.items())
+
+        vectors = [list(map(int, vector.split(','))) for vector in recommendations]
+        tree = ArrayRecommendationTree.build(vectors)
+        write_store(self.recommendations_tree_path, tree.to_arrays(), list(recommendations.values()))
+        # Other worker processes notice new store by its modification time.
+        reload_recommendation_index(self.recommendations_tree_path)
+
+        # Merged entries are searched in the store from now on.
+        if os.path.exists(self.merging_delta_path):
+            os.unlink(self.merging_delta_path)
+
+    def rebuild_in_background(self):
+        """
+        Starts merging the delta file into the store in a background thread, unless the merge
+        is already running in this worker or another one.
+        """
+        def rebuild():
+            try:
+                with self.rebuild_lock(blocking=False) as acquired:
+                    if acquired:
+                        self.merge_delta()
+            except Exception as e:
+                print(f"Error occurred while merging recommendations delta: {e}")
+
+        # Cheap check, so no thread is started for every recommendation added while the merge runs.
+        if _recommendation_rebuild_lock.locked():
+            return
+        threading.Thread(target=rebuild, daemon=True).start()
         
-        # Return the sorted recommendations by distance
-        recommendations.sort(key = lambda x:x[0])
-        return recommendations
+    def get_recomendations(self, target: list[int], n_max: int, diversify_results: bool = False):
+        """
+        Get up to 'n_max' recommendations nearest to the target vector from the shared recommendation index
+        and recommendations added after it was built. Blocking, async code runs it in a thread.
+        With 'diversify_results' more candidates are searched and texts similar to nearer ones are dropped.
+
+        Returns:
+        - List of (distance, texts) tuples sorted by distance.
+        """
+        index = get_recommendation_index(self.recommendations_tree_path)
+        # While the merge runs, its entries are searched in the merging file.
+        deltas = [get_recommendation_delta(self.merging_delta_path), get_recommendation_delta(self.recommendations_delta_path)]
+        if not diversify_results:
+            return index.nearest(target, n_max, deltas)
+
+        candidates = index.nearest(target, n_max * RECOMMENDER_DIVERSITY_CANDIDATES_FACTOR, deltas)
+        return diversify(candidates, n_max, RECOMMENDER_DIVERSITY_MAX_SIMILARITY)
+
+    def compact_recommendations(self, max_distance: float = RECOMMENDER_DUPLICATE_MAX_DISTANCE,
+                                min_similarity: float = RECOMMENDER_DUPLICATE_MIN_SIMILARITY, dry_run: bool = False) -> list[list[str]]:
+        """
+        Merges the delta, collapses near-duplicate recommendations to the earliest one and rebuilds the store.
+        Recommendations are near-duplicates if their texts are similar and their vectors are close.
+
+        Parameters:
+        - max_distance (float): Maximum distance between vectors of near-duplicates.
+        - min_similarity (float): Minimum Jaccard similarity of text shingles of near-duplicates.
+        - dry_run (bool): Only find near-duplicates in the corpus and the delta, don't merge or change them.
+
+        Returns:
+        - List of clusters of near-duplicate texts, the first text of a cluster is kept.
+        """
+        if dry_run:
+            # Delta is only read, merging it would change the corpus.
+            recommendations = self.read_recommendations(self.recommendations_path, self.merging_delta_path, self.recommendations_delta_path)
+            entries, clusters = self.near_duplicates(recommendations, max_distance, min_similarity)
+            return [[entries[i][1] for i in cluster] for cluster in clusters]
+
+        # Lock is held until the store is rebuilt, so no merge runs between reading and rewriting recommendations.
+        with self.rebuild_lock():
+            self.merge_delta()
+            entries, clusters = self.near_duplicates(self.read_recommendations(self.recommendations_path), max_distance, min_similarity)
+            if not clusters:
+                return []
+
+            removed = {i for cluster in clusters for i in cluster[1:]}
+            recommendations = {}
+            for i, (vector, text) in enumerate(entries):
+                if i not in removed:
+                    recommendations[vector] = recommendations[vector] + '|' + text if vector in recommendations else text
+
+            with atomic_open(self.recommendations_path, 'w', encoding='utf-8') as file:
+                file.writelines(f"{vector}:{text}\n" for vector, text in recommendations.items())
+            self.merge_delta()
+
+        return [[entries[i][1] for i in cluster] for cluster in clusters]
+
+    @staticmethod
+    def near_duplicates(recommendations: dict[str, str], max_distance: float, min_similarity: float) -> tuple[list[tuple[str, str]], list[list[int]]]:
+        """
+        Returns entries of (vector string, text), one for every text of recommendations, and clusters
+        of indices of near-duplicate entries.
+        """
+        entries = [(vector, text) for vector, texts in recommendations.items() for text in texts.split('|')]
+        vectors = [list(map(int, vector.split(','))) for vector, text in entries]
+        clusters = near_duplicate_clusters(vectors, [text for vector, text in entries], max_distance, min_similarity)
+        return entries, clusters
+
+    def get_batch_recomendations(self, targets, n_max: int, distance_threshold: float = None):
+        """
+        Get up to 'n_max' recommendations for every target vector from the shared recommendation index,
+        used by offline evaluation and analysis. Recommendations not merged into the store yet are not searched.
+
+        Parameters:
+        - targets: (M, 12) matrix or list of category vectors.
+        - n_max (int): Maximum number of recommendations for a target.
+        - distance_threshold (float): Maximum distance of returned recommendations, same as in 'handle_recommendations'.
+
+        Returns:
+        - List with a list of (distance, texts) tuples sorted by distance for every target.
+        """
+        index = get_recommendation_index(self.recommendations_tree_path)
+        return index.batch_nearest(targets, n_max, distance_threshold)
         
     async def generate_categories_v(self, categories: list[str], text: str, max_val: int = 10):
         """
         Generates a vector of relevance scores for each category based on input text.
+        Vectors are cached by normalized text and model, cached vector is returned without a request.
         
         Parameters:
         - categories (list[str]): List of categories to analyze against the text.
@@ -292,8 +823,14 @@ class Recommender:
         Returns:
         - Tuple of (response, token_usage):
         - response (list[int] or None): A list of integer scores if successful; None if an error occurs.
-        - token_usage (int or None): Number of tokens used in the request.
+        - token_usage (int or None): Number of tokens used in the request, None for cached vector.
         """
+        cache_key = text_cache_key(text, self.gpt_model, max_val, categories)
+        cached_vector = categories_vector_cache.get(cache_key)
+        if cached_vector is not None:
+            if RECOMMENDER_DEBUG: print(f"Categories vector cache hit, {categories_vector_cache.stats()}")
+            return list(cached_vector), None
+
         system = dedent("""\
             You are a text analyzer that assigns a relevance score to each category based 
             on the content of a given text. Your task is to generate a vector of scores that 
@@ -312,12 +849,11 @@ class Recommender:
             Example output:
             1,4,5,7
             
-            Remember: Always output the vector in the order provided in categories, with each element as an integer within the range [0, max_value].""")
-        prompt = dedent(f"""\
-            categories: {categories}
-            max_value: {max_val}
-            text: {text}""")
-        print("GEENERATE CAT V PROMPT:", prompt, system, self.gpt_model)
+            Remember: Always output the vector in the order provided in categories, with each element as an integer within the range [0, max_value].
+            """) + f"categories: {categories}\nmax_value: {max_val}"
+        # Only the text changes between requests, so the rest is a prefix reused by prompt caching.
+        prompt = f"text: {text}"
+        if RECOMMENDER_DEBUG: print("GEENERATE CAT V PROMPT:", prompt, system, self.gpt_model)
         response, token_usage = await openai_chat_request(prompt=prompt, system=system, model=self.gpt_model)
         # Validate response
         if response is not None:
@@ -332,6 +868,7 @@ class Recommender:
                     if val > max_val or val < 0:
                         raise Exception('Invalid value in response vector')
                 
+                categories_vector_cache.set(cache_key, tuple(response))
                 return response, token_usage
             
             except Exception as e:
@@ -343,7 +880,10 @@ class Recommender:
 
     async def handle_recommendations(self, chat_history: str, distance_threshhold: int = 10):
         vector, used_tokens = await self.generate_categories_v(categories=RECOMMENDATION_CATEGORIES, text=str(chat_history))
-        recommendations = self.get_recomendations(vector, N_MAX_RECOMMENDATIONS)
+        if vector is None:
+            return [], used_tokens
+        # Lookup stats the store, can reload the index and reads the delta file, so it runs off the event loop.
+        recommendations = await asyncio.to_thread(self.get_recomendations, vector, N_MAX_RECOMMENDATIONS, RECOMMENDER_DIVERSIFY)
         
         result = []
         # Threshold
@@ -396,30 +936,28 @@ class Recommender:
         else:
             print("Failed to generate recommendation")
             return None, None
+    def save_recomendations(self, recommendations: list[tuple[list[int], str]]):
+        """
+        Appends many (vector, recommendation) pairs to the delta file in one write, used by corpus generation.
+        They are searched alongside the store until 'build_and_save_rec_tree' merges them.
+        """
+        lines = [f"{str(vector)[1:-1].replace(' ','')}:{recommendation}\n" for vector, recommendation in recommendations]
+        with open(self.recommendations_delta_path, 'a', encoding='utf-8') as file:
+            file.write(''.join(lines))
+
+        return
+
     def save_recomendation(self, vector: list[int], recommendation:str):
         """
-        Saves a recommendation and its vector to a file. If the vector already exists, appends the recommendation to that line.
+        Appends a recommendation and its vector to the delta file, which is searched alongside the store.
+        When the delta grows past RECOMMENDER_DELTA_MERGE_SIZE vectors, it is merged into the store in background.
         """
         vector_str = str(vector)[1:-1].replace(' ','')
-        lines = []
-        duplicate = False
-        # Read all lines and check for duplicates
-        with open(self.recommendations_path, "r", encoding='utf-8') as file:
-            for line in file:
-                if line.startswith(vector_str + ":"):
-                    # If vector exists, append recommendation to this line
-                    line = line.strip() + '|' + recommendation + '\n'
-                    duplicate = True
-                lines.append(line)
-
-        # Write back all lines if a duplicate was found
-        if duplicate:
-            with open(self.recommendations_path, 'w', encoding='utf-8') as file:
-                file.writelines(lines)
-        else:
-            # Append a new recommendation if no duplicate
-            with open(self.recommendations_path, 'a', encoding='utf-8') as file:
-                file.write(f"{vector_str}:{recommendation}\n")
+        # Single write of a whole line, so concurrent appends from other workers are not interleaved.
+        with open(self.recommendations_delta_path, 'a', encoding='utf-8') as file:
+            file.write(f"{vector_str}:{recommendation}\n")
+
+        if len(get_recommendation_delta(self.recommendations_delta_path)) >= RECOMMENDER_DELTA_MERGE_SIZE:
+            self.rebuild_in_background()
 
         return
-            
\ No newline at end of file
@@ -3,10 +3,12 @@ from .tools import Tools
 from .user_profile import Profile
 from .emotional_journal import EmotionalJournal
 from .recommender import Recommender
-from .settings import AssistantSettings, CHAT_HISTORY_MESSAGES_FOR_RESPONDER, RESPONDER_DEBUG
+from .pipeline import Stage, StageScheduler
+from .prompt_budget import PromptBudget, count_messages_tokens, count_tokens
+from .settings import AssistantSettings, CHAT_HISTORY_MESSAGES_FOR_RESPONDER, CHAT_SUMMARY_IN_RESPONDER_PROMPT, RESPONDER_DEBUG, PIPELINE_STAGE_TIMEOUTS
 
 from textwrap import dedent
-from .helpers import openai_chat_request
+from .helpers import openai_chat_request, ChatStream
 
 import asyncio
 import openai
@@ -19,7 +21,7 @@ class Responder:
     The Responder class manages the response generation process within the AI Wellbeing Assistant.
     """
     def __init__(self, user_profile: str, chat_history: list[str], assistant_settings: AssistantSettings,
-                 emotional_journal: EmotionalJournal, user, message_count: int = None) -> None:
+                 emotional_journal: EmotionalJournal, user, message_count: int = None, chat_summary: str = None) -> None:
         """
         Initialize the Responder class with necessary attributes.
 
@@ -29,6 +31,7 @@ class Responder:
         - assistant_settings (class): Object containing settings for the assistant.
         - message_count (int): Number of messages in the conversation.
         - emotional_journal (class): Object representing the emotional journal.
+        - chat_summary (str): Rolling summary of earlier conversation, None if chat wasn't summarized yet.
         """
         self.settings = assistant_settings
         self.moderation = Moderation()
@@ -38,6 +41,11 @@ class Responder:
         self.recommender = Recommender(gpt_model=self.settings.responder_gpt_model)
         self.chat_history = chat_history
         self.message_count = message_count
+        self.chat_summary = chat_summary if CHAT_SUMMARY_IN_RESPONDER_PROMPT else None
+        # Seconds every pipeline stage took during the last handled message.
+        self.stage_timings = {}
+        # Prompt tokens of the response request counted before it was sent.
+        self.prompt_tokens = None
 
         # Dictionary to track the total tokens used for GPT prompts and responses for every module.
         self.total_tokens_used = {
@@ -48,8 +56,8 @@ class Responder:
             "Responder": {}
         }
 
-    async def handle_user_message(self, user_message: str, use_tools: bool,
-                                  extract_inputs: bool, image: BytesIO = None) -> tuple[str|None, dict|None, str|None, str|None]:
+    async def handle_user_message(self, user_message: str, use_tools: bool, extract_inputs: bool, image: BytesIO = None,
+                                  stream: bool = False, previous_tools: tuple[str, ...] = ()) -> tuple[str|ChatStream|None, dict|None, str|None, str|None]:
         """
         Process and handle the user's message, applying moderation, updating profile and emotional journal,
         searching for recommendations, handling tools and finaly generating a response.
@@ -58,146 +66,115 @@ class Responder:
         - user_message (str): User's latest message.
         - use_tools (bool): Indicates whether to use tools.
         - extract_inputs (bool): Indicates whether to extract inputs for tools.
+        - stream (bool): If True, generated response is returned as ChatStream, that should be consumed with 'stream_response'.
+        - previous_tools (tuple): Tools used or requested in the previous turn, inputs of the likely tool are extracted speculatively.
 
         Returns:
         - Tuple containing: response, metadata, profile update, and journal update.
         """
-        # Apply moderation to the user's message.
-        flagged, flagged_categories = self.moderation.moderate(user_message = user_message)
+        # Build the pipeline. Stages start as soon as stages they depend on are resolved.
+        # Moderation runs in parallel with other stages and gates only tools execution, response and saved updates.
+        scheduler = StageScheduler([
+            Stage('moderation', self.moderation_stage(user_message)),
+            Stage('tool_extraction', self.tool_extraction_stage(user_message, extract_inputs, previous_tools), condition = lambda: use_tools),
+            Stage('input_extraction', self.input_extraction_stage(user_message, extract_inputs),
+                  inputs = ['moderation', 'tool_extraction'], condition_inputs = ['tool_extraction'],
+                  condition = lambda tool_extraction: bool(tool_extraction)),
+            # Updates of flagged messages are discarded, so profile and journal are cancelled as soon as moderation flags.
+            Stage('profile', self.profile_stage(user_message), timeout = PIPELINE_STAGE_TIMEOUTS['profile'], optional = True,
+                  condition = lambda: self.time_for_update(self.settings.messages_till_profile_update),
+                  cancel_inputs = ['moderation'], cancel_condition = lambda moderation: moderation[0]),
+            Stage('journal', self.journal_stage(user_message), timeout = PIPELINE_STAGE_TIMEOUTS['journal'], optional = True,
+                  condition = lambda: self.time_for_update(self.settings.messages_till_journal_update),
+                  cancel_inputs = ['moderation'], cancel_condition = lambda moderation: moderation[0]),
+            # Recommendations are searched speculatively, the stage is cancelled if no response will be generated.
+            Stage('recommendation', self.recommendation_stage(user_message),
+                  timeout = PIPELINE_STAGE_TIMEOUTS['recommendation'], optional = True, speculative = True),
+            # Response uses the updated journal, but doesn't wait for the profile.
+            Stage('response', self.response_stage(user_message, image, stream),
+                  inputs = ['moderation', 'input_extraction', 'journal', 'recommendation'], condition_inputs = ['moderation', 'input_extraction'],
+                  condition = lambda moderation, input_extraction: not moderation[0] and tools_allow_response(input_extraction))
+        ])
+        try:
+            results = await scheduler.run()
+        finally:
+            # Tokens of stages finished before a failed stage are recorded, so they can still be billed.
+            self.stage_timings = scheduler.timings
+            if use_tools:
+                self.total_tokens_used['Tools'] = self.tools.total_tokens_used
+
+        # If message was flagged by moderation, only notify the user and discard profile and journal updates.
+        flagged, flagged_categories = results['moderation']
         if flagged:
             response =  f"Ill content of message. Categories:{flagged_categories}"
             if RESPONDER_DEBUG: print(response)
 
             metadata, profile_update, journal_update = None, None, None
             return response, metadata, profile_update, journal_update
-        # Initialize task list for concurrent processing.
-        task_list = {}
-        # If using tools, create a task for handling tools.
-        if use_tools:
-            tools_task = asyncio.create_task(
-                self.tools.handle_tools(
-                    user_message = user_message, chat_history = self.chat_history, extract_inputs = extract_inputs,
-                    messages_for_input_extraction = self.settings.messages_for_input_extraction
-                    )
-                )
-            task_list['tools_task'] = tools_task
-        # Check if it's time to update the user profile.
-        if (self.message_count // 2) % self.settings.messages_till_profile_update == 0:
-            profile_update_task = asyncio.create_task(
-                self.user_profile.update_user_profile(chat_history = self.chat_history[-self.settings.messages_for_profile_update:], user_message = user_message)
-                )
-            task_list['profile_update_task'] = profile_update_task
-        # Check if it's time to update the emotional journal.
-        if (self.message_count // 2) % self.settings.messages_till_journal_update == 0:
-            journal_update_task = asyncio.create_task(
-                self.emotioal_journal.update_journal(chat_history = self.chat_history[-self.settings.messages_for_journal_update:], user_message=user_message)
-                )
-            task_list['journal_update_task'] = journal_update_task
-        # Gather results from tasks concurrently.
-        results = await asyncio.gather(*task_list.values())
-        # Process tools results if the tools task was created.
-        if task_list.get('tools_task'):
-            tools_results = results.pop(0)
-            tools_result, metadata = tools_results
-
-            if self.tools.total_tokens_used:
-                self.total_tokens_used['Tools'] = self.tools.total_tokens_used
-        else:
-            tools_result, metadata = None, None
-        # Process profile update results if the profile update task was created.
-        if task_list.get('profile_update_task'):
-            profile_update, profiler_used_tokens = results.pop(0)
-
-            if profiler_used_tokens:
-                self.total_tokens_used['Profiler'] = profiler_used_tokens
-        else:
-            profile_update = None
-        # Process journal update results if the journal update task was created.
-        if task_list.get('journal_update_task'):
-            journal_result = results.pop(0)
-            journal, updates_count, journal_used_tokens =  journal_result
-
-            if not journal:
-                journal_update = None
-            else:
-                self.emotioal_journal.journal = journal
-                journal_update = journal, updates_count
-            print("Journal update: \n",journal_update, '\n' , '_'*100)
 
-            if journal_used_tokens:
-                self.total_tokens_used['Journal'] = journal_used_tokens
-        else:
-            journal_update = None
-        # Initiate prompt to add tools result.
-        prompt = ""
+        tools_result, metadata = results['input_extraction'] or (None, None)
+        profile_update = results['profile']
+        journal_update = results['journal']
         # Check if tools returned metadata
         if metadata is not None:
-            # If tool executed successfuly, add result to prompt
-            if metadata.get('type') == 'tool_result':
-                prompt += tools_result_additon(tools_result)
             # If tool missing inputs, return everything and skip generating response.
-            elif metadata.get('type') == 'input_request':
+            if metadata.get('type') == 'input_request':
                 response = None
                 return response, metadata, profile_update, journal_update
             # If tool exeption accrued return tools result that contains descripton of exeption as a response.
             elif metadata.get('type') == 'tool_exeption':
                 response = tools_result
                 return response, metadata, profile_update, journal_update
-            else:
+            elif metadata.get('type') != 'tool_result':
                 print("Unexpected result of the tool. Metadata:", metadata)
                 return None, None, None, None
-        # If there is no need for tool or tool executed successfuly, search recommendations.
-        recommendations, recomm_used_tokens = await self.recommender.handle_recommendations(user_message)
-        if recomm_used_tokens:
-            self.total_tokens_used["Recommender"] = recomm_used_tokens
-        # Create system prompt.
-        system_message = responder_system_message(
-            user_profile = '\n'.join(self.user_profile.user_profile),
-            emotional_journal = self.emotioal_journal.journal,
-            recommendations = '\n'.join('; '.join(inner) for inner in recommendations),
-            tools_names = self.tools.all_tools_names()
-            )
-        system_message += '\n' + personality_addition(self.settings.responder_personality)
-        # Create prompt
-        prompt += responder_prompt(chat_history = '\n'.join(self.chat_history[-CHAT_HISTORY_MESSAGES_FOR_RESPONDER:]),  user_message = user_message)
-        if RESPONDER_DEBUG: print(f"{'_'*20}\nResponder\nSysytem prompt:\n{system_message}\nPrompt:\n{prompt}\n{'_'*20}")
-
-        # Request a response from the OpenAI GPT model.
-        response, responder_used_tokens = await openai_chat_request(prompt = prompt, system = system_message, model = self.settings.responder_gpt_model, image = image)
-        
-        # Gather token usage statistics.
-        if responder_used_tokens:
-            self.total_tokens_used['Responder'] = responder_used_tokens
+
+        response = results['response']
 
         if RESPONDER_DEBUG: print(f"{'_'*20}\n!!! Final results:\nResponse:{response}\nMetadata:{metadata}\nProfile:{profile_update}\nJournal:{journal_update}\n{'_'*100}")
         return response, metadata, profile_update, journal_update
 
-    async def handle_user_inputs(self, tool: str, inputs: dict[str, str]) -> tuple[str, dict[str, str]]:
+    async def handle_user_inputs(self, tool: str, inputs: dict[str, str], stream: bool = False) -> tuple[str|ChatStream, dict[str, str]]:
         """
         Process and handle user inputs for a specific tool.
 
         Args:
         - tool (str): Name of the tool.
         - inputs (dict): Dictionary containing user inputs for the tool.
+        - stream (bool): If True, generated response is returned as ChatStream.
 
         Returns:
         - Tuple containing response and metadata.
         """
+        async def run_tool(moderation):
+            return await self.tools.run_tools([tool], {tool: inputs})
+
+        scheduler = StageScheduler([
+            Stage('moderation', self.moderation_stage(str(inputs))),
+            # Tool is executed only with inputs that passed moderation.
+            Stage('input_extraction', run_tool, inputs = ['moderation'], condition = lambda moderation: not moderation[0]),
+            Stage('recommendation', self.recommendation_stage(self.chat_history[-1]),
+                  timeout = PIPELINE_STAGE_TIMEOUTS['recommendation'], optional = True, speculative = True),
+            Stage('response', self.response_stage(None, None, stream),
+                  inputs = ['moderation', 'input_extraction', 'recommendation'], condition_inputs = ['moderation', 'input_extraction'],
+                  condition = lambda moderation, input_extraction: not moderation[0] and tools_allow_response(input_extraction))
+        ])
+        try:
+            results = await scheduler.run()
+        finally:
+            self.stage_timings = scheduler.timings
+            self.total_tokens_used['Tools'] = self.tools.total_tokens_used
+
         # Apply moderation to the user's inputs.
-        flagged, flagged_categories = self.moderation.moderate(user_message=str(inputs))
+        flagged, flagged_categories = results['moderation']
         if flagged:
             message = f"Ill content of message. Categories:{flagged_categories}"
             if RESPONDER_DEBUG: print(message)
             return message, None
 
-        tools_result, metadata = await self.tools.run_tools([tool], inputs)
-
-        prompt = ""
+        tools_result, metadata = results['input_extraction']
         if metadata is not None:
-            if metadata.get('type') == 'tool_result':
-                prompt += tools_result_additon(tools_result)
-                
-            elif metadata.get('type') == 'input_request':
+            if metadata.get('type') == 'input_request':
                 response = None
                 return response, metadata
             
@@ -205,54 +182,208 @@ class Responder:
                 response = tools_result
                 return response, metadata
 
-        recommendations, recomm_used_tokens = await self.recommender.handle_recommendations(self.chat_history[-1])
-        if recomm_used_tokens:
-            self.total_tokens_used["Recommender"] = recomm_used_tokens
-        
-        system_message = responder_system_message('\n'.join(self.user_profile.user_profile), self.emotioal_journal.journal, '\n'.join('; '.join(inner) for inner in recommendations), self.tools.all_tools_names())
-        prompt += responder_prompt('\n'.join(self.chat_history[-CHAT_HISTORY_MESSAGES_FOR_RESPONDER:]))
+        response = results['response']
+        if RESPONDER_DEBUG: print(f"{'_'*20}Responder handeles inputs\nResponse:\n{response}\n{'_'*20}")
 
+        return response, metadata
 
-        response, responder_used_tokens = await openai_chat_request(
-            prompt = prompt,
-            system = system_message,
-            model = self.settings.responder_gpt_model
-        )
-        if RESPONDER_DEBUG: print(f"{'_'*20}Responder handeles inputs\nSystem message:\n{system_message}\nPrompt:\n{prompt}\nResponse:\n{response}\n{'_'*20}")
+    def time_for_update(self, messages_till_update: int) -> bool:
+        """
+        Checks if it's time to update the user profile or the emotional journal.
+        """
+        return (self.message_count // 2) % messages_till_update == 0
 
-        if responder_used_tokens:
-            self.total_tokens_used['Responder'] = responder_used_tokens
+    def moderation_stage(self, text: str):
+        async def moderation():
+            return await self.moderation.moderate(user_message = text)
+        return moderation
 
-        return response, metadata
-def responder_system_message(user_profile: str, emotional_journal: str, recommendations: str, tools_names: list = None):
+    def tool_extraction_stage(self, user_message: str, extract_inputs: bool, previous_tools: tuple[str, ...]):
+        async def tool_extraction():
+            # With native function calling tools and their inputs are extracted in one request.
+            if self.settings.native_tool_calling:
+                return await self.tools.extract_tool_calls(
+                    user_message = user_message, chat_history = self.chat_history, extract_inputs = extract_inputs,
+                    messages_for_input_extraction = self.settings.messages_for_input_extraction
+                    )
+            # Extract tools from the user's message and previous chat message if it exsists,
+            # inputs of the predicted tool are extracted at the same time.
+            return await self.tools.extract_tools_speculatively(
+                user_message = user_message, chat_history = self.chat_history, extract_inputs = extract_inputs,
+                messages_for_input_extraction = self.settings.messages_for_input_extraction, previous_tools = previous_tools
+                )
+        return tool_extraction
+
+    def input_extraction_stage(self, user_message: str, extract_inputs: bool):
+        async def input_extraction(moderation, tool_extraction):
+            # Tools are not executed for flagged messages.
+            if moderation[0]:
+                self.tools.cancel_speculative_inputs()
+                return None
+            if self.settings.native_tool_calling:
+                return await self.tools.run_tools(*tool_extraction)
+            return await self.tools.handle_extracted_tools(
+                extracted_tools = tool_extraction, user_message = user_message, chat_history = self.chat_history,
+                extract_inputs = extract_inputs, messages_for_input_extraction = self.settings.messages_for_input_extraction
+                )
+        return input_extraction
+
+    def profile_stage(self, user_message: str):
+        async def profile():
+            profile_update, profiler_used_tokens = await self.user_profile.update_user_profile(
+                chat_history = self.chat_history[-self.settings.messages_for_profile_update:], user_message = user_message
+                )
+            if profiler_used_tokens:
+                self.total_tokens_used['Profiler'] = profiler_used_tokens
+            return profile_update
+        return profile
+
+    def journal_stage(self, user_message: str):
+        async def journal():
+            journal, updates_count, journal_used_tokens = await self.emotioal_journal.update_journal(
+                chat_history = self.chat_history[-self.settings.messages_for_journal_update:], user_message = user_message
+                )
+            if journal_used_tokens:
+                self.total_tokens_used['Journal'] = journal_used_tokens
+
+            if not journal:
+                journal_update = None
+            else:
+                self.emotioal_journal.journal = journal
+                journal_update = journal, updates_count
+            if RESPONDER_DEBUG: print("Journal update: \n",journal_update, '\n' , '_'*100)
+            return journal_update
+        return journal
+
+    def recommendation_stage(self, text: str):
+        async def recommendation():
+            recommendations, recomm_used_tokens = await self.recommender.handle_recommendations(text)
+            if recomm_used_tokens:
+                self.total_tokens_used["Recommender"] = recomm_used_tokens
+            return recommendations
+        return recommendation
+
+    def response_stage(self, user_message: str|None, image: BytesIO|None, stream: bool):
+        async def response(moderation, input_extraction, recommendation, journal = None):
+            tool_executed = input_extraction is not None and input_extraction[1] is not None
+            tools_names = self.tools.all_tools_names()
+            # Instructions, personality and user message are always sent whole.
+            budget = PromptBudget('Responder', self.settings.responder_gpt_model)
+            budget.reserve(
+                responder_system_message(user_profile = "", emotional_journal = "", tools_names = tools_names, personality = self.settings.responder_personality),
+                responder_prompt(chat_history = "", user_message = user_message, tools_result = "" if tool_executed else None)
+                )
+            # Sections are fitted to the rest of the budget from the most to the least important.
+            tools_result = budget.fit_text(str(input_extraction[0])) if tool_executed else None
+            chat_history = budget.fit_items(self.chat_history[-CHAT_HISTORY_MESSAGES_FOR_RESPONDER:], keep_end = True)
+            chat_summary = budget.fit_text(self.chat_summary, keep_end = True) if self.chat_summary else None
+            emotional_journal = budget.fit_text(str(self.emotioal_journal.journal))
+            user_profile = budget.fit_items(self.user_profile.user_profile)
+            # Recommendations are None if search failed or missed its deadline.
+            recommendations = budget.fit_items(['; '.join(inner) for inner in recommendation or []])
+
+            # Create system prompt. It only changes when profile or journal is updated, so it is reused by prompt caching.
+            system_message = responder_system_message(
+                user_profile = '\n'.join(user_profile),
+                emotional_journal = emotional_journal,
+                tools_names = tools_names,
+                personality = self.settings.responder_personality
+                )
+            # Create prompt, if tool executed successfuly, add result to prompt.
+            prompt = responder_prompt(
+                chat_history = '\n'.join(chat_history), user_message = user_message, chat_summary = chat_summary,
+                recommendations = '\n'.join(recommendations), tools_result = tools_result
+                )
+
+            self.prompt_tokens = count_messages_tokens(self.settings.responder_gpt_model, system_message, prompt)
+            if RESPONDER_DEBUG: print(f"{'_'*20}\nResponder\nSysytem prompt:\n{system_message}\nPrompt:\n{prompt}\nPrompt tokens: {self.prompt_tokens} of {budget.budget}\n{'_'*20}")
+
+            # Request a response from the OpenAI GPT model.
+            response, responder_used_tokens = await openai_chat_request(
+                prompt = prompt, system = system_message, model = self.settings.responder_gpt_model, image = image, stream = stream
+                )
+            # Gather token usage statistics.
+            if responder_used_tokens:
+                self.total_tokens_used['Responder'] = responder_used_tokens
+            return response
+        return response
+
+    async def stream_response(self, response: ChatStream):
+        """
+        Passes through text deltas of the streamed response and saves its token usage after the stream ends.
+        Full response text is available in 'response.response' after the iteration.
+        If the stream failed before its usage was received, usage is estimated from the counted prompt and received text.
+        """
+        try:
+            async for delta in response:
+                yield delta
+        finally:
+            if response.usage:
+                self.total_tokens_used['Responder'] = response.usage
+            else:
+                prompt_tokens = self.prompt_tokens or 0
+                completion_tokens = count_tokens(response.response, self.settings.responder_gpt_model)
+                self.total_tokens_used['Responder'] = {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "cached_tokens": 0
+                }
+                print(f"Usage of streamed response wasn't received, estimated usage: {self.total_tokens_used['Responder']}")
+        if RESPONDER_DEBUG: print(f"{'_'*20}\nStreamed response:\n{response.response}\n{'_'*20}")
+
+def tools_allow_response(tools_results: tuple | None) -> bool:
+    """
+    Response is generated if no tools were used or tool executed successfuly.
+    """
+    if tools_results is None:
+        return True
+    tools_result, metadata = tools_results
+    return metadata is None or metadata.get('type') == 'tool_result'
+
+# Prompts are laid out as a static prefix followed by sections from the least to the most often changing one,
+# so OpenAI prompt caching reuses the longest possible prefix between turns.
+def responder_system_message(user_profile: str, emotional_journal: str, tools_names: list, personality: str):
     return dedent(f"""\
 You are a helpful wellbeing assistant.
 You care about user and trying to make users mental and physical health better.
 You have a chat history as a context, focus on answering to LAST USER MESSAGE.
-You have access to the following tools: {', '.join(tools_names)}
-You can't call this tools by yourself, you only get results of these tools!
+You can't call tools by yourself, you only get results of tools!
 Try to use appropriate emojis.
-You have a user profile to better understand the user:|
-{user_profile}|
+You have a user profile to better understand the user.
 You also have the user's emotional journal.The emotional journal reflects\
 how the user feels, represented as emotions with marks from 0 to 100 indicating\
-the intensity of each emotion.|
-{emotional_journal}|
-Here is a list of recommendation to user that might be useful:|
-{recommendations}|""")
+the intensity of each emotion.
+You may get a list of recommendations to user that might be useful.
+You have access to the following tools: {', '.join(tools_names)}
+""") + personality_addition(personality) + f"""
+User profile:|
+{user_profile}|
+Emotional journal:|
+{emotional_journal}|"""
 
-def responder_prompt(chat_history: str, user_message: str = None):
-    if user_message:
-        return f"""\
-Previous conversation|
-{chat_history}
-LAST USER MESSAGE:{user_message}|
-Your responce:"""
-    else:
-        return f"""\
+def responder_prompt(chat_history: str, user_message: str = None, chat_summary: str = None,
+                     recommendations: str = None, tools_result: str = None):
+    prompt = ""
+    if chat_summary:
+        prompt += f"""\
+Summary of earlier conversation|
+{chat_summary}|
+"""
+    prompt += f"""\
 Previous conversation|
 {chat_history}|
-Your responce:"""
+"""
+    if recommendations:
+        prompt += f"""\
+Here is a list of recommendation to user that might be useful:|
+{recommendations}|
+"""
+    if tools_result is not None:
+        prompt += tools_result_additon(tools_result) + "\n"
+    if user_message:
+        prompt += f"LAST USER MESSAGE:{user_message}|\n"
+    return prompt + "Your responce:"
 
 def tools_result_additon(tools_result):
     return f"""\
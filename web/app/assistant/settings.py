@@ -5,6 +5,10 @@ CHAT_MESSAGES_TO_LOAD_PER_REQUEST = 20
 EMOTIONAL_JOURNALS_TO_LOAD_PER_REQUEST = 4
 
 MAX_MESSAGE_LEN = 7000
+# Limit of concurrent database writes done after responses in one process
+POST_RESPONSE_MAX_CONCURRENT_WRITES = 8
+# Seconds the server waits for pending post response writes on shutdown
+POST_RESPONSE_SHUTDOWN_TIMEOUT = 30
 
 AUDIO_TRANSCRIPTION_MODEL = 'whisper-1'
 # Pricing per minute
@@ -14,14 +18,39 @@ AVAILABLE_GPT_MODELS = [
     'gpt-4o',
     'gpt-4o-mini',
 ]
-# 1000 tokens price for every model
+# 1000 tokens price for every model, input tokens read from prompt cache are 'cached_input'
 GPT_MODELS_PRICING = {
-    'gpt-4o':{'input': 0.0025, 'output': 0.01},
-    'gpt-4o-mini':{'input': 0.00015, 'output': 0.0006},
+    'gpt-4o':{'input': 0.0025, 'cached_input': 0.00125, 'output': 0.01},
+    'gpt-4o-mini':{'input': 0.00015, 'cached_input': 0.000075, 'output': 0.0006},
 }
+# Prompt token budgets by module and model, sections that don't fit are truncated by their priority
+PROMPT_TOKEN_BUDGETS = {
+    'Responder': {'gpt-4o': 6000, 'gpt-4o-mini': 8000, 'default': 6000},
+    'Profiler': {'default': 5000},
+    'Journal': {'default': 3000},
+}
+# Tokenizer for models unknown to tiktoken and tokens added by formatting of every chat message
+PROMPT_DEFAULT_ENCODING = 'o200k_base'
+PROMPT_MESSAGE_OVERHEAD_TOKENS = 4
 # Responder constants
 MESSAGES_TO_PASS_TO_ASSISTANT = 12
 CHAT_HISTORY_MESSAGES_FOR_RESPONDER = 10
+# Send response to the client token by token while it is generated
+STREAM_RESPONSES = True
+# Seconds optional pipeline stages may run before they are cancelled and skipped
+PIPELINE_STAGE_TIMEOUTS = {
+    'profile': 60,
+    'journal': 30,
+    'recommendation': 30,
+}
+
+# Rolling chat summary: new messages that start an update, new messages folded in one update
+# (older unsummarized messages are skipped) and maximum summary length
+CHAT_SUMMARY_UPDATE_MESSAGES = 10
+CHAT_SUMMARY_MAX_NEW_MESSAGES = 40
+CHAT_SUMMARY_MAX_LENGTH = 3000
+# Add summary of earlier conversation to the responder prompt
+CHAT_SUMMARY_IN_RESPONDER_PROMPT = True
 
 # Profiler constants
 MIN_MESSAGES_FOR_PROFILE_UPDATE = 1
@@ -44,12 +73,37 @@ EMOTIONAL_JOURNAL_EMOTIONS = [
     "empowerment", "shame", "guilt", "loneliness", "love"
 ]
 # Tools constants 
+TOOLS_LIST_PATH = "web/app/assistant/Tools/tools_list.txt"
+# Limits of a tool call if they are not set in the tools list
+TOOLS_DEFAULT_TIMEOUT = 20
+TOOLS_DEFAULT_MAX_CONCURRENCY = 16
+# Maximum number of cached results of tools with 'cache_ttl'
+TOOLS_RESULT_CACHE_SIZE = 1024
+# Workers for sync tools and for CPU-heavy tool work, that is stopped after the tool timeout
+TOOLS_THREAD_POOL_SIZE = 8
+TOOLS_PROCESS_POOL_SIZE = 2
+# Calls in the process pool are stopped this many seconds before the tool timeout, so they fail with their own error.
+TOOLS_PROCESS_TIMEOUT_MARGIN = 0.5
+# Connection pool and request timeout of the HTTP session shared by network tools
+TOOLS_HTTP_CONNECTIONS_LIMIT = 100
+TOOLS_HTTP_TIMEOUT = 10
+# Local pre-classifier score a message needs to be sent to tool extraction request, 0 sends every message.
+# Previous message adds its score with the weight.
+TOOLS_PRECLASSIFIER_THRESHOLD = 1.0
+TOOLS_PRECLASSIFIER_PREVIOUS_MESSAGE_WEIGHT = 0.5
+# Extract inputs of the tool predicted by the pre-classifier concurrently with tool extraction
+TOOLS_SPECULATIVE_INPUT_EXTRACTION = True
 MIN_MESSAGES_FOR_INPUT_EXTACTION = 1
 MAX_MESSAGES_FOR_INPUT_EXTACTION = 10
 
 # Recommender
-RECOMMENDER_TREE_PATH = "web/app/assistant/Recommendations/recomendation_tree.json"
+# Binary store with the recommendations tree and texts, built from recommendations file
+RECOMMENDER_TREE_PATH = "web/app/assistant/Recommendations/recommendations.bin"
 RECOMMENDER_RECOMMENDATIONS_PATH = "web/app/assistant/Recommendations/recommendations.txt"
+# Append-only file with recommendations added at runtime, searched alongside the store until merged into it
+RECOMMENDER_DELTA_PATH = "web/app/assistant/Recommendations/recommendations_delta.txt"
+# Number of vectors in the delta file that starts a background rebuild of the store
+RECOMMENDER_DELTA_MERGE_SIZE = 200
 RECOMMENDATION_CATEGORIES = [
     "Sport", "Nutrition","Sleep", 
     "Stress", "Mental Health", "Social", 
@@ -57,6 +111,24 @@ RECOMMENDATION_CATEGORIES = [
     "Body", "Mindfulness", "Positive Thinking"
 ]
 N_MAX_RECOMMENDATIONS = 3
+# Category vectors of texts are cached per worker process
+CATEGORIES_VECTOR_CACHE_SIZE = 2048
+CATEGORIES_VECTOR_CACHE_TTL = 60 * 60 * 24
+# Maximum number of vectors in a leaf of the array-backed recommendation tree
+RECOMMENDER_LEAF_SIZE = 32
+# Maximum number of elements in the distance matrix of one chunk of a batch nearest neighbors query
+RECOMMENDER_BATCH_MAX_DISTANCES = 4_000_000
+# Near-duplicate recommendations: words in a text shingle, similarity and vector distance to collapse them
+RECOMMENDER_SHINGLE_SIZE = 3
+RECOMMENDER_DUPLICATE_MIN_SIMILARITY = 0.6
+RECOMMENDER_DUPLICATE_MAX_DISTANCE = 6
+# Drop texts similar to nearer recommendations from search results, more candidates are searched for it
+RECOMMENDER_DIVERSIFY = True
+RECOMMENDER_DIVERSITY_MAX_SIMILARITY = 0.5
+RECOMMENDER_DIVERSITY_CANDIDATES_FACTOR = 3
+# Corpus generation: concurrent model requests and checkpoint of generated recommendations
+RECOMMENDATION_GENERATION_CONCURRENCY = 16
+RECOMMENDATION_GENERATION_CHECKPOINT_PATH = "web/app/assistant/Recommendations/generation_checkpoint.jsonl"
 
 # Debug options
 RECOMMENDER_DEBUG = True
@@ -65,6 +137,8 @@ TOOLS_DEBUG = True
 EMOTIONAL_JOURNAL_DEBUG = True
 RESPONDER_DEBUG = True
 PROFILE_DEBUG = True
+PIPELINE_DEBUG = True
+SUMMARY_DEBUG = True
 
 PRINT_FETCHED_CHAT_HISTOTY = True
 
@@ -82,6 +156,7 @@ class AssistantSettings:
             messages_till_journal_update: int = None,
             messages_for_journal_update: int = None,
             responder_personality: str = None,
+            native_tool_calling: bool = False,
             ) -> None:
         
         self.responder_gpt_model = responder_gpt_model
@@ -92,4 +167,6 @@ class AssistantSettings:
         self.messages_for_profile_update = messages_for_profile_update
         self.messages_for_input_extraction = messages_for_input_extraction
         self.messages_till_journal_update = messages_till_journal_update
-        self.messages_for_journal_update = messages_for_journal_update
\ No newline at end of file
+        self.messages_for_journal_update = messages_for_journal_update
+        # Select tools and extract their inputs in one function calling request.
+        self.native_tool_calling = native_tool_calling
\ No newline at end of file
@@ -0,0 +1,109 @@
+import functools, math, re, threading
+
+from .tool_registry import ToolRegistry, get_tool_registry
+from .settings import TOOLS_LIST_PATH, TOOLS_PRECLASSIFIER_THRESHOLD, TOOLS_PRECLASSIFIER_PREVIOUS_MESSAGE_WEIGHT
+
+# Links and math expressions are replaced with words, so tools can list them as keywords.
+URL_PATTERN = re.compile(r"(https?://|www\.)\S+", re.IGNORECASE)
+MATH_PATTERN = re.compile(r"\d+(?:[.,]\d+)?\s*[-+*/^%×÷]\s*\(?\s*\d")
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+SUFFIXES = ('ing', 'ed', 'es', 's', 'e')
+# Words that don't tell about a tool, but are common in tools descriptions and chat messages.
+STOP_WORDS = frozenset("""
+a about an and are as at be by can for from give gives given how i in is it me my of on or please
+recent the this to with you your what
+""".split())
+
+def tokenize(text: str) -> set[str]:
+    """
+    Returns the set of lower-case word stems of the text without stop words.
+    """
+    text = URL_PATTERN.sub(" url ", text)
+    text = MATH_PATTERN.sub(" math ", text)
+    return {stem(word) for word in WORD_PATTERN.findall(text.lower()) if word not in STOP_WORDS}
+
+def stem(word: str) -> str:
+    # Crude suffix stripping, only needs to map word forms of messages and descriptions to the same stem.
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            return word[:-len(suffix)]
+    return word
+
+class ToolIntentClassifier:
+    """
+    Local TF-IDF scoring of messages against tools names, descriptions and keywords from the tools list.
+    It runs before the tool extraction request and decides if a message certainly doesn't need any tool,
+    so the request is only made for messages with words related to tools.
+
+    - Score of a tool is the sum of IDF weights of message stems found in the tool document. Stems found in
+    documents of fewer tools weigh more.
+    - Message is escalated to the model when the best score reaches 'threshold', 0 escalates every message.
+    - 'counters' count messages that skipped the request and messages that were escalated.
+    """
+    def __init__(self, registry: ToolRegistry, threshold: float = TOOLS_PRECLASSIFIER_THRESHOLD,
+                 previous_message_weight: float = TOOLS_PRECLASSIFIER_PREVIOUS_MESSAGE_WEIGHT):
+        self.threshold = threshold
+        self.previous_message_weight = previous_message_weight
+
+        documents = {
+            tool['name']: tokenize(" ".join([tool['name'].replace('_', ' '), tool['description'], *tool['keywords']]))
+            for tool in registry.tools
+        }
+        document_frequency = {}
+        for document in documents.values():
+            for token in document:
+                document_frequency[token] = document_frequency.get(token, 0) + 1
+
+        # Weight of every stem in every tool document.
+        self.weights = {
+            name: {token: math.log(1 + len(documents) / document_frequency[token]) for token in document}
+            for name, document in documents.items()
+        }
+
+        self.counters = {"skipped": 0, "escalated": 0}
+        self.lock = threading.Lock()
+
+    def scores(self, message: str, previous_message: str = None) -> dict[str, float]:
+        """
+        Returns scores of all tools for the message. Previous message adds its scores with lower weight,
+        so short follow-ups like "and tomorrow?" are still escalated.
+        """
+        tokens = tokenize(message)
+        previous_tokens = tokenize(previous_message) if previous_message else set()
+
+        return {
+            name: sum(weight for token, weight in weights.items() if token in tokens)
+            + self.previous_message_weight * sum(weight for token, weight in weights.items() if token in previous_tokens)
+            for name, weights in self.weights.items()
+        }
+
+    def predict(self, message: str, previous_message: str = None) -> tuple[str | None, float]:
+        """
+        Returns the tool with the best score and the score, tool is None if no tool reaches the threshold.
+        """
+        scores = self.scores(message, previous_message)
+        name = max(scores, key=scores.get, default=None)
+        if name is None or scores[name] == 0 or scores[name] < self.threshold:
+            return None, scores.get(name, 0)
+        return name, scores[name]
+
+    def needs_extraction(self, message: str, previous_message: str = None) -> bool:
+        """
+        Returns False if the message certainly doesn't need a tool and the tool extraction request can be skipped.
+        """
+        escalate = self.threshold <= 0 or self.predict(message, previous_message)[0] is not None
+        with self.lock:
+            self.counters["escalated" if escalate else "skipped"] += 1
+        return escalate
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = sum(self.counters.values())
+            return {**self.counters, "skip_rate": round(self.counters["skipped"] / max(1, total), 3)}
+
+@functools.cache
+def get_tool_classifier(path: str = TOOLS_LIST_PATH) -> ToolIntentClassifier:
+    """
+    Returns the classifier of the process for the tools list, shared by all Tools instances.
+    """
+    return ToolIntentClassifier(get_tool_registry(path))
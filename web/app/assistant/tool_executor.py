@@ -0,0 +1,175 @@
+import asyncio, json, multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Any
+
+import aiohttp
+
+from .helpers import TTLCache
+from .settings import (TOOLS_THREAD_POOL_SIZE, TOOLS_PROCESS_POOL_SIZE, TOOLS_HTTP_CONNECTIONS_LIMIT,
+                       TOOLS_HTTP_TIMEOUT, TOOLS_RESULT_CACHE_SIZE, TOOLS_DEBUG)
+
+# Sync tools run here, so they don't block the event loop.
+tools_thread_pool = ThreadPoolExecutor(max_workers=TOOLS_THREAD_POOL_SIZE, thread_name_prefix='tools')
+
+_http_session: aiohttp.ClientSession | None = None
+_http_session_loop: asyncio.AbstractEventLoop | None = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Returns the HTTP session shared by network tools of the worker process. Its connection pool
+    keeps connections to the APIs open between tool calls. Must be called from the event loop.
+    """
+    global _http_session, _http_session_loop
+    loop = asyncio.get_running_loop()
+    # Session is bound to the loop it was created in.
+    if _http_session is None or _http_session.closed or _http_session_loop is not loop:
+        _http_session_loop = loop
+        _http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=TOOLS_HTTP_CONNECTIONS_LIMIT),
+            timeout=aiohttp.ClientTimeout(total=TOOLS_HTTP_TIMEOUT),
+        )
+    return _http_session
+
+async def run_in_thread(function: Callable, *args) -> Any:
+    """
+    Runs a blocking function in the tools thread pool.
+    """
+    return await asyncio.get_running_loop().run_in_executor(tools_thread_pool, function, *args)
+
+class ProcessRunner:
+    """
+    Pool of processes for CPU-heavy tool work with a hard timeout. Processes of a call that missed its
+    timeout can't be stopped separately, so the whole pool is terminated and created again. Other calls
+    running in the terminated pool are submitted to the new pool and keep their own deadlines.
+    Functions must be defined in modules that import without Django, pool processes are spawned.
+    """
+    def __init__(self, processes: int):
+        self.processes = processes
+        self.pool = None
+        # Function and arguments of unfinished calls by their futures.
+        self.calls: dict[asyncio.Future, tuple[Callable, tuple]] = {}
+
+    async def run(self, function: Callable, args: tuple, timeout: float) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        self.calls[future] = (function, args)
+        try:
+            self.submit(future)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            if TOOLS_DEBUG: print(f"Process of {function.__name__} missed timeout of {timeout} seconds, restarting process pool")
+            del self.calls[future]
+            self.restart()
+            raise Exception(f"Calculation took longer than {timeout} seconds and was stopped.")
+        except asyncio.CancelledError:
+            # Call cancelled by the tool timeout would keep running in the pool.
+            del self.calls[future]
+            self.restart()
+            raise
+        finally:
+            self.calls.pop(future, None)
+
+    def submit(self, future: asyncio.Future):
+        if self.pool is None:
+            self.pool = multiprocessing.get_context('spawn').Pool(self.processes)
+
+        loop = future.get_loop()
+        def set_result(result):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+        def set_exception(exception):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_exception(exception))
+        function, args = self.calls[future]
+        self.pool.apply_async(function, args, callback=set_result, error_callback=set_exception)
+
+    def restart(self):
+        pool, self.pool = self.pool, None
+        if pool is not None:
+            # Terminating waits for the pool processes, so it doesn't block the event loop.
+            asyncio.get_running_loop().run_in_executor(tools_thread_pool, pool.terminate)
+
+        # Calls of other users were killed with the pool, they run again in the new one.
+        for future in self.calls:
+            if not future.done():
+                if TOOLS_DEBUG: print(f"Process pool restarted, running {self.calls[future][0].__name__} again")
+                self.submit(future)
+
+process_runner = ProcessRunner(TOOLS_PROCESS_POOL_SIZE)
+
+def tool_cache_key(tool_name: str, kwargs: dict) -> str:
+    """
+    Key of tool results, inputs are normalized to lower case with collapsed whitespace.
+    """
+    inputs = {name: " ".join(str(value).casefold().split()) if value is not None else None for name, value in kwargs.items()}
+    return tool_name + ":" + json.dumps(inputs, sort_keys=True)
+
+class ToolExecutor:
+    """
+    Runs tool functions from the registry. Async functions are awaited on the event loop, sync ones
+    run in the thread pool. Every tool is limited by its 'timeout' and 'max_concurrency' from the registry.
+
+    Results of tools with 'cache_ttl' are cached by normalized inputs for that many seconds.
+    Concurrent calls with the same inputs share one call of the tool. Hits, misses and shared calls
+    are counted per tool in 'metrics'.
+    """
+    def __init__(self):
+        self.semaphores: dict[str, asyncio.Semaphore] = {}
+        self.results_cache = TTLCache(TOOLS_RESULT_CACHE_SIZE, 0)
+        self.in_flight: dict[str, asyncio.Task] = {}
+        self.metrics: dict[str, dict[str, int]] = {}
+
+    async def run(self, tool, kwargs: dict) -> Any:
+        if not tool['cache_ttl']:
+            return await self.call(tool, kwargs)
+
+        key = tool_cache_key(tool['name'], kwargs)
+        metrics = self.metrics.setdefault(tool['name'], {"hits": 0, "misses": 0, "coalesced": 0})
+
+        result = self.results_cache.get(key)
+        if result is not None:
+            metrics["hits"] += 1
+            if TOOLS_DEBUG: print(f"Tool '{tool['name']}' result from cache, {self.stats()[tool['name']]}")
+            return result
+
+        task = self.in_flight.get(key)
+        if task is not None:
+            metrics["coalesced"] += 1
+        else:
+            metrics["misses"] += 1
+            task = asyncio.ensure_future(self.call(tool, kwargs))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda task: self.save_result(key, tool['cache_ttl'], task))
+
+        # Cancellation of one caller doesn't cancel the call other callers wait for.
+        return await asyncio.shield(task)
+
+    def save_result(self, key: str, ttl: float, task: asyncio.Task):
+        del self.in_flight[key]
+        # Failed calls and empty results are not cached.
+        if not task.cancelled() and task.exception() is None and task.result() is not None:
+            self.results_cache.set(key, task.result(), ttl)
+
+    def stats(self) -> dict[str, dict]:
+        """
+        Returns cache metrics with hit rate for every cached tool.
+        """
+        return {
+            name: {**metrics, "hit_rate": round((metrics["hits"] + metrics["coalesced"]) / max(1, sum(metrics.values())), 3)}
+            for name, metrics in self.metrics.items()
+        }
+
+    async def call(self, tool, kwargs: dict) -> Any:
+        semaphore = self.semaphores.get(tool['name'])
+        if semaphore is None:
+            semaphore = self.semaphores[tool['name']] = asyncio.Semaphore(tool['max_concurrency'])
+
+        function = tool['function_name']
+        async with semaphore:
+            if tool['is_async']:
+                call = function(**kwargs)
+            else:
+                call = run_in_thread(lambda: function(**kwargs))
+            try:
+                return await asyncio.wait_for(call, tool['timeout'])
+            except asyncio.TimeoutError:
+                raise Exception(f"Tool '{tool['name']}' did not respond in {tool['timeout']} seconds.")
+
+tool_executor = ToolExecutor()
@@ -0,0 +1,150 @@
+import ast, functools, inspect
+from types import MappingProxyType
+
+from .Tools import tools_functions
+from .settings import TOOLS_LIST_PATH, TOOLS_DEFAULT_TIMEOUT, TOOLS_DEFAULT_MAX_CONCURRENCY
+
+# Keys every tool description must have and their types.
+TOOL_SPEC_KEYS = {
+    'name': str,
+    'description': str,
+    'function_name': str,
+    'needs_inputs': bool,
+    'inputs': list,
+    'required_inputs': list,
+    'inputs_description': str,
+    'needs_user_db': bool,
+    'uses_gpt': bool,
+}
+# Optional keys with their defaults.
+TOOL_SPEC_DEFAULTS = {
+    'timeout': TOOLS_DEFAULT_TIMEOUT,
+    'max_concurrency': TOOLS_DEFAULT_MAX_CONCURRENCY,
+    # Seconds results are cached for the same inputs, 0 disables caching.
+    'cache_ttl': 0,
+}
+
+class ToolRegistry:
+    """
+    Immutable registry of tools parsed from the tools list file. It is loaded once per process with
+    'get_tool_registry' and shared by all Tools instances, so per-message tool setup does no file reads.
+
+    - Tool descriptions are read-only mappings where 'function_name' is the function from tools_functions
+    and 'is_async' tells if it is a coroutine function. Missing optional keys are set to defaults.
+    - Texts that only depend on the tools list, used in prompts and in 'tools_info', are prepared once.
+    """
+    def __init__(self, tools: list[dict]):
+        self.tools = tuple(MappingProxyType(tool) for tool in tools)
+        self.by_name = MappingProxyType({tool['name']: tool for tool in self.tools})
+        self.names = tuple(tool['name'] for tool in self.tools)
+        self.names_with_inputs = tuple(tool['name'] for tool in self.tools if tool['needs_inputs'])
+        self.names_without_inputs = tuple(tool['name'] for tool in self.tools if not tool['needs_inputs'])
+        # Tools list for the 'extract_tools' system prompt.
+        self.extraction_prompt = "".join(f"Name: {tool['name']}; Description: {tool['description']}\n" for tool in self.tools)
+        # Tools as function schemas for native function calling. Inputs are not marked as required in schemas,
+        # so the model doesn't invent missing values, required inputs are checked after the call.
+        self.function_schemas = tuple(
+            {
+                "type": "function",
+                "function": {
+                    "name": tool['name'],
+                    "description": tool['description'] + (f" Inputs: {tool['inputs_description']}" if tool['inputs'] else ""),
+                    "parameters": {
+                        "type": "object",
+                        "properties": {input: {"type": "string"} for input in tool['inputs']},
+                    },
+                },
+            }
+            for tool in self.tools
+        )
+        # Message of the 'tools_info' tool.
+        self.info_message = "Here is tools list:\n" + "".join(
+            f"Name: {tool['name'].replace('_', ' ')}; Description: {tool['description']}; Inputs: {', '.join(tool['inputs']).replace('_', ' ')};\n"
+            f"Inputs desription: {tool['inputs_description']}\n"
+            for tool in self.tools
+        )
+
+    def get(self, tool_name: str) -> MappingProxyType | None:
+        return self.by_name.get(tool_name)
+
+    @staticmethod
+    def load(path: str) -> 'ToolRegistry':
+        """
+        Parses the tools list file as a Python literal, without executing it, and validates tool descriptions.
+        Functions are referenced in the file by their names in tools_functions.
+        """
+        with open(path, 'r', encoding='utf-8') as file:
+            try:
+                tools_list = ast.literal_eval(file.read())
+            except (SyntaxError, ValueError) as e:
+                raise Exception(f"Error in deffinition of tools in file {path}: {e}")
+
+        if not isinstance(tools_list, list):
+            raise Exception(f"Tools file {path} must contain a list of tools descriptions.")
+
+        tools = []
+        for tool in tools_list:
+            tool = validate_tool(tool, path)
+            if any(tool['name'] == other['name'] for other in tools):
+                raise Exception(f"Tool '{tool['name']}' is defined twice in {path}.")
+            tools.append(tool)
+
+        return ToolRegistry(tools)
+
+def validate_tool(tool: dict, path: str) -> dict:
+    """
+    Checks the tool description and returns its copy with the function object and tuples instead of lists.
+    """
+    if not isinstance(tool, dict):
+        raise Exception(f"Tool description must be a dictionary in {path}: {tool}")
+
+    for key, key_type in TOOL_SPEC_KEYS.items():
+        if not isinstance(tool.get(key), key_type):
+            raise Exception(f"Tool '{tool.get('name')}' in {path} must have '{key}' of type {key_type.__name__}.")
+
+    name = tool['name']
+    for key, default in TOOL_SPEC_DEFAULTS.items():
+        value = tool.get(key, default)
+        if not isinstance(value, (int, float)) or value < 0 or (value == 0 and key != 'cache_ttl'):
+            raise Exception(f"Tool '{name}' in {path} must have positive number as '{key}'.")
+
+    # Results depend on user data, so they can't be shared between users.
+    if tool['needs_user_db'] and tool.get('cache_ttl'):
+        raise Exception(f"Results of tool '{name}' that needs user db can't be cached.")
+
+    keywords = tool.get('keywords', [])
+    if not isinstance(keywords, list) or not all(isinstance(keyword, str) for keyword in keywords):
+        raise Exception(f"Keywords of tool '{name}' in {path} must be a list of strings.")
+
+    if not set(tool['required_inputs']) <= set(tool['inputs']):
+        raise Exception(f"Required inputs of tool '{name}' must be in its inputs.")
+
+    function = getattr(tools_functions, tool['function_name'], None)
+    if not inspect.isfunction(function) or function.__module__ != tools_functions.__name__:
+        raise Exception(f"Function '{tool['function_name']}' of tool '{name}' is not defined in tools_functions.")
+
+    # Tools are called with their inputs as keyword arguments, and with 'user' if they need user db.
+    arguments = dict.fromkeys(tool['inputs'])
+    if tool['needs_user_db']:
+        arguments['user'] = None
+    try:
+        inspect.signature(function).bind(**arguments)
+    except TypeError as e:
+        raise Exception(f"Function '{tool['function_name']}' can't be called with inputs of tool '{name}': {e}")
+
+    return {
+        **TOOL_SPEC_DEFAULTS,
+        **tool,
+        'function_name': function,
+        'is_async': inspect.iscoroutinefunction(function),
+        'inputs': tuple(tool['inputs']),
+        'required_inputs': tuple(tool['required_inputs']),
+        'keywords': tuple(keywords),
+    }
+
+@functools.cache
+def get_tool_registry(path: str = TOOLS_LIST_PATH) -> ToolRegistry:
+    """
+    Returns the tool registry of the process, the tools file is parsed on the first call.
+    """
+    return ToolRegistry.load(path)
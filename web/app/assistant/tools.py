@@ -1,11 +1,15 @@
-from .helpers import openai_chat_request
+from .helpers import openai_chat_request, openai_function_call_request
 from textwrap import dedent
-import json
+import asyncio, json
 
-# Import all tool functions
-from .Tools.tools_functions import *
+from .tool_registry import get_tool_registry
+from .tool_classifier import get_tool_classifier
+from .tool_executor import tool_executor
 
-from .settings import TOOLS_DEBUG
+from .settings import TOOLS_DEBUG, TOOLS_LIST_PATH, TOOLS_SPECULATIVE_INPUT_EXTRACTION
+
+# Per-process counts of speculative input extractions that were used and that were cancelled.
+speculation_counters = {"kept": 0, "cancelled": 0}
  
 class Tools():
     """
@@ -13,7 +17,7 @@ class Tools():
     It manages the extraction of relevant tools and inputs based on user messages and conversation context,
     as well as the execution of these tools.
     """
-    def __init__(self, gpt_model:str, user, tools_path = "web/app/assistant/Tools/tools_list.txt"):
+    def __init__(self, gpt_model:str, user, tools_path = TOOLS_LIST_PATH):
         """
         Initialize the Tools class with a GPT model and a path to the tools list.
 
@@ -21,24 +25,26 @@ class Tools():
         - gpt_model (str): OpenAI GPT model name.
         - tools_path (str): Path to the file containing the list of dictionaries with description of available tools.
         """
-        # Read and store the tools list with all tools descriptions from the specified file
-        with open(tools_path, 'r', encoding='utf-8') as file:
-            # Read the tools list from the specified file
-            try:
-                self.tools_list = eval(file.read())
-            except:
-                raise Exception("Error in deffinition of tools in file.", tools_path)
+        # Tools list is parsed once per process and shared by all instances.
+        self.registry = get_tool_registry(tools_path)
+        self.tools_list = self.registry.tools
+        # Local scoring of messages, that skips tool extraction request for messages without tool intent.
+        self.classifier = get_tool_classifier(tools_path)
 
         # Set the GPT model for the Tools GPT requests
         self.gpt_model = gpt_model
         # User object for tools to acces his db
         self.user = user
 
+        # Input extractions started before tool extraction finished, by tool name.
+        self.speculative_inputs: dict[str, asyncio.Task] = {}
+
         # Dictionary to track the total tokens used for GPT prompts and responces
         self.total_tokens_used = {
             "prompt_tokens": 0,
             "completion_tokens": 0,
-            "total_tokens": 0
+            "total_tokens": 0,
+            "cached_tokens": 0
         }
 
     async def extract_tools(self, user_message: str, previous_message: str = None) -> list[str]:
@@ -58,6 +64,11 @@ class Tools():
         
         If no tools are found, the function returns None.
         """
+        # Messages that certainly don't need a tool are not sent to GPT.
+        if not self.classifier.needs_extraction(user_message, previous_message):
+            if TOOLS_DEBUG: print(f"Tool extraction skipped by pre-classifier: {self.classifier.stats()}")
+            return None
+
         # Construct a system message providing task and context about available tools.
         system_message = dedent(f"""\
         Your task is to identify if the user intends to use a tool from the provided list below.
@@ -70,8 +81,7 @@ class Tools():
         """)
 
         # Append tool information to the system_message.
-        for tool in self.tools_list:
-            system_message += f"Name: {tool['name']}; Description: {tool['description']}\n"
+        system_message += self.registry.extraction_prompt
 
         # Construct prompt with conversation context.
         prompt = dedent(f"""\
@@ -100,9 +110,8 @@ class Tools():
 
             # Validate and filter tool names against the valid tools list.
             for item in response:
-                for tool in self.tools_list:
-                    if item == tool['name']:
-                        valid_tools.append(str(item))
+                if item in self.registry.by_name:
+                    valid_tools.append(str(item))
 
             # Return the list of tool names if found, otherwise, return None.
             if valid_tools:
@@ -125,9 +134,9 @@ class Tools():
         Returns:
         dict or None: A dictionary containing information about the tool if found, or None if not found.
         """
-        for tool in self.tools_list:
-            if tool['name'] == tool_name:
-                return tool
+        tool = self.registry.get(tool_name)
+        if tool is not None:
+            return tool
             
         if TOOLS_DEBUG: print(f"Tool '{tool_name}' not found!")    
         return
@@ -154,7 +163,8 @@ class Tools():
         # Get information about the tool
         tool = self.get_tool(tool_name)
 
-        # Construct a system message providing task.
+        # Construct a system message providing task and information about tool to extract inputs for.
+        # It only depends on the tool, so it is reused by prompt caching, the conversation is in the prompt.
         system_message = dedent("""\
         Extract inputs for the described function from the conversation and respond with a JSON file containing inputs.
         Follow this format:
@@ -167,16 +177,15 @@ class Tools():
         If an input has '(optional)' in the description, it can be empty.
         If there are no inputs in user messages or a required input is missing, your response MUST BE EMPTY.
         If there are no inputs, leave the input field EMPTY.
-        Analyze the entire chat for input extraction.""")
-
-        # Construct a prompt providing information about tool to extract inputs for.
-        prompt = dedent(f"""\
+        Analyze the entire chat for input extraction.
+        """) + dedent(f"""\
         Function name: {tool['name']}
         - Function description: {tool['description']}
-        - Function inputs: {str(tool['inputs'])}
-        - Inputs description: {tool['inputs_description']}
-        - Conversation: |
-        """) + chat_history + "\nRemember the format!"
+        - Function inputs: {str(list(tool['inputs']))}
+        - Inputs description: {tool['inputs_description']}""")
+
+        # Construct a prompt with the conversation.
+        prompt = "Conversation: |\n" + chat_history + "\nRemember the format!"
 
         # Request a responce
         response, token_usage = await openai_chat_request(prompt=prompt, system=system_message, model=self.gpt_model)
@@ -190,49 +199,159 @@ class Tools():
 
         # Process the response to extract inputs.
         if response and response.strip() != '':
-            inputs = {}
-            missing_inputs = []
             try:
                 # Try to parse the GPT response as JSON.
                 response = json.loads(response)
 
-                # Iterate over the expected inputs for the tool.
-                for input in tool['inputs']:
-                    # Get the value of the valid input from the parsed response.
-                    response_input = response.get(input)
-                    
-                    # If the input is found in the response and is not empty, add it to the inputs dictionary.
-                    if response_input and response_input.strip() != '':
-                        inputs[input] = response_input
-
-                    # If the input is not found, check if it is a required input.
-                    else:
-                        for required_input in tool['required_inputs']:
-                            # If input is required, add the input to the list of missing inputs.
-                            if input == required_input:
-                                if TOOLS_DEBUG: print('Required input not found! -', input)
-                                missing_inputs.append(input)
-                                
-                        # Set the input value to None if input is optional.
-                        inputs[input] = None
-
                 # Return the extracted inputs and the list of missing required inputs.
-                return inputs, missing_inputs
+                return validate_inputs(tool, response)
             
             # Handle exceptions that may occur during JSON parsing and return None.
             except Exception as e:
                 print('Error in extracted inputs format from GPT', e)
                 # Return None as tool inputs and tool's required inputs as missing
-                missing_inputs = tool['required_inputs']
+                missing_inputs = list(tool['required_inputs'])
                 
                 return None, missing_inputs
         else:
             # If GPT did not find any inputs, print a message.
             if TOOLS_DEBUG: print("GPT did not find any inputs!")
-            missing_inputs = tool['required_inputs']
+            missing_inputs = list(tool['required_inputs'])
             # Return None as tool inputs and tool's required inputs as missing
             return None, missing_inputs
     
+    def predict_tool(self, user_message: str, previous_message: str = None, previous_tools: tuple[str, ...] = ()) -> str | None:
+        """
+        Predicts the tool that needs inputs and is likely to be extracted for the message, from the pre-classifier scores.
+        Tool used in the previous turn is preferred if the message is related to it, for repeated use of the same tool.
+
+        Returns:
+        - Name of the predicted tool or None if tool extraction will be skipped or no tool with inputs is related.
+        """
+        if self.classifier.predict(user_message, previous_message)[0] is None:
+            return None
+
+        scores = self.classifier.scores(user_message, previous_message)
+        candidates = [name for name in self.registry.names_with_inputs if scores.get(name)]
+        for tool_name in previous_tools:
+            if tool_name in candidates:
+                return tool_name
+        return max(candidates, key=scores.get, default=None)
+
+    async def extract_tools_speculatively(self, user_message: str, chat_history: list, extract_inputs: bool,
+                                          messages_for_input_extraction: int, previous_tools: tuple[str, ...] = ()) -> list[str] | None:
+        """
+        Extracts tools with 'extract_tools', while inputs of the predicted tool are extracted concurrently.
+        If the predicted tool is extracted, its inputs are kept for 'handle_extracted_tools', otherwise extraction is cancelled.
+
+        Args:
+        - user_message (str): Current user message.
+        - chat_history (list): List of previous chat messages.
+        - extract_inputs (bool): Inputs are only extracted speculatively if inputs extraction is turned on.
+        - messages_for_input_extraction (int): Number of messages to consider for input extraction.
+        - previous_tools (tuple): Tools used or requested in the previous turn.
+
+        Returns:
+        - Same as 'extract_tools'.
+        """
+        previous_message = chat_history[-1] if len(chat_history) >= 1 else None
+        predicted_tool = None
+        if TOOLS_SPECULATIVE_INPUT_EXTRACTION and extract_inputs is True:
+            predicted_tool = self.predict_tool(user_message, previous_message, previous_tools)
+
+        if predicted_tool is None:
+            return await self.extract_tools(user_message = user_message, previous_message = previous_message)
+
+        chat_context = input_extraction_context(user_message, chat_history, messages_for_input_extraction)
+        speculation = asyncio.create_task(self.extract_inputs(tool_name = predicted_tool, chat_history = chat_context))
+        try:
+            extracted_tools = await self.extract_tools(user_message = user_message, previous_message = previous_message)
+        except BaseException:
+            speculation.cancel()
+            raise
+
+        if extracted_tools and predicted_tool in extracted_tools:
+            self.speculative_inputs[predicted_tool] = speculation
+            speculation_counters["kept"] += 1
+        else:
+            speculation.cancel()
+            speculation_counters["cancelled"] += 1
+
+        if TOOLS_DEBUG: print(f"Speculative inputs extraction for '{predicted_tool}', extracted tools: {extracted_tools}, {speculation_counters}")
+        return extracted_tools
+
+    def cancel_speculative_inputs(self):
+        """
+        Cancels input extractions started by 'extract_tools_speculatively' that were not used.
+        """
+        for speculation in self.speculative_inputs.values():
+            speculation.cancel()
+        self.speculative_inputs.clear()
+
+    async def extract_tool_calls(self, user_message: str, chat_history: list, extract_inputs: bool,
+                                 messages_for_input_extraction: int) -> tuple[list[str], dict, dict] | None:
+        """
+        Selects tools and extracts their inputs in one request with native function calling.
+        Tools from the registry are passed to the model as function schemas and the model returns structured calls.
+
+        Args:
+        - user_message (str): Current user message.
+        - chat_history (list): List of previous chat messages.
+        - extract_inputs (bool): If False, arguments of calls are ignored and user is asked for inputs.
+        - messages_for_input_extraction (int): Number of messages to consider for input extraction.
+
+        Returns:
+        - Tuple of (tools_list, inputs, missing_inputs) to pass to 'run_tools', or None if no tools are called.
+        """
+        # Messages that certainly don't need a tool are not sent to GPT.
+        previous_message = chat_history[-1] if chat_history else None
+        if not self.classifier.needs_extraction(user_message, previous_message):
+            if TOOLS_DEBUG: print(f"Tool calls extraction skipped by pre-classifier: {self.classifier.stats()}")
+            return None
+
+        system_message = dedent("""\
+        Your task is to identify if the user intends to use one or more of the provided tools and call them.
+        - CALL A TOOL ONLY IF YOU ARE 100% SURE USER WANTS TO USE IT.
+        - Take arguments only from the conversation, leave arguments that user didn't provide empty.
+        - If there are no relevant tools to use, don't call any tools and respond with an empty message.""")
+        prompt = "Conversation:\n" + input_extraction_context(user_message, chat_history, messages_for_input_extraction)
+
+        tool_calls, token_usage = await openai_function_call_request(
+            prompt = prompt, system = system_message, functions = self.registry.function_schemas, model = self.gpt_model
+            )
+
+        # Gather token usage statistics.
+        if token_usage:
+            self.save_token_usage(token_usage)
+
+        if TOOLS_DEBUG: print(f"{'_'*20}\nTool calls extraction:\n{prompt}\n{tool_calls}\n{'_'*20}")
+
+        if not tool_calls:
+            if TOOLS_DEBUG: print('GPT found no tools to call')
+            return None
+
+        tools_list, inputs, missing_inputs = [], {}, {}
+        for tool_name, arguments in tool_calls:
+            tool = self.get_tool(tool_name)
+            if tool is None or tool_name in tools_list:
+                continue
+            tools_list.append(tool_name)
+
+            # Inputs are handled the same way as in 'handle_extracted_tools'.
+            if not tool['needs_inputs']:
+                inputs[tool_name], missing_inputs[tool_name] = {}, []
+            elif extract_inputs is not True:
+                inputs[tool_name], missing_inputs[tool_name] = None, list(tool['required_inputs'])
+            else:
+                try:
+                    inputs[tool_name], missing_inputs[tool_name] = validate_inputs(tool, json.loads(arguments))
+                except (json.JSONDecodeError, AttributeError) as e:
+                    print('Error in arguments format of tool call from GPT', e)
+                    # Tool that needs inputs is not executed without them.
+                    inputs[tool_name], missing_inputs[tool_name] = None, list(tool['inputs'])
+
+        return (tools_list, inputs, missing_inputs) if tools_list else None
+
     def ask_for_inputs(self, tool_name: str, missing_inputs: list, inputs: None|dict = None ):
         """
         Generates metadata for the input request.
@@ -272,20 +391,47 @@ class Tools():
         
         return tool_result, metadata
     
-    async def run_tools(self, tools_list: list[str], inputs: dict[str, str] = None) -> tuple[str | None, dict[str, str]]:
+    async def run_tools(self, tools_list: list[str], inputs: dict[str, dict] = None,
+                        missing_inputs: dict[str, list] = None) -> tuple[str | None, dict[str, str]]:
         """
-        Run the specified tools with given inputs.
+        Run the specified tools concurrently. Tools with missing inputs are not executed, input requests are created for them.
 
         Args:
         - tools_list (list): List of tools to be executed.
-        - inputs (dict): Dictionary containing inputs for the first tool.
+        - inputs (dict): Dictionary with inputs for every tool by tool name.
+        - missing_inputs (dict): Dictionary with missing required inputs by tool name.
 
         Returns:
-        - Tuple containing output of the tool and metadata dictionary.
+        - Tuple containing output of the tool and metadata dictionary, combined by 'combine_tools_results' for several tools.
         """
+        inputs = inputs or {}
+        missing_inputs = missing_inputs or {}
+
+        async def ask_for_inputs(tool_name):
+            return self.ask_for_inputs(tool_name = tool_name, missing_inputs = missing_inputs[tool_name], inputs = inputs.get(tool_name))
+
+        runs = []
+        for tool_name in dict.fromkeys(tools_list):
+            if missing_inputs.get(tool_name):
+                runs.append(ask_for_inputs(tool_name))
+            else:
+                runs.append(self.run_tool(tool_name, inputs.get(tool_name)))
+
+        results = await asyncio.gather(*runs)
+        return combine_tools_results(results)
 
-        # Get the first tool from the list and remove it from the list.
-        tool = self.get_tool(tools_list.pop(0))
+    async def run_tool(self, tool_name: str, inputs: dict[str, str] = None) -> tuple[str | None, dict[str, str]]:
+        """
+        Run the specified tool with given inputs.
+
+        Args:
+        - tool_name (str): Name of the tool to be executed.
+        - inputs (dict): Dictionary containing inputs for the tool.
+
+        Returns:
+        - Tuple containing output of the tool and metadata dictionary.
+        """
+        tool = self.get_tool(tool_name)
 
         # Check if the tool requires inputs.
         if tool['needs_inputs']:
@@ -293,20 +439,7 @@ class Tools():
             if inputs:
                 # Try to execute the tool with the provided inputs.
                 try:
-                    if tool['needs_user_db'] and tool['uses_gpt']:
-                        tool_result, token_usage = await tool['function_name'](**inputs, user=self.user)
-                        if token_usage:
-                            self.save_token_usage(token_usage)
-                        
-                    elif tool['needs_user_db']:
-                        tool_result = await tool['function_name'](**inputs, user=self.user)
-                    
-                    elif tool['uses_gpt']:
-                        tool_result, token_usage = await tool['function_name'](**inputs)
-                        if token_usage:
-                            self.save_token_usage(token_usage)
-                    else:
-                        tool_result = tool['function_name'](**inputs)
+                    tool_result = await self.call_tool(tool, inputs)
                         
                     metadata = {
                         "type": "tool_result",
@@ -332,24 +465,11 @@ class Tools():
                     return tool_result, metadata
             else:
                 # If inputs are not provided, ask for inputs.
-                tool_result, metadata = self.ask_for_inputs(tool_name = tool['name'], missing_inputs = tool["inputs"])
+                tool_result, metadata = self.ask_for_inputs(tool_name = tool['name'], missing_inputs = list(tool["inputs"]))
                 return tool_result, metadata
         else:
             # If the tool does not need inputs, execute the tool without inputs.
-            if tool['needs_user_db'] and tool['uses_gpt']:
-                tool_result, token_usage = await tool['function_name'](**inputs, user=self.user)
-                if token_usage:
-                    self.save_token_usage(token_usage)
-        
-            elif tool['needs_user_db']:
-                tool_result = await tool['function_name'](**inputs, user=self.user)
-                
-            elif tool['uses_gpt']:
-                tool_result, token_usage = await tool['function_name'](**inputs)
-                if token_usage:
-                    self.save_token_usage(token_usage)
-            else:
-                tool_result = tool['function_name']()
+            tool_result = await self.call_tool(tool, {})
                 
             metadata = {
                 "type": "tool_result",
@@ -357,7 +477,28 @@ class Tools():
                 }
             return tool_result, metadata
 
-    async def handle_tools(self, extract_inputs: bool, user_message: str, chat_history: list, messages_for_input_extraction: int) -> tuple[str, dict] | tuple[None, None]:
+    async def call_tool(self, tool, inputs: dict):
+        """
+        Calls the tool function through the tool executor, which runs sync tools in the thread pool and applies
+        the tool timeout and concurrency limit. Passes the user to tools that need user db and saves tokens used by GPT tools.
+
+        Returns:
+        - Result of the tool.
+        """
+        kwargs = dict(inputs)
+        if tool['needs_user_db']:
+            kwargs['user'] = self.user
+
+        tool_result = await tool_executor.run(tool, kwargs)
+        if tool['uses_gpt']:
+            tool_result, token_usage = tool_result
+            if token_usage:
+                self.save_token_usage(token_usage)
+
+        return tool_result
+
+    async def handle_tools(self, extract_inputs: bool, user_message: str, chat_history: list, messages_for_input_extraction: int,
+                           previous_tools: tuple[str, ...] = ()) -> tuple[str, dict] | tuple[None, None]:
         """
         Handle the extraction and execution of tools based on user message and chat history.
 
@@ -366,50 +507,79 @@ class Tools():
         - user_message (str): Current user message.
         - chat_history (list): List of previous chat messages.
         - messages_for_input_extraction (int): Number of messages to consider for input extraction.
+        - previous_tools (tuple): Tools used or requested in the previous turn, to predict the tool.
 
         Returns:
         - Tuple containing output of the tool and metadata dictionary.
         """
 
-        # Extract tools from the user's message and previous chat message if it exsists.
-        if len(chat_history) >= 1: previous_message = chat_history[-1]
-        else: previous_message = None
-        
-        extracted_tools = await self.extract_tools(user_message = user_message, previous_message= previous_message)
-        # If tool detected
-        if extracted_tools:
-            # Check if the first extracted tool needs inputs.
-            if self.get_tool(extracted_tools[0])['needs_inputs']:
-                # If inputs extraction is on.
-                if extract_inputs is True:
-                    # Extract inputs.
-                    inputs, missing_inputs = await self.extract_inputs(
-                        tool_name = extracted_tools[0],
-                        chat_history = '\n'.join(chat_history[:messages_for_input_extraction])+ "\nLast user message: " + user_message)
-                    # If there are missing inputs, create message and metadata asking for inputs.
-                    if missing_inputs:
-                        tool_result, metadata = self.ask_for_inputs(tool_name = extracted_tools[0], missing_inputs = missing_inputs, inputs = inputs)
-                        return tool_result, metadata
-                    # If inputs are passed, run the tools.
-                    if inputs is not None:
-                        tool_result, metadata = await self.run_tools(tools_list = extracted_tools, inputs = inputs)
-                        return tool_result, metadata
-                # If inputs extraction turned off, create message and metadata asking for inputs.
-                else:
-                    tool = self.get_tool(extracted_tools[0])
-                    inputs = None
-                    missing_inputs = tool['required_inputs']
-                    
-                    tool_result, metadata = self.ask_for_inputs(extracted_tools[0], missing_inputs, inputs)
-                    return tool_result, metadata
-            # If the tool does not need inputs, run the tool without inputs.
-            else:
-                tool_result, metadata = await self.run_tools(extracted_tools, inputs=None)
-                return tool_result, metadata
+        # Extract tools from the user's message and previous chat message if it exsists,
+        # inputs of the predicted tool are extracted at the same time.
+        extracted_tools = await self.extract_tools_speculatively(
+            user_message = user_message, chat_history = chat_history, extract_inputs = extract_inputs,
+            messages_for_input_extraction = messages_for_input_extraction, previous_tools = previous_tools
+            )
+
+        return await self.handle_extracted_tools(
+            extracted_tools = extracted_tools, extract_inputs = extract_inputs, user_message = user_message,
+            chat_history = chat_history, messages_for_input_extraction = messages_for_input_extraction
+            )
+
+    async def handle_extracted_tools(self, extracted_tools: list[str] | None, extract_inputs: bool, user_message: str,
+                                     chat_history: list, messages_for_input_extraction: int) -> tuple[str, dict] | tuple[None, None]:
+        """
+        Extract inputs for already extracted tools and execute them or ask user for missing inputs.
+
+        Args:
+        - extracted_tools (list): Tools names returned by 'extract_tools' or None if no tools were found.
+        - extract_inputs (bool): Boolean indicating whether to extract inputs for tools.
+        - user_message (str): Current user message.
+        - chat_history (list): List of previous chat messages.
+        - messages_for_input_extraction (int): Number of messages to consider for input extraction.
+
+        Returns:
+        - Tuple containing output of the tool and metadata dictionary.
+        """
         # If no tools are detected, return None, None.
-        else:
+        if not extracted_tools:
             if TOOLS_DEBUG: print("No tools detected!")
             return None, None
+
+        chat_context = input_extraction_context(user_message, chat_history, messages_for_input_extraction)
+
+        async def prepare_inputs(tool_name):
+            tool = self.get_tool(tool_name)
+            # Tool without inputs runs without inputs.
+            if not tool['needs_inputs']:
+                return {}, []
+            # If inputs extraction turned off, ask user for inputs.
+            if extract_inputs is not True:
+                return None, list(tool['required_inputs'])
+            # Inputs may already be extracted by 'extract_tools_speculatively'.
+            speculation = self.speculative_inputs.pop(tool_name, None)
+            if speculation is not None:
+                inputs, missing_inputs = await speculation
+            else:
+                inputs, missing_inputs = await self.extract_inputs(tool_name = tool_name, chat_history = chat_context)
+            # Tool that needs inputs is not executed without them.
+            if inputs is None and not missing_inputs:
+                missing_inputs = list(tool['inputs'])
+            return inputs, missing_inputs
+
+        # Inputs of all extracted tools are extracted concurrently.
+        extracted_tools = list(dict.fromkeys(extracted_tools))
+        try:
+            prepared = await asyncio.gather(*(prepare_inputs(tool_name) for tool_name in extracted_tools))
+        finally:
+            self.cancel_speculative_inputs()
+
+        # Tools with all inputs are executed together, others ask user for missing inputs.
+        tool_result, metadata = await self.run_tools(
+            tools_list = extracted_tools,
+            inputs = {tool_name: inputs for tool_name, (inputs, missing_inputs) in zip(extracted_tools, prepared)},
+            missing_inputs = {tool_name: missing_inputs for tool_name, (inputs, missing_inputs) in zip(extracted_tools, prepared)}
+            )
+        return tool_result, metadata
     
     async def describe_exception(self, tool: dict, inputs: dict, exeption: str):
         """
@@ -437,7 +607,7 @@ class Tools():
         # Create a prompt with details about the exception and inputs.
         prompt = dedent(f"""\
         Exeeption: {exeption}
-        Tool: {tool}
+        Tool: {dict(tool)}
         Inputs that tool needs: {tool['inputs_description']}
         Inputs passed: {inputs}""")
 
@@ -453,11 +623,93 @@ class Tools():
     
     def save_token_usage(self, token_usage: dict):
         for key in self.total_tokens_used:
-            self.total_tokens_used[key] += token_usage[key]
+            self.total_tokens_used[key] += token_usage.get(key, 0)
             
     def all_tools_names(self) -> list:
-        tool_names = []
-        for tool in self.tools_list:
-            tool_names.append(tool['name'])
-   
-        return tool_names
\ No newline at end of file
+        return list(self.registry.names)
+
+def input_extraction_context(user_message: str, chat_history: list, messages_for_input_extraction: int) -> str:
+    """
+    Conversation passed to 'extract_inputs' and 'extract_tool_calls', the latest 'messages_for_input_extraction' messages.
+    """
+    # [-0:] would be the whole history.
+    messages = chat_history[-messages_for_input_extraction:] if messages_for_input_extraction > 0 else []
+    return '\n'.join(messages) + "\nLast user message: " + user_message
+
+def metadata_tools(metadata: dict | None) -> tuple[str, ...]:
+    """
+    Returns names of tools executed or requesting inputs in the tools metadata, to predict tools of the next turn.
+    """
+    if not metadata or 'tool' not in metadata:
+        return ()
+    tools = metadata.get('tools') or [metadata]
+    tools = [*tools, *metadata.get('input_requests', [])]
+    return tuple(dict.fromkeys(tool['tool'] for tool in tools if 'tool' in tool))
+
+def validate_inputs(tool, arguments: dict) -> tuple[dict[str, str | None], list[str]]:
+    """
+    Takes values of the tool inputs from arguments extracted by GPT.
+
+    Returns:
+    - Tuple of inputs dictionary, where empty inputs are None, and list of missing required inputs.
+    """
+    inputs = {}
+    missing_inputs = []
+    # Iterate over the expected inputs for the tool.
+    for input in tool['inputs']:
+        # Get the value of the valid input from the parsed response.
+        response_input = arguments.get(input)
+        
+        # If the input is found in the response and is not empty, add it to the inputs dictionary.
+        if isinstance(response_input, (str, int, float)) and str(response_input).strip() != '':
+            inputs[input] = str(response_input)
+
+        # If the input is not found, check if it is a required input.
+        else:
+            # If input is required, add the input to the list of missing inputs.
+            if input in tool['required_inputs']:
+                if TOOLS_DEBUG: print('Required input not found! -', input)
+                missing_inputs.append(input)
+                    
+            # Set the input value to None if input is optional.
+            inputs[input] = None
+
+    return inputs, missing_inputs
+
+def combine_tools_results(results: list[tuple[str | None, dict]]) -> tuple[str | None, dict]:
+    """
+    Combines results of several tools into one (tool_result, metadata) tuple. Result of a single tool is returned as is.
+
+    - If any tool was executed, metadata type is 'tool_result' and results of all executed tools are combined
+    for the response. Metadata of every tool is in 'tools'.
+    - Otherwise the first tool exception, or the first input request if no tool failed, is the main metadata
+    and descriptions of all exceptions are the tool result, so they are sent to the user.
+    - Other input requests and tool exceptions are in 'input_requests' of the metadata, so user can provide their inputs.
+    """
+    if len(results) == 1:
+        return results[0]
+
+    executed = [(tool_result, metadata) for tool_result, metadata in results if metadata['type'] == 'tool_result']
+    # Exceptions go first, the result of an input request isn't sent to the user.
+    requests = sorted(((tool_result, metadata) for tool_result, metadata in results if metadata['type'] != 'tool_result'),
+                      key=lambda request: request[1]['type'] != 'tool_exeption')
+    # Descriptions of tools exceptions are passed to the user with the results.
+    exceptions = '\n'.join(f"Tool {metadata['tool']} failed: {tool_result}" for tool_result, metadata in requests if metadata['type'] == 'tool_exeption')
+
+    if executed:
+        tool_result = '\n'.join(f"Result of tool {metadata['tool']}:\n{tool_result}" for tool_result, metadata in executed)
+        if exceptions:
+            tool_result += '\n' + exceptions
+        metadata = {
+            "type": "tool_result",
+            "tool": ', '.join(metadata['tool'] for tool_result, metadata in executed),
+            "tools": [metadata for tool_result, metadata in results],
+            "input_requests": [metadata for tool_result, metadata in requests],
+        }
+        return tool_result, metadata
+
+    tool_result, metadata = requests[0]
+    metadata = {**metadata, "input_requests": [metadata for tool_result, metadata in requests[1:]]}
+    if exceptions:
+        tool_result = exceptions
+    return tool_result, metadata
@@ -3,6 +3,7 @@ from textwrap import dedent
 import os
 import json
 
+from .prompt_budget import PromptBudget, count_messages_tokens
 from .settings import PROFILE_DEBUG
 
 class Profile:
@@ -33,6 +34,8 @@ class Profile:
             self.profile[str(i)] = entry
 
         self.gpt_model = gpt_model
+        # Prompt tokens of the last profile request counted before it was sent.
+        self.prompt_tokens = None
 
     async def generate_user_profile(self, chat_history: list[str], user_message: str) -> tuple [dict|None, dict|None]:
         """
@@ -65,16 +68,22 @@ class Profile:
             "2": "Changed text describing the second element"
         }""")
 
+        # Profile is always sent whole, because entries are changed by their numbers. Chat history takes the rest of the budget.
+        budget = PromptBudget('Profiler', self.gpt_model)
+        budget.reserve(system_message, json.dumps(self.profile), user_message)
+        chat_history = budget.fit_items(chat_history, keep_end = True)
+
         # Compose the prompt for profile generation
         prompt = ("PREVIOUS USER PROFILE:|\n" + json.dumps(self.profile) + '|\n'
         + "CHAT HISTORY:|\n" 
         + '\n'.join(chat_history) + '|\n'
         + f"Last user message: {user_message}\n"
         + 'Remember format: {"number": "Changed text of this element", "number": "Changed text of this element"}')
+        self.prompt_tokens = count_messages_tokens(self.gpt_model, system_message, prompt)
 
         response, token_usage = await openai_chat_request(prompt=prompt, system=system_message, temperature=0.8, model=self.gpt_model)
         
-        if PROFILE_DEBUG: print(f"{'_'*20}\n- Profiler:\nSystem:\n{system_message}\nPrompt\n{prompt}\nGenerated user prifile changes:\n{response}\n{'_'*20}")
+        if PROFILE_DEBUG: print(f"{'_'*20}\n- Profiler:\nSystem:\n{system_message}\nPrompt\n{prompt}\nPrompt tokens: {self.prompt_tokens} of {budget.budget}\nGenerated user prifile changes:\n{response}\n{'_'*20}")
 
         # Process and validate the response
         if response and response.strip() != '':
@@ -0,0 +1,93 @@
+import asyncio, sys
+from typing import Coroutine
+
+from .assistant.settings import POST_RESPONSE_MAX_CONCURRENT_WRITES, POST_RESPONSE_SHUTDOWN_TIMEOUT, CONSUMERS_DEBUG
+
+class PostResponseQueue():
+    """
+    Per-process queue for database writes that are done after the response is sent to the user
+    (profile and journal updates, costs and balance transactions).
+
+    - Writes of one user are committed in the order they were submitted.
+    - Writes of different users run concurrently, limited by 'max_concurrency'.
+    - 'flush' waits for pending writes, consumers call it on disconnect. Server cancels consumers on
+    shutdown without calling disconnect, so 'install_shutdown_flush' and 'lifespan' flush all users
+    before the process exits.
+    """
+    def __init__(self, max_concurrency: int):
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # Last submitted task of every user, next task of the user waits for it.
+        self.user_tails: dict[int, asyncio.Task] = {}
+
+    def submit(self, user_id: int, write: Coroutine) -> asyncio.Task:
+        """
+        Schedules a write coroutine to run after all previously submitted writes of the user.
+        """
+        previous = self.user_tails.get(user_id)
+        task = asyncio.create_task(self._run(previous, write))
+        self.user_tails[user_id] = task
+
+        def forget(task):
+            if self.user_tails.get(user_id) is task:
+                del self.user_tails[user_id]
+        task.add_done_callback(forget)
+
+        return task
+
+    async def _run(self, previous: asyncio.Task|None, write: Coroutine):
+        # Failed previous write should not block the next ones, so only wait for its completion.
+        if previous is not None:
+            await asyncio.wait([previous])
+
+        async with self.semaphore:
+            try:
+                await write
+            except Exception as e:
+                print(f"Error occurred while saving data after response: {e}")
+
+    async def flush(self, user_id: int = None, timeout: float = None):
+        """
+        Waits until pending writes of the user, or of all users if 'user_id' is None, are committed.
+        Writes that are not committed in 'timeout' seconds are left running.
+        """
+        if user_id is not None:
+            tasks = [self.user_tails[user_id]] if user_id in self.user_tails else []
+        else:
+            tasks = list(self.user_tails.values())
+
+        if tasks:
+            if CONSUMERS_DEBUG: print(f"Flushing {len(tasks)} pending post response writes")
+            done, pending = await asyncio.wait(tasks, timeout=timeout)
+            if pending:
+                print(f"{len(pending)} post response writes were not committed in {timeout} seconds")
+
+post_response_queue = PostResponseQueue(POST_RESPONSE_MAX_CONCURRENT_WRITES)
+
+def install_shutdown_flush():
+    """
+    Flushes the queue before the server stops. Daphne runs on the Twisted reactor and doesn't send
+    lifespan events, it waits for deferreds returned by 'before shutdown' triggers instead.
+    Does nothing if the process doesn't run on a Twisted reactor.
+    """
+    if 'twisted.internet.reactor' not in sys.modules:
+        return
+    from twisted.internet import reactor, defer
+
+    def flush():
+        if CONSUMERS_DEBUG: print("Flushing post response writes before shutdown")
+        return defer.Deferred.fromFuture(asyncio.ensure_future(post_response_queue.flush(timeout=POST_RESPONSE_SHUTDOWN_TIMEOUT)))
+
+    reactor.addSystemEventTrigger('before', 'shutdown', flush)
+
+async def lifespan(scope, receive, send):
+    """
+    ASGI lifespan application for servers that send lifespan events, flushes the queue on shutdown.
+    """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await post_response_queue.flush(timeout=POST_RESPONSE_SHUTDOWN_TIMEOUT)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -1,5 +1,6 @@
 import json, io, math
 
+from contextlib import aclosing
 from decimal import Decimal
 
 from channels.generic.websocket import AsyncWebsocketConsumer
@@ -8,12 +9,14 @@ from .assistant.responder import Responder
 from .assistant.settings import *
 from .assistant.emotional_journal import EmotionalJournal
 from .assistant.moderation import Moderation
-from .assistant.helpers import openai_audio_transcription
+from .assistant.tools import metadata_tools
+from .assistant.helpers import openai_audio_transcription, prompt_cache_stats, ChatStream
 
-from .utils import get_chat_history, Encryption
+from .utils import get_chat_history, update_chat_summary, Encryption, UserContext
+from .background import post_response_queue
 
 from .models import Message, Chat, User_profile, User_settings, User_emotional_journal, User_balance, Balance_transaction
-from django.utils import timezone
+from django.db.models import F
 from datetime import date
 from time import time
 
@@ -25,7 +28,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
     WebSocket consumer for handling chat interactions.
 
     Attributes:
-        None
+        context (UserContext): Cached database objects of the connected user.
 
     Methods:
         connect: Handles the initiation of a connection.
@@ -37,7 +40,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         - Retrieves the user from the connection scope.
         - Checks if the user is authenticated.
         - Accepts the connection if authenticated.
-        - Retrieves the chat object for the user.
+        - Loads the user context with all objects needed to handle messages.
         - Gets the previous chat history from the database.
         - Sends the chat history to the client.
         """
@@ -53,12 +56,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Accept the connection
         await self.accept()
 
-        # Retrieve the chat object for the user
-        chat = await Chat.objects.aget(user=user)
+        # Load everything needed for chat turns once per connection
+        self.context = await UserContext.load(user)
 
         # Get the previous chat history
         chat_history = await get_chat_history(
-            chat = chat,
+            chat = self.context.chat,
             limit = CHAT_MESSAGES_TO_LOAD_PER_REQUEST,
             for_socket = True,
             reverse=True
@@ -95,11 +98,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.close(close_code='1006')
             print("Unauthenticated user sent payload!", text_data, user)
             return
+        context = self.context
         # Handle media or simple text data payloads.
         image = None
         if bytes_data:
             try:
-                user_balance = await User_balance.objects.aget(user=user)
+                user_balance = await context.refresh_balance()
                 if user_balance.balance < 0.01:
                     await self.send(text_data=json.dumps({
                             'type':'notification',
@@ -120,7 +124,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                         audio.name = "voice.webm"
                         # Transcribe voice message and calculate cost.
                         text, duration = await openai_audio_transcription(audio, AUDIO_TRANSCRIPTION_MODEL)
-                        await calculate_audio_cost(user_balance, duration)
+                        post_response_queue.submit(user.id, save_transactions(user_balance, calculate_audio_cost(user_balance, duration)))
                         
                         if CONSUMERS_DEBUG: print(f"Received audio data, with duration: {duration} and translated as: {text}")     
                     except Exception as e:
@@ -168,9 +172,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Process user profile request
         if text_data_json.get('type') == 'user_profile':
 
-            # Get all information related to user profile from DB
-            user_profile = await User_profile.objects.aget(user=user)
-            settings = await User_settings.objects.aget(user=user)
+            user_profile = context.profile
+            settings = context.settings
 
             if CONSUMERS_DEBUG:print(f"{'_'*20}\nProfile request sent\nProfile:\n{encryption.decrypt(user_profile.content)}\n{'_'*20}")
             # Send user profile data to the client
@@ -208,7 +211,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 return
             
             moder = Moderation()
-            flagged, category = moder.moderate(profile)
+            flagged, category = await moder.moderate(profile)
             if flagged:
                 if CONSUMERS_DEBUG: print("Flagged: ", flagged)
                 await self.send(text_data=json.dumps({
@@ -219,9 +222,9 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }))
                 return
             
-            user_profile = await User_profile.objects.aget(user=user)
+            user_profile = context.profile
             user_profile.content = encryption.encrypt(profile)
-            await user_profile.asave()
+            await user_profile.asave(update_fields=['content'])
 
             await self.send(text_data=json.dumps({
                 'type':'notification',
@@ -275,12 +278,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }))
                 return
             
-            user_settings = await User_settings.objects.aget(user=user)
+            user_settings = context.settings
             if profiler_gpt_model != None:
                 user_settings.profiler_gpt_model = profiler_gpt_model
             user_settings.messages_for_profile_update = msg_for_update
             user_settings.messages_till_profile_update = msg_till_update
-            await user_settings.asave()
+            await user_settings.asave(update_fields=['profiler_gpt_model', 'messages_for_profile_update', 'messages_till_profile_update'])
 
             await self.send(text_data=json.dumps({
                 'type':'notification',
@@ -299,7 +302,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 limit = EMOTIONAL_JOURNALS_TO_LOAD_PER_REQUEST,
                 for_socket = True)
 
-            settings = await User_settings.objects.aget(user=user)
+            settings = context.settings
 
             if CONSUMERS_DEBUG:print(f"{'_'*20}\nJournal request sent\nJournals:\n{journals}\n{'_'*20}")
             
@@ -377,12 +380,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }))
                 return
             
-            user_settings = await User_settings.objects.aget(user=user)
+            user_settings = context.settings
             if journal_gpt_model != None:
                 user_settings.journal_gpt_model = journal_gpt_model
             user_settings.messages_for_journal_update = msg_for_update
             user_settings.messages_till_journal_update = msg_till_update
-            await user_settings.asave()
+            await user_settings.asave(update_fields=['journal_gpt_model', 'messages_for_journal_update', 'messages_till_journal_update'])
 
             await self.send(text_data=json.dumps({
                 'type':'notification',
@@ -396,13 +399,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Process request for responder settings
         if text_data_json.get('type') == 'user_responder':
 
-            settings = await User_settings.objects.aget(user=user)
+            settings = context.settings
 
             await self.send(text_data=json.dumps({
                 'type':'user_responder',
                 'gpt_model': settings.responder_gpt_model,
                 'responder_personality': settings.responder_personality,
-                'messages_for_input_extraction': settings.messages_for_input_extraction
+                'messages_for_input_extraction': settings.messages_for_input_extraction,
+                'native_tool_calling': settings.native_tool_calling
             }))
 
             return
@@ -413,6 +417,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 responder_gpt_model = text_data_json['responder_gpt_model']
                 responder_personality = text_data_json['responder_personality']
                 msg_for_input = int(text_data_json['messages_for_input_extraction'])
+                native_tool_calling = bool(text_data_json.get('native_tool_calling', context.settings.native_tool_calling))
 
             except Exception as e:
                 await self.send(text_data=json.dumps({
@@ -442,7 +447,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 return
             
             moder = Moderation()
-            flagged, category = moder.moderate(responder_personality)
+            flagged, category = await moder.moderate(responder_personality)
             if flagged:
                 if CONSUMERS_DEBUG: print("Flagged: ", flagged)
                 await self.send(text_data=json.dumps({
@@ -453,13 +458,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 }))
                 return
             
-            settings = await User_settings.objects.aget(user=user)
+            settings = context.settings
             if responder_gpt_model != None:
                 settings.responder_gpt_model = responder_gpt_model
             settings.responder_personality = responder_personality
             settings.messages_for_input_extraction = msg_for_input
+            settings.native_tool_calling = native_tool_calling
 
-            await settings.asave()
+            await settings.asave(update_fields=['responder_gpt_model', 'responder_personality', 'messages_for_input_extraction', 'native_tool_calling'])
 
             await self.send(text_data=json.dumps({
                 'type':'notification',
@@ -473,7 +479,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         # Process request to load more user emotional journals
         if text_data_json.get('type') == 'user_transactions':
 
-            user_balance = await User_balance.objects.aget(user=user)
+            user_balance = context.balance
             user_transactions = []
             async for transaction in Balance_transaction.objects.order_by('-datetime').filter(balance = user_balance):
                 formated_data = {
@@ -494,7 +500,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
         if text_data_json.get('type') == 'inputs':
             if CONSUMERS_DEBUG:print(f"{'_'*20}\nInputs recived by socket:{text_data_json}{'_'*20}")
 
-            user_balance = await User_balance.objects.aget(user=user)
+            user_balance = await context.refresh_balance()
             if user_balance.balance < 0.01:
                 await self.send(text_data=json.dumps({
                         'type':'notification',
@@ -511,16 +517,12 @@ class ChatConsumer(AsyncWebsocketConsumer):
             tool = text_data_json['tool']
             inputs = text_data_json['inputs']
 
-            user_settings = await User_settings.objects.aget(user=user)
-            user_profile = await User_profile.objects.aget(user=user)
-            
-            current_date = timezone.now().date()
-            user_emotional_journal, journal_created = await User_emotional_journal.objects.aget_or_create(user=user, date=current_date)
-                
-            chat = await Chat.objects.aget(user=user)
+            user_settings = context.settings
+            user_profile = context.profile
+            user_emotional_journal = await context.get_emotional_journal()
 
             chat_history = await get_chat_history(
-                chat=chat,
+                chat=context.chat,
                 limit=MESSAGES_TO_PASS_TO_ASSISTANT,
                 reverse=True
             )
@@ -540,38 +542,46 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 user_profile = encryption.decrypt(user_profile.content),
                 emotional_journal = emotional_journal,
                 assistant_settings = assistant_settings,
-                user=user
+                user=user,
+                chat_summary = context.chat_summary()
             )
 
-            response, metadata = await responder.handle_user_inputs(tool = tool, inputs = inputs)
-
-            await calculate_cost(user_balance, responder.total_tokens_used, assistant_settings)
-
-            if metadata:
-                if metadata.get('type') == "input_request":
-                    if CONSUMERS_DEBUG: print(f"{'_'*20}\nInput request\nMetadata:\n{metadata}\n{'_'*20}")
+            try:
+                response, metadata = await responder.handle_user_inputs(tool = tool, inputs = inputs, stream = STREAM_RESPONSES)
+            except Exception as e:
+                print(f"Error occurred while handling user inputs: {e}")
+                # Tokens spent before the failure are billed.
+                await self.save_after_response(calculate_cost(user_balance, responder.total_tokens_used, assistant_settings))
+                await self.send_error_response()
+                return
+            context.previous_tools = metadata_tools(metadata) or (tool,)
 
-                    if metadata.get('type') == "tool_exeption":
-                        await self.send(text_data=json.dumps({
-                            'type': 'ai_response',
-                            'ai_message': response
-                        }))
-                        metadata['type'] = "input_request"
-                        
-                    await self.send(text_data=json.dumps(metadata))
+            # Same handling as in the message path, failed tool is sent with its error and its input form.
+            input_requests = metadata.pop('input_requests', []) if metadata else []
+            if metadata and (metadata.get('type') == "input_request" or metadata.get('type') == "tool_exeption"):
+                if CONSUMERS_DEBUG: print(f"{'_'*20}\nInput request\nMetadata:\n{metadata}\n{'_'*20}")
 
-                    return
-                else:
-                    if CONSUMERS_DEBUG:print(f"{'_'*20}\nResponse with recived inputs:\n{response}\n- Metadata:\n{metadata}\n{'_'*20}")
+                if metadata.get('type') == "tool_exeption":
                     await self.send(text_data=json.dumps({
-                        'type':'ai_response',
+                        'type': 'ai_response',
                         'ai_message': response
                     }))
+                    metadata['type'] = "input_request"
 
-                    new_bot_message = Message(chat = chat, text = encryption.encrypt(response), is_bot = True)
-                    await new_bot_message.asave()
+                await self.send(text_data=json.dumps(metadata))
 
-                    return
+            else:
+                response = await self.send_ai_response(responder, response)
+                if CONSUMERS_DEBUG:print(f"{'_'*20}\nResponse with recived inputs:\n{response}\n- Metadata:\n{metadata}\n{'_'*20}")
+
+                if response:
+                    await context.save_message(response, is_bot = True)
+                else:
+                    await self.send_error_response()
+
+            await self.send_input_requests(input_requests)
+
+            await self.save_after_response(calculate_cost(user_balance, responder.total_tokens_used, assistant_settings))
             return
         # Process request to load more chat history
         if text_data_json.get('type') == 'load_more_chat':
@@ -581,9 +591,8 @@ class ChatConsumer(AsyncWebsocketConsumer):
             except:
                 return
 
-            chat = await Chat.objects.aget(user=user)
             chat_history = await get_chat_history(
-                chat = chat,
+                chat = context.chat,
                 limit = CHAT_MESSAGES_TO_LOAD_PER_REQUEST,
                 offset = offset,
                 for_socket = True,
@@ -601,7 +610,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
         
         # Check user balance before responding
-        user_balance = await User_balance.objects.aget(user=user)
+        user_balance = await context.refresh_balance()
         if user_balance.balance < 0.01:
             await self.send(text_data=json.dumps({
                     'type':'notification',
@@ -635,28 +644,23 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'type':'loading_response'
             }))
         
-        chat = await Chat.objects.aget(user=user)
-
-        current_date = timezone.now().date()
-
         chat_history = await get_chat_history(
-            chat = chat,
+            chat = context.chat,
             limit = MESSAGES_TO_PASS_TO_ASSISTANT,
             reverse=True
         )
 
-        new_message = Message(chat=chat, text=encryption.encrypt(user_message))
-        await new_message.asave()
+        await context.save_message(user_message)
 
-        message_count = await Message.objects.filter(chat=chat).acount()
+        message_count = context.message_count
         if CONSUMERS_DEBUG: print("Message count:", message_count)
 
-        user_profile_object, profile_created = await User_profile.objects.aget_or_create(user=user)
+        user_profile_object = context.profile
         user_profile = encryption.decrypt(user_profile_object.content)
         if CONSUMERS_DEBUG: print("User profile: ", user_profile)
 
-        user_settings = await User_settings.objects.aget(user=user)
-        user_emotional_journal, journal_created = await User_emotional_journal.objects.aget_or_create(user=user, date=current_date)
+        user_settings = context.settings
+        user_emotional_journal = await context.get_emotional_journal()
 
         emotional_journal = EmotionalJournal(
             journal = user_emotional_journal.journal,
@@ -676,17 +680,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
             user_settings.messages_for_input_extraction,
             user_settings.messages_till_journal_update,'\n', '_'*20
         )
-        assistant_settings = AssistantSettings(
-            responder_gpt_model = user_settings.responder_gpt_model,
-            responder_personality = user_settings.responder_personality,
-            profiler_gpt_model = user_settings.profiler_gpt_model,
-            journal_gpt_model = user_settings.journal_gpt_model,
-            messages_for_profile_update = user_settings.messages_for_profile_update,
-            messages_till_profile_update = user_settings.messages_till_profile_update,
-            messages_for_input_extraction = user_settings.messages_for_input_extraction,
-            messages_till_journal_update = user_settings.messages_till_journal_update,
-            messages_for_journal_update = user_settings.messages_for_journal_update
-        )
+        assistant_settings = context.assistant_settings()
         responder = Responder(
             user_profile = user_profile,
             chat_history = chat_history,
@@ -694,19 +688,29 @@ class ChatConsumer(AsyncWebsocketConsumer):
             emotional_journal=emotional_journal,
             assistant_settings = assistant_settings,
             user=user,
+            chat_summary = context.chat_summary()
         )
-        response = await responder.handle_user_message(
-            user_message = user_message,
-            use_tools = use_tools,
-            extract_inputs = extract_inputs,
-            image=image
-        )
+        try:
+            response = await responder.handle_user_message(
+                user_message = user_message,
+                use_tools = use_tools,
+                extract_inputs = extract_inputs,
+                image=image,
+                stream=STREAM_RESPONSES,
+                previous_tools=context.previous_tools
+            )
+        except Exception as e:
+            # Failed moderation stops the pipeline, no response is generated for unchecked message.
+            print(f"Error occurred while handling user message: {e}")
+            # Tokens spent before the failure are billed.
+            await self.save_after_response(calculate_cost(user_balance, responder.total_tokens_used, assistant_settings))
+            await self.send_error_response()
+            return
         text, metadata, profile, journal = response
+        context.previous_tools = metadata_tools(metadata)
 
-        if CONSUMERS_DEBUG: print("Responder used tokens: ", responder.total_tokens_used)
-        
-        await calculate_cost(user_balance, responder.total_tokens_used, assistant_settings)
-                    
+        # Tools that were extracted together with other tools and are missing inputs.
+        input_requests = metadata.pop('input_requests', []) if metadata else []
         if metadata:
             if metadata.get('type') == "input_request" or metadata.get('type') == "tool_exeption":
                 if CONSUMERS_DEBUG: print(f"{'_'*20}\nSending input request:\n{json.dumps(metadata, indent=2)}\n{'_'*20}")
@@ -719,43 +723,31 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     metadata['type'] = "input_request"
                     
                 await self.send(text_data=json.dumps(metadata))
+                await self.send_input_requests(input_requests)
 
-                if profile:
-                    if len(profile) >= MAX_PROFILE_LENGTH:
-                        await self.send(text_data=json.dumps({
-                            'type':'notification',
-                            'type_of_notification': 'error',
-                            'header': 'Profile',
-                            'message': 'Assitant tried to update profile, but it was too long! Please, delete or shorten some entries for further updates.'
-                        }))
-                        return
-                    else:   
-                        user_profile_object.content = encryption.encrypt(json.dumps(profile))
-                        await user_profile_object.asave()
-
-                if journal:
-                    journal_text, updates_count = journal
-
-                    user_emotional_journal.journal = json.dumps(journal_text)
-                    user_emotional_journal.updates_count = updates_count
-
-                    await user_emotional_journal.asave()
-                    
+                await self.save_after_response(
+                    calculate_cost(user_balance, responder.total_tokens_used, assistant_settings),
+                    profile = profile,
+                    journal = journal
+                )
                 return
         
         if text:
-            await self.send(text_data=json.dumps({
-                'type': 'ai_response',
-                'ai_message': text
-            }))
-            new_bot_message = Message(chat=chat, text=encryption.encrypt(text), is_bot=True)
-            await new_bot_message.asave()
+            text = await self.send_ai_response(responder, text)
+
+        if text:
+            await context.save_message(text, is_bot=True)
         else:
-            await self.send(text_data=json.dumps({
-                'type': 'ai_response',
-                'ai_message': "Apologies, the I currently experiencing some technical difficulties. Please try again later. Thank you for your patience!"
-            }))
-        
+            await self.send_error_response()
+        await self.send_input_requests(input_requests)
+
+        if CONSUMERS_DEBUG: print("Responder used tokens: ", responder.total_tokens_used)
+        await self.save_after_response(
+            calculate_cost(user_balance, responder.total_tokens_used, assistant_settings),
+            profile = profile,
+            journal = journal
+        )
+
         # To measure systems response generaing speed. 
         if CONSUMERS_DEBUG: 
             response_sent = time()
@@ -771,7 +763,80 @@ class ChatConsumer(AsyncWebsocketConsumer):
             print('Responder, Tools, Recommender model:', assistant_settings.responder_gpt_model)
             print('Profiler model:', assistant_settings.profiler_gpt_model)
             print('Journal model:', assistant_settings.journal_gpt_model)
+            print('Prompt cache:', prompt_cache_stats.stats())
+
+        return
         
+    async def send_ai_response(self, responder: Responder, response: str|ChatStream) -> str|None:
+        """
+        Sends the assistant response to the client.
+
+        Streamed response is sent in 'ai_response_chunk' frames while it is generated and then
+        as a whole in the final 'ai_response' frame.
+
+        Returns:
+            Full text of the response, or None if nothing was generated or the stream failed.
+        """
+        if isinstance(response, ChatStream):
+            try:
+                # Closing the generator records usage of the stream even if sending failed.
+                async with aclosing(responder.stream_response(response)) as deltas:
+                    async for delta in deltas:
+                        await self.send(text_data=json.dumps({
+                            'type': 'ai_response_chunk',
+                            'ai_message_chunk': delta
+                        }))
+            except Exception as e:
+                print(f"Error occurred while streaming response: {e}")
+
+            # Truncated response isn't saved, the streamed part is replaced by the error response of the caller.
+            if not response.finished:
+                return None
+            response = response.response
+            
+            if not response:
+                return None
+
+        await self.send(text_data=json.dumps({
+            'type': 'ai_response',
+            'ai_message': response
+        }))
+        return response
+
+    async def send_error_response(self):
+        """
+        Sends the response used when no response could be generated.
+        """
+        await self.send(text_data=json.dumps({
+            'type': 'ai_response',
+            'ai_message': "Apologies, the I currently experiencing some technical difficulties. Please try again later. Thank you for your patience!"
+        }))
+
+    async def send_input_requests(self, input_requests: list[dict]):
+        """
+        Sends input requests of tools that were not executed, exceptions of tools are already described in the response.
+        """
+        for input_request in input_requests:
+            await self.send(text_data=json.dumps({**input_request, 'type': 'input_request'}))
+
+    async def save_after_response(self, transactions: list[Balance_transaction], profile: list = None, journal: tuple = None):
+        """
+        Applies cost, profile and journal updates to the cached user context and submits their
+        database writes to the post response queue, so they don't hold the socket for the next turn.
+
+        Args:
+            transactions (list): Unsaved transactions from 'calculate_cost'.
+            profile (list): Updated profile entries, if profile was updated.
+            journal (tuple): Updated journal and its updates count, if journal was updated.
+        """
+        context = self.context
+        post_response_queue.submit(context.user.id, save_transactions(context.balance, transactions))
+
+        # Rolling chat summary is updated after the turn's writes, without delaying the response.
+        if context.summary_update_due():
+            context.summary_update_pending = True
+            post_response_queue.submit(context.user.id, self.summarize_chat())
+
         if profile:
             if len(profile) >= MAX_PROFILE_LENGTH:
                 await self.send(text_data=json.dumps({
@@ -780,23 +845,39 @@ class ChatConsumer(AsyncWebsocketConsumer):
                     'header': 'Profile',
                     'message': 'Assitant tried to update profile, but it was too long! Please, delete or shorten some entries for further updates.'
                 }))
-                return
-            else:   
-                user_profile_object.content = encryption.encrypt(json.dumps(profile))
-                await user_profile_object.asave()
+            else:
+                context.profile.content = Encryption().encrypt(json.dumps(profile))
+                post_response_queue.submit(context.user.id, context.profile.asave(update_fields=['content']))
 
         if journal:
             journal_text, updates_count = journal
+            # Journal of the turn was loaded to context before response generation
+            user_emotional_journal = context.journal
             user_emotional_journal.journal = json.dumps(journal_text)
             user_emotional_journal.updates_count = updates_count
 
-            await user_emotional_journal.asave()
+            post_response_queue.submit(context.user.id, user_emotional_journal.asave(update_fields=['journal', 'updates_count']))
+
+    async def summarize_chat(self):
+        """
+        Folds new messages into the rolling chat summary and charges the user for the summary request.
+        """
+        context = self.context
+        try:
+            assistant_settings = context.assistant_settings()
+            token_usage = await update_chat_summary(context.chat, assistant_settings.responder_gpt_model)
+            if token_usage:
+                await save_transactions(context.balance, calculate_cost(context.balance, {"Summarizer": token_usage}, assistant_settings))
+        finally:
+            context.summary_update_pending = False
 
-        return
-        
     async def disconnect(self, close_code):
 
         if CONSUMERS_DEBUG: print("Socket disconnected with code:", close_code)
+        # Commit writes that are still pending for this user.
+        user = self.scope['user']
+        if user.is_authenticated:
+            await post_response_queue.flush(user.id)
         await self.close()
 
         return
@@ -827,14 +908,18 @@ async def get_emotional_journals(user: object, limit: int, offset: int = 0, for_
 
     return journals
 
-async def calculate_cost(user_balance: User_balance, tokens_used: dict, assistant_settings: AssistantSettings) -> None:
+def calculate_cost(user_balance: User_balance, tokens_used: dict, assistant_settings: AssistantSettings) -> list[Balance_transaction]:
     """
-    Calculates cost of used tokens by every asistant module.  Creates and saves transactions for
-    modules to database and updates user balance.
+    Calculates cost of used tokens by every asistant module and subtracts it from the cached user balance.
+    Returns unsaved transactions for modules, that are saved to database with 'save_transactions'.
     """
     def module_cost(module, gpt_model):
-        module_cost = Decimal(tokens_used[module]['prompt_tokens']/1000 * GPT_MODELS_PRICING[gpt_model]['input'])
-        module_cost += Decimal(tokens_used[module]['completion_tokens']/1000 * GPT_MODELS_PRICING[gpt_model]['output'])
+        pricing = GPT_MODELS_PRICING[gpt_model]
+        # Cached prompt tokens are part of prompt tokens and have their own price.
+        cached_tokens = tokens_used[module].get('cached_tokens', 0)
+        module_cost = Decimal((tokens_used[module]['prompt_tokens'] - cached_tokens)/1000 * pricing['input'])
+        module_cost += Decimal(cached_tokens/1000 * pricing.get('cached_input', pricing['input']))
+        module_cost += Decimal(tokens_used[module]['completion_tokens']/1000 * pricing['output'])
         return module_cost
     
     modules_and_models = {
@@ -842,41 +927,57 @@ async def calculate_cost(user_balance: User_balance, tokens_used: dict, assistan
         "Profiler": assistant_settings.profiler_gpt_model,
         "Journal": assistant_settings.journal_gpt_model,
         "Recommender": assistant_settings.responder_gpt_model,
-        "Responder": assistant_settings.responder_gpt_model
+        "Responder": assistant_settings.responder_gpt_model,
+        "Summarizer": assistant_settings.responder_gpt_model
     }
     
-    total_cost = Decimal(0)
+    transactions = []
     for module in tokens_used:
         if len(tokens_used[module]) == 0 or tokens_used[module]['total_tokens'] == 0:
             continue
         
         module_costs = module_cost(module, modules_and_models[module])
-        total_cost += module_costs
         if CONSUMERS_DEBUG: print(f"{module} cost - {module_costs}")
         
-        new_transaction = Balance_transaction(type = module, balance = user_balance, amount = module_costs)
-        await new_transaction.asave()
-    
-    new_user_balance = Decimal(user_balance.balance) - total_cost
-    new_user_balance = new_user_balance.quantize(Decimal('0.0001'), rounding='ROUND_FLOOR')
-    
-    if CONSUMERS_DEBUG: print(f"User balance: {user_balance.balance} - New balance: {new_user_balance}")
+        transactions.append(Balance_transaction(type = module, balance = user_balance, amount = module_costs))
     
-    user_balance.balance = new_user_balance
-    await user_balance.asave()
+    debit_cached_balance(user_balance, transactions)
+    return transactions
     
-async def calculate_audio_cost(user_balance: User_balance, audio_duration: float) -> None:
+def calculate_audio_cost(user_balance: User_balance, audio_duration: float) -> list[Balance_transaction]:
     """
-    Calculates cost of voice message transcription. Creates and saves transaction to database and 
-    updates user balance.
+    Calculates cost of voice message transcription and subtracts it from the cached user balance.
+    Returns unsaved transaction, that is saved to database with 'save_transactions'.
     """
-    audio_cost = Decimal(0)
-    audio_cost = math.ceil(audio_duration) / 60 * AUDIO_TRANSCRIPTION_MODEL_PRICING
-    new_transaction = Balance_transaction(type = 'Audio', balance = user_balance, amount = audio_cost)
-    await new_transaction.asave()
+    audio_cost = Decimal(math.ceil(audio_duration) / 60 * AUDIO_TRANSCRIPTION_MODEL_PRICING)
+    transactions = [Balance_transaction(type = 'Audio', balance = user_balance, amount = audio_cost)]
+
+    debit_cached_balance(user_balance, transactions)
+    return transactions
+
+def transactions_total(transactions: list[Balance_transaction]) -> Decimal:
+    total_cost = sum((Decimal(transaction.amount) for transaction in transactions), Decimal(0))
+    return total_cost.quantize(Decimal('0.0001'), rounding='ROUND_CEILING')
+
+def debit_cached_balance(user_balance: User_balance, transactions: list[Balance_transaction]) -> None:
+    """
+    Subtracts total of transactions from the balance cached in user context, so next turn sees it
+    before the transactions are saved.
+    """
+    new_user_balance = Decimal(user_balance.balance) - transactions_total(transactions)
+    if CONSUMERS_DEBUG: print(f"User balance: {user_balance.balance} - New balance: {new_user_balance}")
 
-    new_user_balance = Decimal(user_balance.balance) - Decimal(audio_cost)
-    new_user_balance = new_user_balance.quantize(Decimal('0.0001'), rounding='ROUND_FLOOR')
-    
     user_balance.balance = new_user_balance
-    await user_balance.asave()
\ No newline at end of file
+    # Debits that are not committed yet, they are subtracted from balance re-read from database.
+    user_balance.pending_debit += transactions_total(transactions)
+
+async def save_transactions(user_balance: User_balance, transactions: list[Balance_transaction]) -> None:
+    """
+    Saves transactions to database and subtracts their total from user balance. Balance is updated
+    in database to not overwrite top ups made since it was loaded.
+    """
+    if not transactions:
+        return
+    await Balance_transaction.objects.abulk_create(transactions)
+    await User_balance.objects.filter(pk=user_balance.pk).aupdate(balance=F('balance') - transactions_total(transactions))
+    user_balance.pending_debit -= transactions_total(transactions)
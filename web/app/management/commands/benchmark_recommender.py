@@ -0,0 +1,191 @@
+import json, os, tempfile, tracemalloc
+from time import perf_counter
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from ...assistant import recommender
+from ...assistant.recommender import RecommerdationTree, ArrayRecommendationTree, RecommendationIndex, Data
+from ...assistant.recommendation_store import write_store
+from ...assistant.settings import RECOMMENDATION_CATEGORIES
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks recommendation indexes on synthetic corpora of integer category vectors. Reports build and load time, "
+        "query latency percentiles, traced memory and recall@k against exact search as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default="10,1000,100000", help="Comma separated corpus sizes, up to 1000000.")
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--k', type=int, default=3)
+        parser.add_argument('--max-value', type=int, default=10)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--max-recursive-size', type=int, default=100000,
+                            help="Largest corpus for the recursive tree, its build is slow on big corpora.")
+        parser.add_argument('--output', help="File to write JSON report to, by default it is printed.")
+
+    def handle(self, *args, **options):
+        # Recursive tree prints every step in debug mode.
+        recommender.RECOMMENDER_DEBUG = False
+        rng = np.random.default_rng(options['seed'])
+        dimension = len(RECOMMENDATION_CATEGORIES)
+
+        report = {
+            "config": {key: options[key] for key in ('queries', 'k', 'max_value', 'seed', 'max_recursive_size')},
+            "results": {},
+        }
+        for size in map(int, options['sizes'].split(',')):
+            vectors = rng.integers(0, options['max_value'] + 1, (size, dimension))
+            targets = rng.integers(0, options['max_value'] + 1, (options['queries'], dimension))
+            benchmark = IndexBenchmark(vectors, targets, options['k'])
+
+            results = {"brute_force": benchmark.run(BruteForceIndex)}
+            if size <= options['max_recursive_size']:
+                results["recursive_tree"] = benchmark.run(RecursiveTreeIndex)
+                results["recursive_tree_json"] = benchmark.run(JsonTreeIndex)
+            results["array_tree"] = benchmark.run(ArrayTreeIndex)
+            results["store"] = benchmark.run(StoreIndex)
+            report["results"][str(size)] = results
+            self.stderr.write(f"Benchmarked corpus of {size} vectors")
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+class IndexBenchmark:
+    """
+    Measures one index type on a corpus. Recall@k counts returned neighbors not further than
+    the k-th exact neighbor, so ties with equal distances are not counted as misses.
+    """
+    def __init__(self, vectors: np.ndarray, targets: np.ndarray, k: int):
+        self.vectors = vectors
+        self.targets = targets
+        self.k = k
+        # Distance to the k-th exact neighbor of every target, only one row of distances is kept at a time.
+        kth = min(k, len(vectors)) - 1
+        self.kth_distances = []
+        for target in targets:
+            squared_distances = ((vectors - target) ** 2).sum(axis=1)
+            self.kth_distances.append(np.sqrt(np.partition(squared_distances, kth)[kth]))
+
+    def run(self, index_type) -> dict:
+        with tempfile.TemporaryDirectory() as directory:
+            index = index_type(directory)
+
+            tracemalloc.start()
+            start = perf_counter()
+            index.build(self.vectors)
+            build_time = perf_counter() - start
+            _, build_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            tracemalloc.start()
+            start = perf_counter()
+            index.load()
+            load_time = perf_counter() - start
+            _, load_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            latencies = []
+            found = 0
+            for target, kth_distance in zip(self.targets, self.kth_distances):
+                target = target.tolist()
+                start = perf_counter()
+                distances = index.query(target, self.k)
+                latencies.append(perf_counter() - start)
+                found += sum(1 for distance in distances[:self.k] if distance <= kth_distance + 1e-9)
+
+            return {
+                "build_s": round(build_time, 4),
+                "load_s": round(load_time, 4),
+                "query_p50_ms": round(float(np.percentile(latencies, 50)) * 1000, 4),
+                "query_p99_ms": round(float(np.percentile(latencies, 99)) * 1000, 4),
+                "build_peak_memory_bytes": build_memory,
+                "load_peak_memory_bytes": load_memory,
+                "file_bytes": index.file_size(),
+                "recall_at_k": round(found / (len(self.targets) * min(self.k, len(self.vectors))), 4),
+            }
+
+class BruteForceIndex:
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, "vectors.npy")
+
+    def build(self, vectors: np.ndarray):
+        np.save(self.path, vectors.astype(np.int8))
+
+    def load(self):
+        self.vectors = np.load(self.path).astype(np.int32)
+
+    def query(self, target: list[int], k: int) -> list[float]:
+        distances = ((self.vectors - np.asarray(target, dtype=np.int32)) ** 2).sum(axis=1)
+        nearest = np.argpartition(distances, min(k, len(distances)) - 1)[:k]
+        return np.sqrt(np.sort(distances[nearest])).tolist()
+
+    def file_size(self) -> int:
+        return os.path.getsize(self.path)
+
+class RecursiveTreeIndex:
+    """
+    Current recursive tree, built in memory and queried without saving.
+    """
+    def __init__(self, directory: str):
+        self.path = None
+
+    def build(self, vectors: np.ndarray):
+        self.tree = RecommerdationTree(vectors.shape[1])
+        self.tree.build_tree([Data(vector, i) for i, vector in enumerate(vectors.tolist())])
+
+    def load(self):
+        pass
+
+    def query(self, target: list[int], k: int) -> list[float]:
+        return [distance for distance, index, vector in self.tree.nearest_neighbors(target, k)]
+
+    def file_size(self) -> int:
+        return 0
+
+class JsonTreeIndex(RecursiveTreeIndex):
+    """
+    Recursive tree saved with 'save_tree' and loaded with 'load_tree'.
+    """
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, "tree.json")
+
+    def build(self, vectors: np.ndarray):
+        super().build(vectors)
+        self.tree.save_tree(self.path)
+
+    def load(self):
+        self.tree = RecommerdationTree.load_tree(self.path)
+
+    def file_size(self) -> int:
+        return os.path.getsize(self.path)
+
+class ArrayTreeIndex(RecursiveTreeIndex):
+    def build(self, vectors: np.ndarray):
+        self.tree = ArrayRecommendationTree.build(vectors)
+
+class StoreIndex:
+    """
+    Array tree saved to the binary store and mapped to memory, as used by workers. The tree of the loaded
+    index is queried directly, so raw neighbors are compared like in other variants, without merging equal vectors.
+    """
+    def __init__(self, directory: str):
+        self.path = os.path.join(directory, "recommendations.bin")
+
+    def build(self, vectors: np.ndarray):
+        tree = ArrayRecommendationTree.build(vectors)
+        write_store(self.path, tree.to_arrays(), [f"recommendation {i}" for i in range(len(vectors))])
+
+    def load(self):
+        self.index = RecommendationIndex.load(self.path)
+
+    def query(self, target: list[int], k: int) -> list[float]:
+        return [distance for distance, index, vector in self.index.tree.nearest_neighbors(target, k)]
+
+    def file_size(self) -> int:
+        return os.path.getsize(self.path)
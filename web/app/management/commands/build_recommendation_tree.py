@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from ...assistant.recommender import Recommender
+from ...assistant.settings import RECOMMENDER_TREE_PATH, RECOMMENDER_RECOMMENDATIONS_PATH, RECOMMENDER_DELTA_PATH
+
+class Command(BaseCommand):
+    help = "Builds the binary recommendation store with the KD-tree and texts from recommendations file, merging recommendations added at runtime. Running workers reload it on the next lookup."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tree-path', default=RECOMMENDER_TREE_PATH)
+        parser.add_argument('--recommendations-path', default=RECOMMENDER_RECOMMENDATIONS_PATH)
+        parser.add_argument('--delta-path', default=RECOMMENDER_DELTA_PATH)
+
+    def handle(self, *args, **options):
+        recommender = Recommender(
+            gpt_model = None,
+            recommendations_tree_path = options['tree_path'],
+            recommendations_path = options['recommendations_path'],
+            recommendations_delta_path = options['delta_path']
+        )
+        recommender.build_and_save_rec_tree()
+
+        self.stdout.write(self.style.SUCCESS(f"Recommendation store saved to {options['tree_path']}"))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from ...assistant.recommender import Recommender
+from ...assistant.settings import (RECOMMENDER_TREE_PATH, RECOMMENDER_RECOMMENDATIONS_PATH, RECOMMENDER_DELTA_PATH,
+                                   RECOMMENDER_DUPLICATE_MAX_DISTANCE, RECOMMENDER_DUPLICATE_MIN_SIMILARITY)
+
+class Command(BaseCommand):
+    help = "Collapses near-duplicate recommendations, with similar texts and close vectors, and rebuilds the recommendation store."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-distance', type=float, default=RECOMMENDER_DUPLICATE_MAX_DISTANCE)
+        parser.add_argument('--min-similarity', type=float, default=RECOMMENDER_DUPLICATE_MIN_SIMILARITY)
+        parser.add_argument('--dry-run', action='store_true', help="Only print near-duplicates.")
+        parser.add_argument('--tree-path', default=RECOMMENDER_TREE_PATH)
+        parser.add_argument('--recommendations-path', default=RECOMMENDER_RECOMMENDATIONS_PATH)
+        parser.add_argument('--delta-path', default=RECOMMENDER_DELTA_PATH)
+
+    def handle(self, *args, **options):
+        recommender = Recommender(
+            gpt_model = None,
+            recommendations_tree_path = options['tree_path'],
+            recommendations_path = options['recommendations_path'],
+            recommendations_delta_path = options['delta_path']
+        )
+        clusters = recommender.compact_recommendations(options['max_distance'], options['min_similarity'], options['dry_run'])
+
+        for cluster in clusters:
+            self.stdout.write(f"Kept: {cluster[0]}")
+            for text in cluster[1:]:
+                self.stdout.write(f"  Duplicate: {text}")
+
+        removed = sum(len(cluster) - 1 for cluster in clusters)
+        action = "Found" if options['dry_run'] else "Removed"
+        self.stdout.write(self.style.SUCCESS(f"{action} {removed} near-duplicate recommendations in {len(clusters)} clusters."))
@@ -0,0 +1,259 @@
+import asyncio, json, os, random
+
+from django.core.management.base import BaseCommand
+
+from ...assistant.helpers import text_cache_key
+from ...assistant.recommender import Recommender
+from ...assistant.settings import (RECOMMENDATION_CATEGORIES, RECOMMENDER_TREE_PATH, RECOMMENDER_RECOMMENDATIONS_PATH,
+                                   RECOMMENDER_DELTA_PATH, RECOMMENDATION_GENERATION_CONCURRENCY,
+                                   RECOMMENDATION_GENERATION_CHECKPOINT_PATH)
+
+MAX_CATEGORY_VALUE = 10
+MIN_RECOMMENDATION_LENGTH = 40
+MAX_RECOMMENDATION_LENGTH = 1500
+
+class Command(BaseCommand):
+    help = (
+        "Generates recommendations from seed prompts or random category vectors. Items flow through "
+        "generation, validation with dedupe and vectorization stages connected by queues, with bounded concurrency "
+        "of model requests. Results are checkpointed, so an interrupted run continues where it stopped, "
+        "and are written to the corpus with a single rebuild of the store at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100, help="Number of random category vectors to generate from.")
+        parser.add_argument('--seeds-file', help="File with a seed prompt on every line, used instead of random vectors.")
+        parser.add_argument('--random-seed', type=int, default=0, help="Seed of random vectors, keep it when resuming.")
+        parser.add_argument('--model', default='gpt-4o-mini')
+        parser.add_argument('--concurrency', type=int, default=RECOMMENDATION_GENERATION_CONCURRENCY)
+        parser.add_argument('--checkpoint-path', default=RECOMMENDATION_GENERATION_CHECKPOINT_PATH)
+        parser.add_argument('--tree-path', default=RECOMMENDER_TREE_PATH)
+        parser.add_argument('--recommendations-path', default=RECOMMENDER_RECOMMENDATIONS_PATH)
+        parser.add_argument('--delta-path', default=RECOMMENDER_DELTA_PATH)
+
+    def handle(self, *args, **options):
+        recommender = Recommender(
+            gpt_model = options['model'],
+            recommendations_tree_path = options['tree_path'],
+            recommendations_path = options['recommendations_path'],
+            recommendations_delta_path = options['delta_path']
+        )
+        pipeline = GenerationPipeline(recommender, options['concurrency'], options['checkpoint_path'], self.stdout)
+        items = seed_items(options['seeds_file']) if options['seeds_file'] else vector_items(options['count'], options['random_seed'])
+
+        accepted = asyncio.run(pipeline.run(items))
+
+        if accepted:
+            recommender.save_recomendations(accepted)
+            # Rerun after a failure below doesn't save the same items again.
+            pipeline.mark_saved()
+        if accepted or pipeline.saved:
+            recommender.build_and_save_rec_tree()
+        os.remove(options['checkpoint_path'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Saved {len(accepted) + pipeline.saved} recommendations, rejected {pipeline.rejected}. Tokens used: {pipeline.tokens_used}"
+        ))
+
+def seed_items(seeds_file: str) -> list[dict]:
+    """
+    Items with seed prompts by line number of the seeds file.
+    """
+    with open(seeds_file, 'r', encoding='utf-8') as file:
+        return [{"id": f"seed-{i}", "addition": line.strip()} for i, line in enumerate(file) if line.strip()]
+
+def vector_items(count: int, random_seed: int) -> list[dict]:
+    """
+    Items with random category vectors, where a few categories have high scores.
+    Vectors depend only on 'random_seed', so ids stay the same when the run is resumed.
+    """
+    rng = random.Random(random_seed)
+    items = []
+    for i in range(count):
+        vector = [0] * len(RECOMMENDATION_CATEGORIES)
+        for category in rng.sample(range(len(vector)), rng.randint(1, 4)):
+            vector[category] = rng.randint(5, MAX_CATEGORY_VALUE)
+        items.append({"id": f"vector-{random_seed}-{i}", "vector": vector})
+    return items
+
+class GenerationPipeline:
+    """
+    Runs items through generation, validation with dedupe and vectorization stages. Every stage has its own
+    workers connected by queues, model requests of all stages share one semaphore. Texts are validated
+    before vectorization, so rejected texts don't cost a vectorization request.
+    Every finished item is appended to the checkpoint file, items from it are not generated again.
+    After accepted items are saved to the corpus a 'saved' record is appended, they are not saved again on resume.
+    """
+    def __init__(self, recommender: Recommender, concurrency: int, checkpoint_path: str, stdout):
+        self.recommender = recommender
+        self.concurrency = concurrency
+        self.checkpoint_path = checkpoint_path
+        self.stdout = stdout
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tokens_used = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_tokens": 0}
+        self.rejected = 0
+        self.accepted: list[tuple[list[int], str]] = []
+        # Accepted items of previous runs already saved to the corpus.
+        self.saved = 0
+        # Keys of normalized texts already in the corpus or generated in this run.
+        self.known_texts = set()
+
+    async def run(self, items: list[dict]) -> list[tuple[list[int], str]]:
+        """
+        Generates recommendations for all items not finished in previous runs.
+
+        Returns:
+        - List of accepted (vector, recommendation) pairs of this and previous runs, that are not saved yet.
+        """
+        self.load_known_texts()
+        done_ids = self.load_checkpoint()
+        items = [item for item in items if item["id"] not in done_ids]
+        self.stdout.write(f"Resumed {len(done_ids)} items from checkpoint, {len(items)} items to generate.")
+
+        queues = [asyncio.Queue(maxsize=self.concurrency * 2) for _ in range(3)]
+        # Validation dedupes with the set of known texts, so it runs in a single worker.
+        stages = [
+            (self.generate, queues[0], queues[1], self.concurrency),
+            (self.validate, queues[1], queues[2], 1),
+            (self.vectorize, queues[2], None, self.concurrency),
+        ]
+        workers = [
+            [asyncio.create_task(self.worker(function, input, output)) for _ in range(count)]
+            for function, input, output, count in stages
+        ]
+
+        with open(self.checkpoint_path, 'a', encoding='utf-8') as self.checkpoint:
+            # Line cut by interruption is ended, so it doesn't break the next record.
+            if self.checkpoint.tell() > 0 and not self.checkpoint_ends_with_newline:
+                self.checkpoint.write('\n')
+
+            for item in items:
+                await queues[0].put(item)
+
+            # Stop workers stage by stage, so every stage finishes its items before the next one stops.
+            for stage_workers, queue in zip(workers, queues):
+                for _ in stage_workers:
+                    await queue.put(None)
+                await asyncio.gather(*stage_workers)
+
+        return self.accepted
+
+    async def worker(self, function, input: asyncio.Queue, output: asyncio.Queue|None):
+        while (item := await input.get()) is not None:
+            try:
+                item = await function(item)
+            except Exception as e:
+                item["rejected"] = f"Error: {e}"
+            # Rejected items skip the remaining stages and are checkpointed right away.
+            if "rejected" in item or output is None:
+                self.finish(item)
+            else:
+                await output.put(item)
+
+    async def generate(self, item: dict) -> dict:
+        async with self.semaphore:
+            if "vector" in item:
+                recommendation, token_usage = await self.recommender.generate_recommendation(
+                    vector=item["vector"], vector_categories=RECOMMENDATION_CATEGORIES, vector_max_val=MAX_CATEGORY_VALUE)
+            else:
+                recommendation, token_usage = await self.recommender.generate_recommendation(addition=item["addition"])
+        self.add_tokens(token_usage)
+
+        if recommendation is None:
+            item["rejected"] = "Generation failed"
+        item["text"] = recommendation
+        return item
+
+    async def vectorize(self, item: dict) -> dict:
+        async with self.semaphore:
+            vector, token_usage = await self.recommender.generate_categories_v(
+                categories=RECOMMENDATION_CATEGORIES, text=item["text"], max_val=MAX_CATEGORY_VALUE)
+        self.add_tokens(token_usage)
+
+        if vector is None:
+            item["rejected"] = "Vectorization failed"
+        elif not any(vector):
+            item["rejected"] = "Empty vector"
+        # Recommendation is saved with the vector of its own text, not the vector it was generated from.
+        item["vector"] = vector
+        return item
+
+    async def validate(self, item: dict) -> dict:
+        # Lines of recommendations file hold one entry, texts of equal vectors are delimited by '|'.
+        text = " ".join(item["text"].replace('|', '/').split())
+        item["text"] = text
+        if not MIN_RECOMMENDATION_LENGTH <= len(text) <= MAX_RECOMMENDATION_LENGTH:
+            item["rejected"] = f"Invalid length {len(text)}"
+            return item
+
+        key = text_cache_key(text)
+        if key in self.known_texts:
+            item["rejected"] = "Duplicate"
+        else:
+            self.known_texts.add(key)
+        return item
+
+    def finish(self, item: dict):
+        if "rejected" in item:
+            self.rejected += 1
+        else:
+            self.accepted.append((item["vector"], item["text"]))
+
+        record = {"id": item["id"], "rejected": item["rejected"]} if "rejected" in item else \
+            {"id": item["id"], "vector": item["vector"], "text": item["text"]}
+        self.checkpoint.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.checkpoint.flush()
+
+        finished = self.rejected + len(self.accepted)
+        if finished % 100 == 0:
+            self.stdout.write(f"Finished {finished} items, tokens used: {self.tokens_used['total_tokens']}")
+
+    def mark_saved(self):
+        """
+        Appends the 'saved' record after accepted items were saved to the corpus.
+        """
+        with open(self.checkpoint_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps({"saved": len(self.accepted)}) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+
+    def add_tokens(self, token_usage: dict|None):
+        if token_usage:
+            for key in self.tokens_used:
+                self.tokens_used[key] += token_usage.get(key, 0)
+
+    def load_known_texts(self):
+        for path in (self.recommender.recommendations_path, self.recommender.recommendations_delta_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    for text in line.rstrip('\n').split(':', maxsplit=1)[1].split('|'):
+                        self.known_texts.add(text_cache_key(text))
+
+    def load_checkpoint(self) -> set[str]:
+        done_ids = set()
+        self.checkpoint_ends_with_newline = True
+        if not os.path.exists(self.checkpoint_path):
+            return done_ids
+
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                self.checkpoint_ends_with_newline = line.endswith('\n')
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Last line could be cut by interruption, its item is generated again.
+                    continue
+                if "saved" in record:
+                    # Items accepted before this record are already in the corpus.
+                    self.saved += len(self.accepted)
+                    self.accepted = []
+                    continue
+                done_ids.add(record["id"])
+                if "rejected" in record:
+                    self.rejected += 1
+                else:
+                    self.accepted.append((record["vector"], record["text"]))
+                    self.known_texts.add(text_cache_key(record["text"]))
+        return done_ids
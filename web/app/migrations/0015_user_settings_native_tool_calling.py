@@ -0,0 +1,18 @@
+# Generated by Django 4.2.5 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0014_chat_datetime_user_balance_datetime_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user_settings',
+            name='native_tool_calling',
+            field=models.BooleanField(default=False),
+        ),
+    ]
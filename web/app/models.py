@@ -11,6 +11,10 @@ from django.utils import timezone
 class Chat(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     datetime = models.DateTimeField(default=timezone.now)
+    # Encrypted rolling summary, number of messages it covers and time of the last summarized message
+    summary = models.TextField(default="")
+    summarized_messages = models.PositiveIntegerField(default=0)
+    summarized_until = models.DateTimeField(null=True, blank=True)
 
 class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
@@ -29,6 +33,7 @@ class User_settings(models.Model):
     responder_personality = models.TextField(max_length=2500, default="Caring and helpful assistant.")
     responder_gpt_model = models.TextField(default='gpt-4o-mini')
     messages_for_input_extraction = models.PositiveSmallIntegerField(default=3)
+    native_tool_calling = models.BooleanField(default=False)
 
     profiler_gpt_model = models.TextField(default='gpt-4o-mini')
     messages_till_profile_update = models.PositiveSmallIntegerField(default=5)
@@ -258,6 +258,7 @@ function load_more_chat() {
 };
 
 let chat_offset = 0
+let inputs_forms_count = 0
 chat.addEventListener('scroll', load_more_chat)
 
 // User profile showing and settings handling.
@@ -395,6 +396,7 @@ messages_for_input_slide.addEventListener('change', (e) => {
 let responder_personality_textarea = document.getElementById('responder-personality')
 let responder_gpt_select = document.getElementById('responder-gpt-select');
 let save_responder_settings = document.getElementById('save-responder-settings');
+let native_tool_calling_switch = document.getElementById('native-tool-calling');
 
 save_responder_settings.addEventListener('click', (e) => {
     e.preventDefault();
@@ -404,6 +406,7 @@ save_responder_settings.addEventListener('click', (e) => {
         'responder_gpt_model': modelValMapping[responder_gpt_select.value],
         'responder_personality': responder_personality_textarea.value,
         'messages_for_input_extraction': messages_for_input_slide.value,
+        'native_tool_calling': native_tool_calling_switch.checked,
         // 'chat_history_to_pass': chat_history_slide.value
     }));
 })
@@ -669,6 +672,8 @@ chatSocket.onmessage = function (e) {
         messages_for_input_slide.value = messages_for_input_extraction;
         messages_for_input_val.innerText = messages_for_input_extraction;
 
+        native_tool_calling_switch.checked = data.native_tool_calling;
+
         // chat_history_slide.value = chat_history_to_pass;
         // chat_history_val.innerText = chat_history_to_pass;
         return
@@ -777,6 +782,20 @@ chatSocket.onmessage = function (e) {
         return
     }
 
+    else if (data.type === 'ai_response_chunk') {
+        // Streamed response is shown in the loading message until the full response arrives
+        loading_message = document.getElementById('loading_message');
+        if (loading_message != null) {
+            if (loading_message.dataset.streamed_text === undefined) {
+                loading_message.dataset.streamed_text = '';
+            }
+            loading_message.dataset.streamed_text += data.ai_message_chunk;
+            loading_message.innerHTML = marked.parse(loading_message.dataset.streamed_text);
+        }
+        chat.scrollTo(0, chat.scrollHeight);
+        return
+    }
+
     else if (data.type === 'ai_response') {
         loading_message = document.getElementById('loading_message');
         if (loading_message != null) {
@@ -792,8 +811,10 @@ chatSocket.onmessage = function (e) {
 
     else if (data.type === 'input_request') {
 
+        // Several tools can request inputs at once, every form has its own id and message.
+        inputs_forms_count += 1;
         let inputs_form = document.createElement('form');
-        inputs_form.id = 'inputs_form';
+        inputs_form.id = 'inputs_form_' + inputs_forms_count;
         inputs_form.className = 'py-2 my-1';
 
         let input_base = document.createElement('input');
@@ -861,7 +882,7 @@ chatSocket.onmessage = function (e) {
 
         inputs_form.appendChild(buttons_row);
 
-        inputs_message_container = add_message_in_chat(is_bot = true, message = '');
+        let inputs_message_container = add_message_in_chat(is_bot = true, message = '');
         inputs_message_container.appendChild(inputs_form);
 
         chat.scrollTo(0, chat.scrollHeight);
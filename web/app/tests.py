@@ -1,3 +1,442 @@
-from django.test import TestCase
+import asyncio, os, tempfile, time
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase
+
+from .assistant.recommender import ArrayRecommendationTree, RecommendationIndex, Recommender, get_recommendation_index
+from .assistant.recommendation_store import write_store
+from .assistant.helpers import TTLCache
+from .assistant.prompt_budget import PromptBudget, count_tokens
+from .assistant.tool_executor import ProcessRunner, ToolExecutor
+from .assistant.pipeline import Stage, StageScheduler
+
+def brute_force_distances(vectors: np.ndarray, target: list[int]) -> np.ndarray:
+    return np.sqrt(((vectors.astype(np.int64) - np.asarray(target, dtype=np.int64)) ** 2).sum(axis=1))
+
+def random_vectors(n: int, seed: int = 0) -> np.ndarray:
+    """
+    Category vectors with values from 0 to 10, every fifth vector repeats an earlier one.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = rng.integers(0, 11, size=(n, 12))
+    vectors[::5] = vectors[rng.integers(0, n, size=len(vectors[::5]))]
+    return vectors
+
+class ArrayRecommendationTreeTests(SimpleTestCase):
+    def setUp(self):
+        self.vectors = random_vectors(300)
+        # Small leaves, so search goes through many nodes.
+        self.tree = ArrayRecommendationTree.build(self.vectors, leaf_size=4)
+        self.targets = np.random.default_rng(1).integers(0, 11, size=(25, 12)).tolist() + self.vectors[:5].tolist()
+
+    def assert_nearest(self, targets: list[list[int]], n_max: int, results: list[list[tuple[float, int]]]):
+        for target, result in zip(targets, results):
+            expected = np.sort(brute_force_distances(self.vectors, target))[:n_max]
+            distances = [distance for distance, index in result]
+            indices = [index for distance, index in result]
+
+            np.testing.assert_allclose(distances, expected)
+            self.assertEqual(len(set(indices)), len(indices))
+            # Every index has the distance it was returned with, ties may be in any order.
+            np.testing.assert_allclose(brute_force_distances(self.vectors[indices], target), distances)
+
+    def test_nearest_neighbors_matches_brute_force(self):
+        for n_max in (1, 5, 17):
+            results = [[(distance, index) for distance, index, vector in self.tree.nearest_neighbors(target, n_max)]
+                       for target in self.targets]
+            self.assert_nearest(self.targets, n_max, results)
+
+    def test_nearest_neighbors_returns_vectors_of_indices(self):
+        for distance, index, vector in self.tree.nearest_neighbors(self.targets[0], 10):
+            self.assertEqual(vector, self.vectors[index].tolist())
+
+    def test_batch_nearest_neighbors_matches_brute_force(self):
+        for k in (1, 5, 17):
+            indices, distances = self.tree.batch_nearest_neighbors(self.targets, k)
+            self.assertEqual(indices.shape, (len(self.targets), k))
+            results = [list(zip(row_distances, row_indices)) for row_indices, row_distances in zip(indices, distances)]
+            self.assert_nearest(self.targets, k, results)
+
+    def test_duplicate_vectors_are_all_found(self):
+        vectors = np.array([[3] * 12] * 10 + [[4] * 12] * 3)
+        tree = ArrayRecommendationTree.build(vectors, leaf_size=2)
+
+        nearest = tree.nearest_neighbors([3] * 12, 10)
+        self.assertEqual(sorted(index for distance, index, vector in nearest), list(range(10)))
+        self.assertTrue(all(distance == 0 for distance, index, vector in nearest))
+
+        indices, distances = tree.batch_nearest_neighbors([[3] * 12], 10)
+        self.assertEqual(sorted(indices[0].tolist()), list(range(10)))
+
+    def test_n_max_larger_than_corpus(self):
+        vectors = self.vectors[:7]
+        tree = ArrayRecommendationTree.build(vectors, leaf_size=2)
+
+        nearest = tree.nearest_neighbors(self.targets[0], 20)
+        self.assertEqual(sorted(index for distance, index, vector in nearest), list(range(7)))
+
+        indices, distances = tree.batch_nearest_neighbors([self.targets[0]], 20)
+        self.assertEqual(sorted(indices[0, :7].tolist()), list(range(7)))
+        # Results are padded when corpus has less vectors than requested.
+        self.assertTrue((indices[0, 7:] == -1).all())
+        self.assertTrue(np.isinf(distances[0, 7:]).all())
+
+    def test_batch_distance_threshold(self):
+        indices, distances = self.tree.batch_nearest_neighbors(self.targets, 10, distance_threshold=6)
+        self.assertTrue((distances[indices >= 0] <= 6).all())
+        self.assertTrue(np.isinf(distances[indices < 0]).all())
+
+    def test_empty_tree(self):
+        tree = ArrayRecommendationTree.build(np.zeros((0, 12)))
+        self.assertEqual(tree.nearest_neighbors([0] * 12, 3), [])
+        indices, distances = tree.batch_nearest_neighbors([[0] * 12], 3)
+        self.assertTrue((indices == -1).all())
+
+class RecommendationStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'tree.bin')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_store_round_trip(self):
+        vectors = random_vectors(50)
+        texts = [f"Recommendation {i}" for i in range(50)]
+        texts[3] = "Go for a walk|Drink a glass of water"
+        texts[7] = "Prenez une pause ☕|Выпейте воды|散歩に行く"
+        texts[9] = ""
+        tree = ArrayRecommendationTree.build(vectors, leaf_size=4)
+        write_store(self.path, tree.to_arrays(), texts)
+
+        index = RecommendationIndex.load(self.path)
+        self.assertEqual(len(index.store), 50)
+        for name, array in tree.to_arrays().items():
+            np.testing.assert_array_equal(index.tree.to_arrays()[name], array)
+
+        self.assertEqual(index.get_texts(3), ["Go for a walk", "Drink a glass of water"])
+        self.assertEqual(index.get_texts(7), ["Prenez une pause ☕", "Выпейте воды", "散歩に行く"])
+        self.assertEqual(index.get_texts(9), [""])
+        self.assertEqual(index.get_texts(49), ["Recommendation 49"])
+
+        # Texts are found by line numbers of vectors in the loaded tree.
+        distances, texts = zip(*index.nearest(vectors[7].tolist(), 3))
+        self.assertEqual(distances[0], 0)
+        self.assertIn(["Prenez une pause ☕", "Выпейте воды", "散歩に行く"], texts)
+
+    def test_empty_store(self):
+        tree = ArrayRecommendationTree.build([])
+        write_store(self.path, tree.to_arrays(), [])
+
+        index = RecommendationIndex.load(self.path)
+        self.assertEqual(len(index.store), 0)
+        self.assertEqual(index.tree.dimension, 12)
+        self.assertEqual(index.nearest([0] * 12, 3), [])
+        self.assertEqual(index.batch_nearest([[0] * 12], 3), [[]])
+
+class RecommendationDeltaMergeTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = lambda name: os.path.join(self.directory.name, name)
+        self.recommender = Recommender('gpt-4o-mini', recommendations_tree_path=path('tree.bin'),
+                                       recommendations_path=path('recommendations.txt'), recommendations_delta_path=path('delta.txt'))
+        with open(self.recommender.recommendations_path, 'w', encoding='utf-8') as file:
+            file.write("1,1,1,1,1,1,1,1,1,1,1,1:Go for a walk\n")
+            file.write("5,5,5,5,5,5,5,5,5,5,5,5:Call a friend\n")
+        self.recommender.build_and_save_rec_tree()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read_lines(self) -> list[str]:
+        with open(self.recommender.recommendations_path, 'r', encoding='utf-8') as file:
+            return file.read().splitlines()
+
+    def test_delta_is_searched_before_merge(self):
+        self.recommender.save_recomendations([([9] * 12, "Take a nap")])
+
+        nearest = self.recommender.get_recomendations([9] * 12, 1)
+        self.assertEqual(nearest, [(0.0, ["Take a nap"])])
+
+    def test_merge(self):
+        self.recommender.save_recomendations([([1] * 12, "Stretch|for a minute"), ([9] * 12, "Выпейте воды")])
+        self.recommender.build_and_save_rec_tree()
+
+        self.assertEqual(self.read_lines(), [
+            "1,1,1,1,1,1,1,1,1,1,1,1:Go for a walk|Stretch|for a minute",
+            "5,5,5,5,5,5,5,5,5,5,5,5:Call a friend",
+            "9,9,9,9,9,9,9,9,9,9,9,9:Выпейте воды",
+        ])
+        self.assertFalse(os.path.exists(self.recommender.recommendations_delta_path))
+        self.assertFalse(os.path.exists(self.recommender.merging_delta_path))
+
+        index = get_recommendation_index(self.recommender.recommendations_tree_path)
+        self.assertEqual(index.nearest([1] * 12, 1), [(0.0, ["Go for a walk", "Stretch", "for a minute"])])
+        self.assertEqual(self.recommender.get_recomendations([9] * 12, 1), [(0.0, ["Выпейте воды"])])
+
+    def test_interrupted_merge_is_merged_again(self):
+        with open(self.recommender.merging_delta_path, 'w', encoding='utf-8') as file:
+            file.write("7,7,7,7,7,7,7,7,7,7,7,7:Read a book\n")
+        self.recommender.save_recomendations([([9] * 12, "Take a nap")])
+
+        # Delta left by the interrupted merge is merged first, the new delta waits for the next merge.
+        self.recommender.build_and_save_rec_tree()
+        self.assertEqual(self.read_lines()[-1], "7,7,7,7,7,7,7,7,7,7,7,7:Read a book")
+        self.assertTrue(os.path.exists(self.recommender.recommendations_delta_path))
+
+        self.recommender.build_and_save_rec_tree()
+        self.assertEqual(self.read_lines()[-1], "9,9,9,9,9,9,9,9,9,9,9,9:Take a nap")
+        self.assertFalse(os.path.exists(self.recommender.recommendations_delta_path))
+
+    def test_dry_run_compaction_keeps_files(self):
+        self.recommender.save_recomendations([([1] * 12, "Go for a walk.")])
+        lines = self.read_lines()
+
+        clusters = self.recommender.compact_recommendations(max_distance=1, min_similarity=0.5, dry_run=True)
+        self.assertEqual(clusters, [["Go for a walk", "Go for a walk."]])
+        self.assertEqual(self.read_lines(), lines)
+        self.assertTrue(os.path.exists(self.recommender.recommendations_delta_path))
+
+        clusters = self.recommender.compact_recommendations(max_distance=1, min_similarity=0.5)
+        self.assertEqual(clusters, [["Go for a walk", "Go for a walk."]])
+        self.assertEqual(self.read_lines()[0], "1,1,1,1,1,1,1,1,1,1,1,1:Go for a walk")
+
+class ProcessRunnerTests(SimpleTestCase):
+    def setUp(self):
+        self.runner = ProcessRunner(2)
+
+    def tearDown(self):
+        if self.runner.pool is not None:
+            self.runner.pool.terminate()
+
+    async def test_slow_call_doesnt_fail_other_calls(self):
+        async def slow():
+            with self.assertRaisesRegex(Exception, "longer than 0.5 seconds"):
+                await self.runner.run(time.sleep, (10,), 0.5)
+
+        start = time.monotonic()
+        # The other call runs in the same pool, which is restarted when the slow call misses its timeout.
+        results = await asyncio.gather(slow(), self.runner.run(time.sleep, (1,), 5), self.runner.run(pow, (2, 10), 5))
+        self.assertEqual(results[1:], [None, 1024])
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(self.runner.calls, {})
+
+    async def test_cancelled_call_restarts_pool(self):
+        await self.runner.run(pow, (2, 10), 5)
+        pool = self.runner.pool
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.runner.run(time.sleep, (10,), 5), 0.5)
+        self.assertIsNot(self.runner.pool, pool)
+        self.assertEqual(await self.runner.run(pow, (3, 2), 5), 9)
+
+def stage_function(result, delay: float = 0, log: list = None, name: str = None):
+    """
+    Stage function returning 'result' after 'delay' seconds, or raising it if it is an exception.
+    Stopped and cancelled stages are recorded in 'log'.
+    """
+    async def function(**inputs):
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            if log is not None: log.append(f"{name} cancelled")
+            raise
+        if log is not None: log.append(f"{name} done")
+        if isinstance(result, Exception):
+            raise result
+        return result
+    return function
+
+def make_tool(function, timeout=1, max_concurrency=4, cache_ttl=0):
+    return {'name': function.__name__, 'function_name': function, 'is_async': asyncio.iscoroutinefunction(function),
+            'timeout': timeout, 'max_concurrency': max_concurrency, 'cache_ttl': cache_ttl}
+
+
+class ToolExecutorTests(SimpleTestCase):
+    async def test_slow_tool_times_out(self):
+        async def slow_tool():
+            await asyncio.sleep(1)
+        with self.assertRaises(Exception) as context:
+            await ToolExecutor().run(make_tool(slow_tool, timeout=0.05), {})
+        self.assertEqual(str(context.exception), "Tool 'slow_tool' did not respond in 0.05 seconds.")
+
+    async def test_sync_tool_runs_in_thread(self):
+        def sync_tool(value):
+            return value * 2
+        self.assertEqual(await ToolExecutor().run(make_tool(sync_tool), {'value': 21}), 42)
+
+    async def test_concurrency_is_limited(self):
+        running = []
+        peak = []
+        async def limited_tool():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.02)
+            running.pop()
+        executor = ToolExecutor()
+        tool = make_tool(limited_tool, max_concurrency=2)
+        await asyncio.gather(*(executor.run(tool, {}) for _ in range(5)))
+        self.assertEqual(max(peak), 2)
+
+
+class ToolExecutorCacheTests(SimpleTestCase):
+    async def test_concurrent_calls_are_coalesced_and_cached(self):
+        calls = []
+        async def cached_tool(query):
+            calls.append(query)
+            await asyncio.sleep(0.02)
+            return query.upper()
+        executor = ToolExecutor()
+        tool = make_tool(cached_tool, cache_ttl=60)
+        results = await asyncio.gather(*(executor.run(tool, {'query': 'weather'}) for _ in range(3)))
+        self.assertEqual(results, ['WEATHER'] * 3)
+        self.assertEqual(await executor.run(tool, {'query': 'weather'}), 'WEATHER')
+        self.assertEqual(await executor.run(tool, {'query': 'news'}), 'NEWS')
+        self.assertEqual(calls, ['weather', 'news'])
+        self.assertEqual(executor.stats()['cached_tool'], {'hits': 1, 'misses': 2, 'coalesced': 2, 'hit_rate': 0.6})
+
+    async def test_failed_calls_are_not_cached(self):
+        calls = []
+        async def failing_tool():
+            calls.append(1)
+            raise Exception("failed")
+        executor = ToolExecutor()
+        tool = make_tool(failing_tool, cache_ttl=60)
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                await executor.run(tool, {})
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(executor.in_flight, {})
+
+
+class StageSchedulerTests(SimpleTestCase):
+    async def test_results_are_passed_to_dependent_stages(self):
+        async def total(a, b):
+            return a + b
+        scheduler = StageScheduler([
+            Stage('total', total, inputs=['a', 'b']),
+            Stage('a', stage_function(1, 0.02)),
+            Stage('b', stage_function(2)),
+        ])
+        results = await scheduler.run()
+        self.assertEqual(results, {'a': 1, 'b': 2, 'total': 3})
+        self.assertEqual(set(scheduler.timings), {'a', 'b', 'total'})
+
+    async def test_skipped_stage_resolves_to_none(self):
+        log = []
+        scheduler = StageScheduler([
+            Stage('flag', stage_function(True)),
+            # Condition is checked as soon as 'flag' is resolved, without waiting for 'slow'.
+            Stage('skipped', stage_function('skipped', 0, log, 'skipped'), inputs=['flag', 'slow'],
+                  condition_inputs=['flag'], condition=lambda flag: not flag),
+            Stage('after_skipped', stage_function('after'), inputs=['skipped']),
+            Stage('slow', stage_function('slow', 0.05)),
+        ])
+        results = await scheduler.run()
+        self.assertIsNone(results['skipped'])
+        self.assertEqual(results['after_skipped'], 'after')
+        self.assertEqual(scheduler.skipped, {'skipped'})
+        self.assertEqual(log, [])
+
+    async def test_failed_optional_stage_resolves_to_none(self):
+        scheduler = StageScheduler([
+            Stage('failing', stage_function(Exception("failed")), optional=True),
+            Stage('late', stage_function('late', 1), timeout=0.05, optional=True),
+            Stage('required', stage_function('done'), inputs=['failing', 'late']),
+        ])
+        results = await scheduler.run()
+        self.assertEqual(results, {'failing': None, 'late': None, 'required': 'done'})
+        self.assertEqual(scheduler.skipped, {'failing', 'late'})
+
+    async def test_speculative_stage_is_cancelled_when_not_needed(self):
+        log = []
+        scheduler = StageScheduler([
+            Stage('flag', stage_function(False)),
+            Stage('speculative', stage_function('result', 1, log, 'speculative'), speculative=True, optional=True),
+            Stage('dependent', stage_function('dependent'), inputs=['flag', 'speculative'],
+                  condition_inputs=['flag'], condition=lambda flag: flag),
+        ])
+        results = await scheduler.run()
+        self.assertEqual(results, {'flag': False, 'dependent': None, 'speculative': None})
+        self.assertEqual(log, ["speculative cancelled"])
+
+    async def test_cancel_condition_stops_running_stage(self):
+        log = []
+        scheduler = StageScheduler([
+            Stage('moderation', stage_function((True, ['harassment']), 0.02)),
+            Stage('profile', stage_function('profile', 1, log, 'profile'), optional=True,
+                  cancel_inputs=['moderation'], cancel_condition=lambda moderation: moderation[0]),
+        ])
+        results = await scheduler.run()
+        self.assertIsNone(results['profile'])
+        self.assertEqual(log, ["profile cancelled"])
+
+    async def test_failed_required_stage_stops_other_stages(self):
+        log = []
+        scheduler = StageScheduler([
+            Stage('failing', stage_function(Exception("failed"), 0.05)),
+            Stage('other_failing', stage_function(Exception("other failed"), 0.05)),
+            Stage('slow', stage_function('slow', 1, log, 'slow')),
+        ])
+        with self.assertRaisesRegex(Exception, "failed"):
+            await scheduler.run()
+        # Cancelled stage has stopped before the pipeline returned.
+        self.assertEqual(log, ["slow cancelled"])
+
+
+class TTLCacheTests(SimpleTestCase):
+    def test_entries_expire_after_ttl(self):
+        cache = TTLCache(10, 60)
+        with mock.patch('time.monotonic', return_value=1000):
+            cache.set('default', 1)
+            cache.set('short', 2, ttl=5)
+        with mock.patch('time.monotonic', return_value=1010):
+            self.assertEqual(cache.get('default'), 1)
+            self.assertIsNone(cache.get('short'))
+        with mock.patch('time.monotonic', return_value=1061):
+            self.assertEqual(cache.get('default', 'expired'), 'expired')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.stats(), {'size': 0, 'hits': 1, 'misses': 2})
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = TTLCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(len(cache), 2)
+
+
+class PromptBudgetTests(SimpleTestCase):
+    items = ["first message", "second message", "third message", "fourth message"]
+
+    def budget_for(self, items, separator_tokens=1):
+        # Budget with room for exactly the given items.
+        budget = PromptBudget('Responder', 'gpt-4o')
+        budget.budget = budget.used + sum(count_tokens(item, budget.model) + separator_tokens for item in items)
+        return budget
+
+    def test_fit_items_keeps_start(self):
+        budget = self.budget_for(self.items[:2])
+        self.assertEqual(budget.fit_items(self.items), self.items[:2])
+        self.assertEqual(budget.remaining, 0)
+
+    def test_fit_items_keeps_end_in_order(self):
+        budget = self.budget_for(self.items[-3:])
+        self.assertEqual(budget.fit_items(self.items, keep_end=True), self.items[-3:])
+        self.assertEqual(budget.remaining, 0)
+
+    def test_fit_items_stops_at_first_item_over_budget(self):
+        items = ["short", "a much longer item " * 20, "short"]
+        budget = self.budget_for(items[:1])
+        budget.budget += count_tokens(items[2], budget.model) + 1
+        self.assertEqual(budget.fit_items(items), ["short"])
+
+    def test_reserved_texts_are_counted(self):
+        budget = self.budget_for(self.items)
+        budget.reserve(self.items[0])
+        self.assertEqual(budget.fit_items(self.items), self.items[:3])
+        self.assertEqual(budget.fit_items(["more"]), [])
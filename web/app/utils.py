@@ -1,8 +1,12 @@
-from .models import Chat, Message
-from .assistant.settings import PRINT_FETCHED_CHAT_HISTOTY
+from .models import Chat, Message, User_balance, User_profile, User_settings, User_emotional_journal
+from .assistant.settings import PRINT_FETCHED_CHAT_HISTOTY, AssistantSettings, CHAT_SUMMARY_UPDATE_MESSAGES, CHAT_SUMMARY_MAX_NEW_MESSAGES
+from .assistant.chat_summary import ChatSummary
+
+from django.utils import timezone
 
 from cryptography.fernet import Fernet
 import os
+from decimal import Decimal
 from dotenv import load_dotenv
 load_dotenv()
 encryption_key = os.getenv("ENCRYPTION_KEY")
@@ -43,6 +47,47 @@ async def get_chat_history(chat: Chat, limit: int, offset: int = 0, for_socket:
         print('_'*20)
     return chat_history
 
+def message_line(message: Message, encryption: 'Encryption') -> str:
+    return f"{'Assistant' if message.is_bot else 'User'}: {encryption.decrypt(message.text)}"
+
+async def get_unsummarized_messages(chat: Chat, limit: int) -> tuple[list[str], Message|None]:
+    """
+    Returns up to 'limit' latest messages that are not in the chat summary yet, in chronological order,
+    and the last of these messages.
+    """
+    encryption = Encryption()
+    messages = Message.objects.filter(chat=chat)
+    if chat.summarized_until is not None:
+        messages = messages.filter(time__gt=chat.summarized_until)
+
+    new_messages = [message async for message in messages.order_by('-time')[:limit]]
+    new_messages.reverse()
+    return [message_line(message, encryption) for message in new_messages], (new_messages[-1] if new_messages else None)
+
+async def update_chat_summary(chat: Chat, gpt_model: str) -> dict|None:
+    """
+    Folds messages written after the last summary update into the rolling chat summary and saves it.
+    If there are more new messages than CHAT_SUMMARY_MAX_NEW_MESSAGES, older of them are skipped.
+
+    Returns:
+    - Dictionary with token usage information or None if no request was made.
+    """
+    new_messages, last_message = await get_unsummarized_messages(chat, CHAT_SUMMARY_MAX_NEW_MESSAGES)
+    if last_message is None:
+        return None
+
+    encryption = Encryption()
+    chat_summary = ChatSummary(summary = encryption.decrypt(chat.summary) if chat.summary else "", gpt_model = gpt_model)
+    summary, token_usage = await chat_summary.update_summary(new_messages)
+    if summary is None:
+        return token_usage
+
+    chat.summary = encryption.encrypt(summary)
+    chat.summarized_until = last_message.time
+    chat.summarized_messages = await Message.objects.filter(chat=chat, time__lte=last_message.time).acount()
+    await chat.asave(update_fields=['summary', 'summarized_until', 'summarized_messages'])
+    return token_usage
+
 class Encryption():
     def __init__(self):
         self.encryptor = Fernet(encryption_key)
@@ -52,4 +97,97 @@ class Encryption():
     def decrypt(self, encrypted_text: str) -> str:
         text = self.encryptor.decrypt(encrypted_text.encode())
         return text.decode()
-    
\ No newline at end of file
+    
+class UserContext():
+    """
+    Per-connection cache of the user's database objects used on every chat turn.
+
+    Loaded once when the socket connects, so handling a message does not need a separate
+    round trip for balance, chat, profile, settings and emotional journal. Settings handlers
+    write through the cached objects, so they always stay current.
+    """
+    def __init__(self, user, chat: Chat, balance: User_balance, profile: User_profile,
+                 settings: User_settings, journal: User_emotional_journal, message_count: int):
+        self.user = user
+        self.chat = chat
+        self.balance = balance
+        self.profile = profile
+        self.settings = settings
+        self.journal = journal
+        self.message_count = message_count
+        # Chat summary update is submitted after a response and not finished yet.
+        self.summary_update_pending = False
+        # Tools used or requested in the last turn, to predict the tool of the next message.
+        self.previous_tools: tuple[str, ...] = ()
+
+    @classmethod
+    async def load(cls, user) -> 'UserContext':
+        """
+        Fetch all objects needed to handle user messages.
+        """
+        chat = await Chat.objects.aget(user=user)
+        balance = await User_balance.objects.aget(user=user)
+        balance.pending_debit = Decimal(0)
+        profile, profile_created = await User_profile.objects.aget_or_create(user=user)
+        settings = await User_settings.objects.aget(user=user)
+        journal, journal_created = await User_emotional_journal.objects.aget_or_create(user=user, date=timezone.now().date())
+        message_count = await Message.objects.filter(chat=chat).acount()
+
+        return cls(user, chat, balance, profile, settings, journal, message_count)
+
+    async def get_emotional_journal(self) -> User_emotional_journal:
+        """
+        Returns today's emotional journal. Fetches a new one only when the date has changed since it was loaded.
+        """
+        current_date = timezone.now().date()
+        if self.journal.date != current_date:
+            self.journal, journal_created = await User_emotional_journal.objects.aget_or_create(user=self.user, date=current_date)
+        return self.journal
+
+    async def save_message(self, text: str, is_bot: bool = False) -> Message:
+        """
+        Encrypts and saves a message to the user's chat and keeps the message count current.
+        """
+        message = Message(chat=self.chat, text=Encryption().encrypt(text), is_bot=is_bot)
+        await message.asave()
+        self.message_count += 1
+        return message
+
+    async def refresh_balance(self) -> User_balance:
+        """
+        Re-reads the balance, it is changed outside of this connection by top ups and by other open sockets.
+        Debits of this connection that are not committed yet are subtracted from it.
+        """
+        balance = await User_balance.objects.filter(pk=self.balance.pk).values_list('balance', flat=True).aget()
+        self.balance.balance = Decimal(balance) - self.balance.pending_debit
+        return self.balance
+
+    def chat_summary(self) -> str|None:
+        """
+        Returns decrypted rolling summary of the chat or None if chat wasn't summarized yet.
+        """
+        return Encryption().decrypt(self.chat.summary) if self.chat.summary else None
+
+    def summary_update_due(self) -> bool:
+        """
+        Summary is updated when enough messages were written after the previous update.
+        """
+        return not self.summary_update_pending and self.message_count - self.chat.summarized_messages >= CHAT_SUMMARY_UPDATE_MESSAGES
+
+    def assistant_settings(self) -> AssistantSettings:
+        """
+        Creates assistant settings from the cached user settings.
+        """
+        settings = self.settings
+        return AssistantSettings(
+            responder_gpt_model = settings.responder_gpt_model,
+            responder_personality = settings.responder_personality,
+            profiler_gpt_model = settings.profiler_gpt_model,
+            journal_gpt_model = settings.journal_gpt_model,
+            messages_for_profile_update = settings.messages_for_profile_update,
+            messages_till_profile_update = settings.messages_till_profile_update,
+            messages_for_input_extraction = settings.messages_for_input_extraction,
+            messages_till_journal_update = settings.messages_till_journal_update,
+            messages_for_journal_update = settings.messages_for_journal_update,
+            native_tool_calling = settings.native_tool_calling
+        )
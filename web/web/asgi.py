@@ -15,11 +15,16 @@ from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 
 import app.routing
+from app.background import install_shutdown_flush, lifespan
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'web.settings')
 
+# Pending database writes done after responses are committed before the server stops.
+install_shutdown_flush()
+
 application = ProtocolTypeRouter({
     "http": get_asgi_application(),
+    "lifespan": lifespan,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             app.routing.websocket_urlpatterns